@@ -1,5 +1,7 @@
 from django.contrib import admin
+from django.contrib.admin.views.main import ChangeList
 from models import Category, Entry
+from bulk import update_entries
 from django.template.defaultfilters import slugify, pluralize
 from django.contrib import messages
 from django.utils.translation import ugettext as _
@@ -14,8 +16,29 @@ from django.http import HttpResponse, HttpResponseRedirect
 from django.utils.html import escape
 import urllib, urllib2
 import urlparse
+import search
+
+class SearchChangeList(ChangeList):
+    """
+    A change list whose search box uses loft's search index rather than LIKE
+    queries on the admin's search_fields
+    """
+
+    def get_query_set(self):
+        query, self.query = self.query, ''
+        try:
+            qs = super(SearchChangeList, self).get_query_set()
+        finally:
+            self.query = query
+        if query:
+            qs = search.matching(qs, query)
+        return qs
+
 
 class EntryAdmin(admin.ModelAdmin):
+
+    def get_changelist(self, request, **kwargs):
+        return SearchChangeList
     
     def admin_link(self, obj):
         if obj.status == Entry.PUBLISHED:
@@ -30,28 +53,33 @@ class EntryAdmin(admin.ModelAdmin):
         return obj.publish_date.strftime('%d %b, %Y')
     format_date.short_description = _('Date Published')
 
+    # Bulk actions go through update_entries(), which renders and writes
+    # entries in batches and sends entries_changed once for the lot
+
     def make_published(self, request, queryset):
-        row_count = queryset.update(status=Entry.PUBLISHED)
+        # Entries with a future publish date are scheduled rather than published
+        row_count = update_entries(queryset, status=Entry.PUBLISHED)
         messages.info(request, '%d entr%s set as published.' % (row_count, pluralize(row_count, 'y was,ies were')))
     make_published.short_description = ugettext_lazy("Set selected %(verbose_name_plural)s as published")
 
     def make_draft(self, request, queryset):
-        row_count = queryset.update(status=Entry.DRAFT)
+        row_count = update_entries(queryset, status=Entry.DRAFT)
         messages.info(request, '%d entr%s set as draft.' % (row_count, pluralize(row_count, 'y was,ies were')))
     make_draft.short_description = ugettext_lazy("Set selected %(verbose_name_plural)s as draft")
 
     def enable_comments(self, request, queryset):
-        row_count = queryset.update(enable_comments=True)
+        row_count = update_entries(queryset, enable_comments=True)
         messages.info(request, 'Commenting was enabled on %d entr%s' % (row_count, pluralize(row_count, 'y,ies')))
     enable_comments.short_description = ugettext_lazy("Enable commenting on selected %(verbose_name_plural)s")
 
     def disable_comments(self, request, queryset):
-        row_count = queryset.update(enable_comments=False)
+        row_count = update_entries(queryset, enable_comments=False)
         messages.info(request, 'Commenting was disabled on %d entr%s' % (row_count, pluralize(row_count, 'y,ies')))
     disable_comments.short_description = ugettext_lazy("Disable commenting on selected %(verbose_name_plural)s")
     
     list_display = ('title', 'format_date', 'status', 'enable_comments', 'admin_link')
     list_filter = ('publish_date', 'status', 'categories')
+    # Searched with loft's search index by SearchChangeList
     search_fields = ('title', 'body')
     prepopulated_fields = {'slug': ['title']}
     ordering = ('-publish_date',)
@@ -79,10 +107,6 @@ class EntryAdmin(admin.ModelAdmin):
 
 class CategoryAdmin(admin.ModelAdmin):
 
-    def entry_count(self, obj):
-        return obj.entry_categories.all().count()
-    entry_count.short_description = _('Entries')
-
     form = CategoryAdminForm
     prepopulated_fields = {'slug': ['name']}
     list_display = ('name', 'description', 'entry_count')
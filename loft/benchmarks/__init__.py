@@ -0,0 +1,15 @@
+"""
+Benchmarks of loft's expensive paths against synthetic blogs.
+
+``./manage.py loft_benchmark`` creates a test database, fills it with a
+generated corpus (see ``corpus``) and times rendering, saving, the views,
+feeds, sitemap, archives and template tags (see ``suite``). It records wall
+time, queries and growth in peak memory for each, and writes the results as
+JSON so runs can be compared across commits::
+
+    ./manage.py loft_benchmark --entries 10000 --output before.json
+
+The project's own settings apply, so set ``LOFT_PAGE_CACHE`` and the cache
+backends as in production. Use a database other than in-memory SQLite to
+render the corpus on more than one process.
+"""
@@ -0,0 +1,152 @@
+"""
+Synthetic blogs for benchmarking.
+
+Entries are generated from a seeded random number generator, so the same
+arguments always give the same corpus. They imitate a long-running blog:
+
+* Bodies are Markdown with a log-normal number of paragraphs, about 500
+  words for a typical entry with a long tail of much longer ones.
+* About a third of entries include highlighted code blocks, each different,
+  so Pygments runs for every one.
+* Words and categories are drawn with Zipf-like popularity, so a few
+  categories hold most entries. Entries are in one to four categories.
+* Publish dates run evenly over ``YEARS`` years up to today, in primary key
+  order, with a few drafts and scheduled entries.
+
+Entries are written with the importer, in batches rendered on a process pool.
+"""
+from django.template.defaultfilters import slugify
+from loft.importer import BATCH_SIZE, Importer, batches
+from datetime import datetime, timedelta
+import bisect
+import math
+import random
+
+YEARS = 10
+
+SYLLABLES = ('ka', 'lo', 'mi', 'ne', 'ru', 'ta', 'vi', 'so', 'pe', 'da', 'gu', 'fi',
+    'zo', 'ba', 'ce', 'hy', 'wa', 'jo', 'xi', 'ly')
+
+CODE_LINES = (
+    'def %(a)s(%(b)s):',
+    '    return %(b)s.%(c)s(%(n)d)',
+    'for %(a)s in range(%(n)d):',
+    '    %(b)s = %(c)s[%(a)s] * %(n)d',
+    'class %(A)s(object):',
+    '    %(a)s = "%(b)s-%(n)d"',
+    'if %(a)s is not None and %(b)s > %(n)d:',
+    '    raise ValueError("%(c)s")',
+)
+
+
+class Corpus(object):
+    """
+    Generates ``entries`` importer items from ``seed``
+    """
+
+    def __init__(self, entries, seed=0, vocabulary=5000, categories=None):
+        self.entries = entries
+        self.seed = seed
+        rng = random.Random(seed)
+        self.words = self.unique_words(rng, vocabulary, 2, 4)
+        self.word_weights = self.zipf(len(self.words))
+        if categories is None:
+            categories = max(5, min(1000, int(math.sqrt(entries))))
+        self.categories = [word.capitalize() for word in self.unique_words(rng, categories, 3, 5)]
+        self.category_weights = self.zipf(len(self.categories))
+
+    def unique_words(self, rng, count, shortest, longest):
+        words, seen = [], set()
+        while len(words) < count:
+            word = ''.join([rng.choice(SYLLABLES) for i in range(rng.randint(shortest, longest))])
+            if word not in seen:
+                seen.add(word)
+                words.append(word)
+        return words
+
+    def zipf(self, count):
+        """
+        Cumulative weights giving the item at each rank a share proportional
+        to 1 / rank
+        """
+        total, weights = 0.0, []
+        for rank in range(1, count + 1):
+            total += 1.0 / rank
+            weights.append(total)
+        return weights
+
+    def pick(self, rng, items, weights):
+        return items[min(len(items) - 1, bisect.bisect(weights, rng.random() * weights[-1]))]
+
+    def sentence(self, rng, length):
+        words = [self.pick(rng, self.words, self.word_weights) for i in range(length)]
+        return ' '.join(words).capitalize() + '.'
+
+    def paragraph(self, rng):
+        return ' '.join([self.sentence(rng, rng.randint(6, 18)) for i in range(rng.randint(3, 7))])
+
+    def code_block(self, rng, number):
+        lines = ['    :::python']
+        for i in range(rng.randint(5, 30)):
+            names = dict(
+                a=rng.choice(self.words[:200]), b=rng.choice(self.words[:200]),
+                c=rng.choice(self.words[:200]), n=number * 100 + i,
+            )
+            names['A'] = names['a'].capitalize()
+            lines.append('    ' + rng.choice(CODE_LINES) % names)
+        return '\n'.join(lines)
+
+    def body(self, rng, number):
+        paragraphs = int(min(60, max(1, rng.lognormvariate(math.log(6), 0.6))))
+        blocks = [self.paragraph(rng) for i in range(paragraphs)]
+        if rng.random() < 0.3:
+            for i in range(rng.randint(1, 3)):
+                blocks.insert(rng.randint(1, len(blocks)), self.code_block(rng, number))
+        return '\n\n'.join(blocks)
+
+    def __iter__(self):
+        from loft.models import Entry
+        rng = random.Random(self.seed)
+        end = datetime.now().replace(microsecond=0)
+        start = end - timedelta(days=365 * YEARS)
+        step = (end - start).total_seconds() / max(1, self.entries)
+        for number in range(self.entries):
+            title = self.sentence(rng, rng.randint(3, 8))[:-1]
+            publish_date = start + timedelta(seconds=int(number * step))
+            status = Entry.PUBLISHED
+            roll = rng.random()
+            if roll < 0.04:
+                status = Entry.DRAFT
+            elif roll < 0.05:
+                status = Entry.SCHEDULED
+                publish_date = end + timedelta(days=rng.randint(1, 60))
+            names = set()
+            while len(names) < min(len(self.categories), rng.randint(1, 4)):
+                names.add(self.pick(rng, self.categories, self.category_weights))
+            yield {
+                'title': title,
+                'slug': '%s-%d' % (slugify(title)[:60], number + 1),
+                'body': self.body(rng, number),
+                'excerpt': rng.random() < 0.3 and self.sentence(rng, 20) or '',
+                'markup': Entry.MARKDOWN,
+                'status': status,
+                'publish_date': publish_date,
+                'categories': [(slugify(name), name) for name in sorted(names)],
+                'meta_keywords': ', '.join(rng.sample(self.words[:500], 5)),
+            }
+
+
+def populate(author, entries, seed=0, processes=None, batch_size=BATCH_SIZE):
+    """
+    Write a generated corpus of ``entries`` entries by ``author``. Returns
+    the Corpus.
+    """
+    corpus = Corpus(entries, seed)
+    importer = Importer(author, processes)
+    try:
+        for batch in batches(iter(corpus), batch_size):
+            importer.write(batch)
+    finally:
+        importer.close()
+    importer.finish()
+    return corpus
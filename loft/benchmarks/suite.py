@@ -0,0 +1,176 @@
+"""
+The benchmarks, run against whatever entries are in the database.
+
+Each benchmark is timed over a number of iterations, recording for each
+iteration its wall time and the queries it ran. Peak memory is the growth in
+the process's maximum resident set size over the benchmark, so it's only
+non-zero when a benchmark needs more memory than anything before it.
+"""
+from django.conf import settings
+from django.core.urlresolvers import reverse
+from django.db import connection, reset_queries
+from django.template import Template, Context
+from django.test.client import Client
+from loft.cache import bump_generation, cache
+from loft.feeds import LoftEntryFeedRSS
+from loft.models import Entry
+from loft.rendering import render_cache
+from datetime import datetime
+import gc
+import itertools
+import resource
+import time
+
+AJAX = {'HTTP_X_REQUESTED_WITH': 'XMLHttpRequest'}
+
+LATEST_ENTRIES = Template(
+    "{% load blog_tags %}{% get_latest_entries 10 %}"
+    "{% for entry in entry_list %}{{ entry.title }}{{ entry.get_absolute_url }}{% endfor %}"
+)
+
+
+def max_rss():
+    """
+    The process's peak resident set size in kilobytes
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(name, function, iterations, setup=None):
+    """
+    Time ``iterations`` calls of ``function``, calling ``setup`` untimed
+    before each. Returns the benchmark's results.
+    """
+    debug, settings.DEBUG = settings.DEBUG, True
+    times, queries = [], []
+    gc.collect()
+    peak = max_rss()
+    try:
+        for i in range(iterations):
+            if setup is not None:
+                setup()
+            reset_queries()
+            start = time.time()
+            function()
+            times.append(time.time() - start)
+            queries.append(len(connection.queries))
+    finally:
+        settings.DEBUG = debug
+        reset_queries()
+    times.sort()
+    return {
+        'name': name,
+        'iterations': iterations,
+        'seconds': {
+            'min': times[0],
+            'median': times[len(times) // 2],
+            'mean': sum(times) / len(times),
+            'max': times[-1],
+        },
+        'queries': max(queries),
+        'peak_memory_kb': max_rss() - peak,
+    }
+
+
+def get(path, status=200, **extra):
+    """
+    Returns a function requesting ``path``, checking the response's status
+    and reading all of its content
+    """
+    client = Client()
+    def request():
+        response = client.get(path, **extra)
+        if response.status_code != status:
+            raise AssertionError("%s returned %d" % (path, response.status_code))
+        ''.join(response)
+    return request
+
+
+def benchmarks():
+    """
+    Returns a list of (name, function, setup) for every benchmark
+    """
+    published = Entry.objects.published()
+    count = published.count()
+    if not count:
+        raise ValueError("There are no published entries to benchmark")
+    # An entry from the middle of the blog, with neighbours on both sides
+    entry = published.order_by('publish_date')[count // 2]
+    date = entry.publish_date
+    body = Entry.objects.filter(pk=entry.pk).values_list('body', flat=True)[0]
+    counter = itertools.count()
+    feed = LoftEntryFeedRSS()
+
+    def save_new():
+        Entry.objects.create(
+            title="Benchmark entry %d" % counter.next(),
+            body=body, author_id=entry.author_id, status=Entry.PUBLISHED,
+        )
+
+    def save_existing():
+        entry.title = "Benchmark entry %d" % counter.next()
+        entry.save()
+
+    def render_new():
+        # Change the text, so the render cache misses
+        entry.create_markup('%s\n\n%d' % (body, counter.next()))
+
+    def render_cached():
+        entry.create_markup(body)
+
+    def latest_entries():
+        LATEST_ENTRIES.render(Context())
+
+    index = reverse('blog_index')
+    year = reverse('blog_entry_archive_year', kwargs={'year': date.year})
+    month = reverse('blog_entry_archive_month', kwargs={
+        'year': date.year, 'month': date.strftime('%b').lower()})
+    return [
+        ('create_markup', render_new, None),
+        ('create_markup cached', render_cached, render_cached),
+        ('Entry.save new', save_new, None),
+        ('Entry.save edit', save_existing, None),
+        # The saves have changed the blog, so what follows is cold first
+        ('list', get(index), None),
+        ('list ajax', get(index, **AJAX), None),
+        ('detail', get(entry.get_absolute_url()), None),
+        ('detail ajax', get(entry.get_absolute_url(), **AJAX), None),
+        ('feed rss', get(reverse('blog_rss_feed')), lambda: cache.delete(feed.cache_key())),
+        ('feed rss cached', get(reverse('blog_rss_feed')), None),
+        ('feed atom cached', get(reverse('blog_atom_feed')), None),
+        ('sitemap index', get(reverse('blog_sitemap')), None),
+        ('sitemap section', get(reverse('blog_sitemap_section', kwargs={'section': 1})), None),
+        ('archive year', get(year), None),
+        ('archive month', get(month), None),
+        ('get_latest_entries', latest_entries, bump_generation),
+        ('get_latest_entries cached', latest_entries, None),
+    ]
+
+
+def run(iterations=10, names=None):
+    """
+    Run the benchmarks, or those named in ``names``, and return their results
+    """
+    results = []
+    render_cache.clear()
+    for name, function, setup in benchmarks():
+        if names and name not in names:
+            continue
+        results.append(measure(name, function, iterations, setup))
+    return results
+
+
+def environment():
+    """
+    Returns what the results of a run depend on besides the code
+    """
+    import django
+    import platform
+    return {
+        'date': datetime.now().strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'database': connection.vendor,
+        'page_cache': bool(getattr(settings, 'LOFT_PAGE_CACHE', False)),
+        'max_rss_kb': max_rss(),
+    }
@@ -0,0 +1,266 @@
+"""
+Rendering and writing many entries at once.
+
+Going through ``Entry.save()`` renders and writes one entry per query. These
+helpers instead stream entries in primary key batches, render them on a
+process pool and write the results back with one batched ``UPDATE`` per batch.
+
+``update_entries()`` applies a change to many entries the way ``save()``
+would, for the admin's bulk actions. It renders in the calling process, as
+starting a pool closes the database connection and forks the web server's
+process mid-request; management commands may ask it for a pool.
+
+Commands that write entries with the other helpers call ``invalidate_all()``
+when they're done, as nothing else tells the caches.
+"""
+from django.db import connection, transaction
+from django.template.defaultfilters import slugify
+from rendering import render
+from datetime import datetime
+import multiprocessing
+
+RENDER_FIELDS = ('id', 'markup', 'body', 'excerpt', 'slug', 'status', 'title')
+
+HTML_FIELDS = ('body_html', 'excerpt_html', 'lead_in_html')
+
+BATCH_SIZE = 500
+
+
+def iter_batches(queryset, batch_size=500):
+    """
+    Yield lists of at most ``batch_size`` objects from ``queryset`` in primary
+    key order. Each batch is a separate query that seeks past the last primary
+    key, so memory use doesn't grow with the size of the table.
+    """
+    last_pk = None
+    queryset = queryset.order_by('pk')
+    while True:
+        qs = queryset
+        if last_pk is not None:
+            qs = qs.filter(pk__gt=last_pk)
+        batch = list(qs[:batch_size])
+        if not batch:
+            break
+        yield batch
+        last_pk = batch[-1].pk
+
+
+def render_job(entry):
+    """
+    Returns the picklable rendering job for an entry. The lead-in's permalink
+    is resolved here, so workers don't need a URLconf.
+    """
+    return (entry.pk, entry.markup, entry.body, entry.excerpt, entry.lead_in_source())
+
+
+def render_entry(job):
+    """
+    Render one job from ``render_job()``. Runs in a worker process.
+    """
+    pk, markup, body, excerpt, lead_in = job
+    return (
+        pk,
+        render(body, markup),
+        excerpt and render(excerpt, markup) or '',
+        render(lead_in, markup),
+    )
+
+
+class Renderer(object):
+    """
+    Renders jobs on a pool of ``processes`` worker processes, or in this
+    process when ``processes`` is 1. Jobs are passed to ``function``, which
+    must be importable by the workers.
+    """
+
+    def __init__(self, processes=None, function=render_entry):
+        self.processes = processes or multiprocessing.cpu_count()
+        self.function = function
+        self.pool = None
+        if self.processes > 1:
+            # Children mustn't inherit the parent's database connection
+            connection.close()
+            self.pool = multiprocessing.Pool(self.processes)
+
+    def render(self, jobs):
+        if self.pool is None:
+            return map(self.function, jobs)
+        chunksize = max(1, len(jobs) // (self.processes * 4))
+        return self.pool.map(self.function, jobs, chunksize)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+
+def update_rows(model, fields, rows):
+    """
+    Write ``rows`` of ``(value, ..., pk)`` tuples for ``fields`` to
+    ``model``'s table with a single batched ``UPDATE`` statement, touching
+    each row's updated time and version as ``save()`` would
+    """
+    if not rows:
+        return
+    qn = connection.ops.quote_name
+    opts = model._meta
+    fields = [opts.get_field(name) for name in fields]
+    version = qn(opts.get_field('version').column)
+    sql = 'UPDATE %s SET %s, %s = %%s, %s = %s + 1 WHERE %s = %%s' % (
+        qn(opts.db_table),
+        ', '.join(['%s = %%s' % qn(field.column) for field in fields]),
+        qn(opts.get_field('updated').column),
+        version, version,
+        qn(opts.pk.column),
+    )
+    now = connection.ops.value_to_db_datetime(datetime.now())
+    params = [
+        [field.get_db_prep_save(value, connection=connection) for field, value in zip(fields, row[:-1])] + [now, row[-1]]
+        for row in rows
+    ]
+    cursor = connection.cursor()
+    cursor.executemany(sql, params)
+
+
+def insert_rows(model, fields, rows):
+    """
+    Insert ``rows`` of values for ``fields`` into ``model``'s table with a
+    single batched ``INSERT`` statement. Nothing is saved through the ORM,
+    so no signals are sent.
+    """
+    if not rows:
+        return
+    qn = connection.ops.quote_name
+    opts = model._meta
+    fields = [opts.get_field(name) for name in fields]
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+        qn(opts.db_table),
+        ', '.join([qn(field.column) for field in fields]),
+        ', '.join(['%s'] * len(fields)),
+    )
+    params = [
+        [field.get_db_prep_save(value, connection=connection) for field, value in zip(fields, row)]
+        for row in rows
+    ]
+    cursor = connection.cursor()
+    cursor.executemany(sql, params)
+
+
+@transaction.commit_on_success
+def update_rendered(model, results):
+    """
+    Write rendered ``(pk, body_html, excerpt_html, lead_in_html)`` tuples back
+    to ``model``'s table with a single batched ``UPDATE`` statement.
+    """
+    update_rows(model, HTML_FIELDS, [row[1:] + row[:1] for row in results])
+
+
+def invalidate_all():
+    """
+    Throw away everything cached from entries, after writing many of them
+    without sending the signals that would invalidate it entry by entry
+    """
+    from cache import bump_generation, cache
+    from feeds import LoftEntryFeedRSS, LoftEntryFeedAtom
+    from models import Revision
+    import pagecache
+    bump_generation()
+    Revision.bump()
+    pagecache.purge_all()
+    for feed in (LoftEntryFeedRSS(), LoftEntryFeedAtom()):
+        cache.delete(feed.cache_key())
+
+
+def planned_values(entry, values, now):
+    """
+    Returns the fields of ``entry`` that change when ``values`` are applied
+    to it, adjusted as ``Entry.save()`` would adjust them
+    """
+    from models import Entry
+    values = dict(values)
+    if values.get('status') in (Entry.PUBLISHED, Entry.SCHEDULED):
+        # Entries published with a future date wait until they're due
+        values['publish_date'] = entry.publish_date or now
+        values['status'] = values['publish_date'] > now and Entry.SCHEDULED or Entry.PUBLISHED
+    if not entry.slug:
+        values['slug'] = slugify(entry.title)
+    return dict((name, value) for name, value in values.items() if getattr(entry, name) != value)
+
+
+def update_entries(queryset, processes=1, **values):
+    """
+    Set ``values`` on the entries in ``queryset`` as ``Entry.save()`` would,
+    without saving them one at a time. Only entries whose stored HTML is
+    missing, or whose lead-in links elsewhere once changed, are rendered, in
+    this process unless ``processes`` asks for a pool. Changes are written
+    with batched updates in one transaction, then entries_changed is sent
+    once for all of them. Returns the number of entries changed.
+    """
+    from models import Entry, EntryState
+    from signals import entries_changed
+    qn = connection.ops.quote_name
+    now = datetime.now()
+    fields = ['id', 'title'] + [name for name in EntryState._fields + tuple(values) if name != 'id']
+    unrendered = "CASE WHEN %s = '' OR %s = '' THEN 1 ELSE 0 END" % (qn('body_html'), qn('lead_in_html'))
+    queryset = queryset.only(*set(fields)).extra(select={'unrendered': unrendered})
+
+    changes = []
+    for batch in iter_batches(queryset, BATCH_SIZE):
+        for entry in batch:
+            new = planned_values(entry, values, now)
+            if new:
+                previous = entry.get_state()
+                for name, value in new.items():
+                    setattr(entry, name, value)
+                current = entry.get_state()
+                # The lead-in ends with a permalink, which moves when an entry
+                # is published or unpublished or its slug changes
+                moved = (previous.status == Entry.PUBLISHED) != (current.status == Entry.PUBLISHED)
+                moved = moved or (current.status == Entry.PUBLISHED and previous.slug != current.slug)
+                changes.append((entry.pk, previous, current, new, bool(entry.unrendered) or moved))
+    if not changes:
+        return 0
+
+    # A pool must be started before writing, as it closes the connection
+    renderer = Renderer(processes)
+    try:
+        write_changes(Entry, changes, renderer)
+    finally:
+        renderer.close()
+    entries_changed.send(sender=Entry, changes=dict(
+        (pk, (previous, current)) for pk, previous, current, new, render in changes
+    ))
+    return len(changes)
+
+
+@transaction.commit_on_success
+def write_changes(model, changes, renderer):
+    """
+    Write the changes planned by ``update_entries()``, rendering the entries
+    that need it, a batch at a time
+    """
+    for i in range(0, len(changes), BATCH_SIZE):
+        block = changes[i:i + BATCH_SIZE]
+        values = dict((pk, new) for pk, previous, current, new, render in block)
+        rendered = {}
+        pks = [pk for pk, previous, current, new, render in block if render]
+        if pks:
+            jobs = []
+            for entry in model.objects.filter(pk__in=pks).only(*RENDER_FIELDS):
+                for name, value in values[entry.pk].items():
+                    setattr(entry, name, value)
+                jobs.append(render_job(entry))
+            rendered = dict((result[0], result[1:]) for result in renderer.render(jobs))
+
+        # One statement for each combination of fields written
+        statements = {}
+        for pk, new in values.items():
+            names = tuple(sorted(new))
+            row = tuple([new[name] for name in names])
+            if pk in rendered:
+                names += HTML_FIELDS
+                row += rendered[pk]
+            statements.setdefault(names, []).append(row + (pk,))
+        for names, rows in statements.items():
+            update_rows(model, names, rows)
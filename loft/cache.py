@@ -0,0 +1,56 @@
+"""
+Caching of derived entry data, such as an entry's neighbours.
+
+Keys made with ``cache_key()`` include a generation number that is bumped
+whenever an entry changes, so everything cached with them is invalidated at
+once without having to track individual keys.
+
+The cache backend is chosen with ``LOFT_CACHE_BACKEND`` (a cache alias or
+backend URI, default ``default``) and items are kept for ``LOFT_CACHE_TIMEOUT``
+seconds (default one hour).
+"""
+from django.conf import settings
+from django.core.cache import get_cache
+from datetime import datetime
+import time
+
+cache = get_cache(getattr(settings, 'LOFT_CACHE_BACKEND', 'default'))
+
+CACHE_TIMEOUT = getattr(settings, 'LOFT_CACHE_TIMEOUT', 60 * 60)
+
+GENERATION_KEY = 'loft:generation'
+
+
+def generation():
+    gen = cache.get(GENERATION_KEY)
+    if gen is None:
+        # Start from the clock so that, if the generation is evicted, keys
+        # made before the eviction are never reused
+        gen = int(time.time() * 1000)
+        if not cache.add(GENERATION_KEY, gen, 60 * 60 * 24 * 30):
+            gen = cache.get(GENERATION_KEY, gen)
+    return gen
+
+
+def bump_generation():
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:
+        generation()
+
+
+def cache_key(*bits):
+    return 'loft:%s:%s' % (generation(), ':'.join([str(bit) for bit in bits]))
+
+
+def cache_timeout(timeout=CACHE_TIMEOUT):
+    """
+    Returns ``timeout``, shortened if need be so that anything cached with it
+    expires when the next scheduled entry is due to be published.
+    """
+    from models import Entry
+    next_date = Entry.objects.next_publish_date()
+    if next_date is not None:
+        due = next_date - datetime.now()
+        timeout = min(timeout, max(1, due.days * 86400 + due.seconds + 1))
+    return timeout
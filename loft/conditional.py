@@ -0,0 +1,58 @@
+"""
+Conditional GET support for loft's views and sitemap. The feeds have their
+own validators; see ``loft.feeds``.
+
+Every page loft serves depends on more than one entry: listings and archives
+on all published entries, and detail pages on their neighbours, categories
+and comments as well. So all of them share one set of validators, taken from
+the blog's Revision row, which is bumped whenever an entry, category or
+comment changes:
+
+* Last-Modified is the time of the latest change.
+* The ETag combines the number of changes with the request's path, query
+  string, Accept header and whether it's an AJAX request.
+
+Both come from one primary key lookup, so a client whose copy is current is
+answered with a 304 before any template is rendered or markup is run.
+Requests from visitors with a session get neither, so a page rendered for a
+logged in user is never confirmed to an anonymous one, or the reverse.
+"""
+from django.conf import settings
+from django.views.decorators.http import condition
+from django.utils.hashcompat import md5_constructor
+from models import Revision
+
+
+def revision(request):
+    if not hasattr(request, '_loft_revision'):
+        request._loft_revision = Revision.current()
+    return request._loft_revision
+
+
+def last_modified(request, *args, **kwargs):
+    return revision(request)[1]
+
+
+def etag(request, *args, **kwargs):
+    return md5_constructor('|'.join([
+        str(revision(request)[0]),
+        request.path,
+        request.META.get('QUERY_STRING', ''),
+        request.META.get('HTTP_ACCEPT', ''),
+        str(request.is_ajax()),
+    ])).hexdigest()
+
+
+def conditional(view):
+    """
+    Decorator adding loft's ETag and Last-Modified validators to a view
+    """
+    conditional_view = condition(etag_func=etag, last_modified_func=last_modified)(view)
+    def wrapper(request, *args, **kwargs):
+        if settings.SESSION_COOKIE_NAME in request.COOKIES:
+            return view(request, *args, **kwargs)
+        return conditional_view(request, *args, **kwargs)
+    wrapper.__name__ = view.__name__
+    wrapper.__module__ = view.__module__
+    wrapper.__doc__ = view.__doc__
+    return wrapper
@@ -4,10 +4,17 @@ from django.shortcuts import render_to_response
 from django.core import serializers
 from django.core.serializers.json import DjangoJSONEncoder
 from django.db.models.query import QuerySet, ValuesQuerySet
+from django.db.models import Q
 from django.db import models
+from django.db.models.fields import FieldDoesNotExist
+from django.conf import settings
 from django import http
 import json
 
+STREAM_CHUNK_SIZE = getattr(settings, 'LOFT_STREAM_CHUNK_SIZE', 100)
+
+NDJSON = 'application/x-ndjson'
+
 class ValuesDjangoJSONEncoder(DjangoJSONEncoder):
     def default(self, obj):
 
@@ -37,13 +44,204 @@ class ValuesDjangoJSONEncoder(DjangoJSONEncoder):
                 return list(obj)
             else:
                 return list(obj)[0]
+        if hasattr(obj, 'as_json'):
+            return obj.as_json()
         return DjangoJSONEncoder.default(self, obj)
 
-def add_ajax(template_name):
+class InstanceValues(object):
+
+    """
+    The equivalent of queryset.values(*fields) for a model instance that has
+    already been loaded, for returning from views decorated with add_ajax.
+    Foreign keys give the related object's primary key, as values() does.
+    """
+
+    def __init__(self, instance, *fields):
+        self.instance = instance
+        self.fields = fields
+
+    def as_json(self):
+        return [instance_values(self.instance, self.fields)]
+
+class ListValues(object):
+
+    """
+    The equivalent of queryset.values(*fields) for a list of model instances
+    that have already been loaded, such as search results. Fields may also
+    name plain attributes of the instances.
+    """
+
+    def __init__(self, instances, *fields):
+        self.instances = instances
+        self.fields = fields
+
+    def as_json(self):
+        return [instance_values(instance, self.fields) for instance in self.instances]
+
+    def iter_rows(self, chunk_size):
+        for i in range(0, len(self.instances), chunk_size):
+            yield [instance_values(instance, self.fields) for instance in self.instances[i:i + chunk_size]]
+
+def instance_values(instance, fields):
+    values = {}
+    for name in fields:
+        try:
+            values[name] = getattr(instance, instance._meta.get_field(name).attname)
+        except FieldDoesNotExist:
+            values[name] = getattr(instance, name)
+    return values
+
+def keyset_ordering(queryset):
+
+    """
+    Returns the ordering of a queryset as a list of fields that rows can be
+    seeked through, ending with the primary key to break ties, or None if it
+    can't be. Querysets that are sliced, or ordered randomly, across
+    relations or by columns that may be NULL, can't be.
+    """
+
+    query = queryset.query
+    if query.low_mark or query.high_mark is not None or query.extra_order_by:
+        return None
+    opts = queryset.model._meta
+    ordering = query.order_by or (query.default_ordering and opts.ordering) or []
+    fields = []
+    for field in ordering:
+        name = field.lstrip('-')
+        if name == 'pk':
+            name = opts.pk.name
+        try:
+            model_field = opts.get_field(name)
+        except FieldDoesNotExist:
+            return None
+        if model_field.null or model_field.rel:
+            return None
+        fields.append(field.startswith('-') and '-' + name or name)
+    if opts.pk.name not in [field.lstrip('-') for field in fields]:
+        fields.append(opts.pk.name)
+    return fields
+
+def seek(ordering, row):
+
+    """ A filter for the rows that come after row in ordering """
+
+    q, equal = None, {}
+    for field in ordering:
+        name = field.lstrip('-')
+        lookup = '%s__%s' % (name, field.startswith('-') and 'lt' or 'gt')
+        clause = Q(**dict(equal, **{lookup: row[name]}))
+        q = q is None and clause or q | clause
+        equal[name] = row[name]
+    return q
+
+def iter_values(queryset, chunk_size=STREAM_CHUNK_SIZE):
+
+    """
+    Iterate over a ValuesQuerySet in lists of at most chunk_size rows, keeping
+    its ordering. Each chunk is fetched by seeking past the ordering values of
+    the last row of the one before, so memory use doesn't depend on the size
+    of the result whatever the database driver buffers. Querysets that can't
+    be seeked through (see keyset_ordering) are read with iterator() instead.
+    """
+
+    ordering = keyset_ordering(queryset)
+    if ordering is None:
+        rows = []
+        for row in queryset.iterator():
+            rows.append(row)
+            if len(rows) == chunk_size:
+                yield rows
+                rows = []
+        if rows:
+            yield rows
+        return
+
+    fields = list(queryset._fields)
+    extra = [field.lstrip('-') for field in ordering if fields and field.lstrip('-') not in fields]
+    queryset = queryset.order_by(*ordering)
+    if extra:
+        queryset = queryset.values(*(fields + extra))
+    last = None
+    while True:
+        chunk = queryset
+        if last is not None:
+            chunk = chunk.filter(seek(ordering, last))
+        rows = list(chunk[:chunk_size])
+        if not rows:
+            return
+        last = rows[-1]
+        if extra:
+            rows = [dict((name, row[name]) for name in fields) for row in rows]
+        yield rows
+        if len(rows) < chunk_size:
+            return
+
+def iter_rows(value, chunk_size=STREAM_CHUNK_SIZE):
+
+    """
+    Iterate over the rows of a ValuesQuerySet, or of an object with an
+    iter_rows() method such as a page from loft.pagination, in lists of at
+    most chunk_size rows. Returns None for any other value.
+    """
+
+    if isinstance(value, ValuesQuerySet):
+        return iter_values(value, chunk_size)
+    if hasattr(value, 'iter_rows'):
+        return value.iter_rows(chunk_size)
+    return None
+
+def stream_json(data, chunk_size=STREAM_CHUNK_SIZE):
+
+    """
+    Encode a view's dictionary as one JSON object, a chunk of rows at a time
+    """
+
+    encoder = ValuesDjangoJSONEncoder()
+    yield '{'
+    for i, (key, value) in enumerate(data.items()):
+        yield '%s%s: ' % (i and ', ' or '', encoder.encode(key))
+        chunks = iter_rows(value, chunk_size)
+        if chunks is not None:
+            yield '['
+            separator = ''
+            for rows in chunks:
+                yield separator + ', '.join([encoder.encode(row) for row in rows])
+                separator = ', '
+            yield ']'
+        else:
+            yield encoder.encode(value)
+    yield '}'
+
+def stream_ndjson(data, chunk_size=STREAM_CHUNK_SIZE):
+
+    """
+    Encode a view's dictionary as newline delimited JSON. Every row of a
+    ValuesQuerySet or page of values is a line of its own; any other value is
+    written as a single {key: value} line before the rows.
+    """
+
+    encoder = ValuesDjangoJSONEncoder()
+    for key, value in data.items():
+        if iter_rows(value) is None:
+            yield encoder.encode({key: value}) + '\n'
+    for key, value in data.items():
+        chunks = iter_rows(value, chunk_size)
+        if chunks is not None:
+            for rows in chunks:
+                yield ''.join([encoder.encode(row) + '\n' for row in rows])
+
+def add_ajax(template_name, stream=False):
 
     """
     Decorator to render a response either with a template, as normal, or as
-    JSON. All querysets and model instances are converted to JSON.
+    JSON. All querysets and model instances are converted to JSON, as are
+    objects with an as_json() method, such as pages from loft.pagination.
+
+    With stream=True the JSON is streamed, fetching and encoding the rows of
+    ValuesQuerySets and pages of values a chunk at a time so memory use stays
+    flat however many rows there are. Streamed responses aren't kept by the
+    page cache. Requests that accept application/x-ndjson (or ask for
+    ?format=ndjson) are always streamed as newline delimited JSON.
     """
 
     def decorator(view):
@@ -54,8 +252,12 @@ def add_ajax(template_name):
             data = view(request, *args, **kwargs)
             if request.is_ajax():
                 for k,v in data.items():
-                    if not isinstance(v, ValuesQuerySet):
+                    if not isinstance(v, ValuesQuerySet) and not hasattr(v, 'as_json'):
                         del data[k]
+                if request.GET.get('format') == 'ndjson' or NDJSON in request.META.get('HTTP_ACCEPT', ''):
+                    return http.HttpResponse(stream_ndjson(data), mimetype=NDJSON)
+                if stream:
+                    return http.HttpResponse(stream_json(data), mimetype='application/json')
                 response = json.dumps(data, cls=ValuesDjangoJSONEncoder)
                 return http.HttpResponse(response, mimetype='application/json')
             else:
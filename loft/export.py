@@ -0,0 +1,226 @@
+"""
+Exporting the blog's public pages as static files.
+
+Every public page (the index, entry details, year and month archives, the
+feeds and the sitemap) is rendered through the normal views and written
+under an output directory, so that a web server such as nginx can serve the
+blog without Django. Each file is written to a temporary file and renamed
+into place, so a page is never served half written, and a gzipped copy is
+written next to it for nginx's ``gzip_static``. Pages are rendered through
+the project's middleware with requests for the current Site; see
+``loft.handlers``.
+
+Paths ending in a slash are written to an ``index.html`` in the matching
+directory, except for the feeds, which are written to ``index.xml`` so that
+the web server doesn't serve them as HTML. See the README for nginx's
+configuration.
+
+A manifest of what was exported is kept in the output directory. Later
+exports compare it with the database and only render the pages of entries
+that have changed since, removing pages that no longer exist.
+"""
+from django.core.urlresolvers import reverse
+from django.utils import simplejson as json
+from handlers import SiteHandler
+from models import Entry, EntryState, Category, entry_states
+from pagecache import entry_paths, sitemap_paths
+from sitemaps import sections
+from datetime import datetime
+import gzip
+import os
+import tempfile
+
+MANIFEST_NAME = '.loft-export.json'
+
+# One for each rendering process, so middleware is only loaded once
+handler = SiteHandler()
+
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def public_paths():
+    """
+    Returns the set of paths of every public page
+    """
+    entries = Entry.objects.published()
+    paths = set([
+        reverse('blog_index'),
+        reverse('blog_rss_feed'),
+        reverse('blog_atom_feed'),
+    ])
+    paths.update(sitemap_paths())
+    for number, lastmod in sections():
+        paths.add(reverse('blog_sitemap_section', kwargs={'section': number}))
+    for slug in entries.values_list('slug', flat=True).iterator():
+        paths.add(reverse('blog_entry_detail', kwargs={'slug': slug}))
+    for date in entries.dates('publish_date', 'year'):
+        paths.add(reverse('blog_entry_archive_year', kwargs={'year': date.year}))
+    for date in entries.dates('publish_date', 'month'):
+        paths.add(reverse('blog_entry_archive_month', kwargs={
+            'year': date.year, 'month': date.strftime('%b').lower()
+        }))
+    return paths
+
+
+def index_name(path):
+    """
+    Returns the name of the file a path ending in a slash is written to
+    """
+    if path in (reverse('blog_rss_feed'), reverse('blog_atom_feed')):
+        return 'index.xml'
+    return 'index.html'
+
+
+def file_path(output, path):
+    """
+    Returns the file a page is written to
+    """
+    name = path.lstrip('/')
+    if not name or name.endswith('/'):
+        name += index_name(path)
+    return os.path.join(output, *name.split('/'))
+
+
+def write_atomic(filename, content):
+    directory = os.path.dirname(filename)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Another worker may have made it first
+            if not os.path.isdir(directory):
+                raise
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.loft-')
+    try:
+        f = os.fdopen(fd, 'wb')
+        try:
+            if filename.endswith('.gz'):
+                # A fixed mtime keeps unchanged pages byte for byte the same
+                gz = gzip.GzipFile(os.path.basename(filename[:-3]), 'wb', 9, f, mtime=0)
+                gz.write(content)
+                gz.close()
+            else:
+                f.write(content)
+        finally:
+            f.close()
+        os.chmod(tmp, 0644)
+        os.rename(tmp, filename)
+    except:
+        os.unlink(tmp)
+        raise
+
+
+def export_page(job):
+    """
+    Render one page and write it and its gzipped copy. ``job`` is a tuple of
+    the output directory and the page's path. Returns the path and the
+    response's status code; only 200 responses are written.
+    """
+    output, path = job
+    response = handler(path)
+    if response.status_code == 200:
+        filename = file_path(output, path)
+        write_atomic(filename, response.content)
+        write_atomic(filename + '.gz', response.content)
+    return path, response.status_code
+
+
+def remove_page(output, path):
+    filename = file_path(output, path)
+    for name in (filename, filename + '.gz'):
+        if os.path.exists(name):
+            os.unlink(name)
+    # Tidy up directories left empty, such as those of unpublished entries
+    directory = os.path.dirname(filename)
+    while directory != output.rstrip(os.sep) and os.path.isdir(directory) and not os.listdir(directory):
+        os.rmdir(directory)
+        directory = os.path.dirname(directory)
+
+
+class Manifest(object):
+    """
+    A record of an export: when it started, the paths written and the state
+    and categories of every entry at the time.
+    """
+
+    def __init__(self, exported=None, paths=(), entries=None, categories=None):
+        self.exported = exported
+        self.paths = set(paths)
+        self.entries = entries or {}
+        self.categories = categories or {}
+
+    @classmethod
+    def current(cls, paths=()):
+        """
+        A manifest of the database as it is now
+        """
+        exported = datetime.now()
+        entries = {}
+        for pk, state in entry_states(Entry.objects.all()).items():
+            entries[pk] = [
+                state.status,
+                state.publish_date and state.publish_date.strftime(DATE_FORMAT),
+                state.slug,
+                [],
+            ]
+        through = Entry.categories.through.objects.order_by('category')
+        for entry_id, category_id in through.values_list('entry', 'category').iterator():
+            if entry_id in entries:
+                entries[entry_id][3].append(category_id)
+        categories = dict(
+            (pk, updated.strftime(DATE_FORMAT))
+            for pk, updated in Category.objects.values_list('pk', 'updated').iterator()
+        )
+        return cls(exported, paths, entries, categories)
+
+    @classmethod
+    def load(cls, output):
+        try:
+            f = open(os.path.join(output, MANIFEST_NAME))
+        except IOError:
+            return None
+        try:
+            data = json.load(f)
+        finally:
+            f.close()
+        return cls(
+            datetime.strptime(data['exported'], DATE_FORMAT),
+            data['paths'],
+            dict((int(pk), state) for pk, state in data['entries'].items()),
+            dict((int(pk), updated) for pk, updated in data['categories'].items()),
+        )
+
+    def save(self, output):
+        write_atomic(os.path.join(output, MANIFEST_NAME), json.dumps({
+            'exported': self.exported.strftime(DATE_FORMAT),
+            'paths': sorted(self.paths),
+            'entries': self.entries,
+            'categories': self.categories,
+        }))
+
+    def state(self, pk):
+        entry = self.entries.get(pk)
+        if entry is None:
+            return None
+        status, publish_date, slug = entry[:3]
+        if publish_date is not None:
+            publish_date = datetime.strptime(publish_date, DATE_FORMAT)
+        return EntryState(status, publish_date, slug)
+
+    def changed_paths(self, current):
+        """
+        Returns the paths that may differ between this export and the
+        ``current`` manifest, or None if everything may have changed.
+        """
+        if self.categories != current.categories:
+            return None
+        updated = set(
+            Entry.objects.filter(updated__gte=self.exported).values_list('pk', flat=True)
+        )
+        paths = set()
+        for pk in set(self.entries) | set(current.entries):
+            if pk in updated or self.entries.get(pk) != current.entries.get(pk):
+                paths.update(entry_paths(pk, self.state(pk)))
+                paths.update(entry_paths(pk, current.state(pk)))
+        return paths
+
@@ -1,20 +1,154 @@
+"""
+RSS and Atom feeds of the latest published entries.
+
+Feed readers poll these constantly, so each feed is serialized once, with a
+gzipped copy, and served from the ``LOFT_CACHE_BACKEND`` cache. The feeds are
+rebuilt as soon as an entry that appears in them is published, edited or
+unpublished. Responses carry an ETag of the feed's bytes and a Last-Modified
+of its newest change, and are gzipped for clients that accept it.
+
+``LOFT_FEED_ITEMS`` sets the number of entries in each feed (default 20) and
+``LOFT_FEED_FULL_CONTENT`` whether items carry the full entry rather than its
+lead-in (default ``False``). Feeds rebuilt outside of a request link to the
+current Site's domain over ``LOFT_SITE_SCHEME``; see ``loft.handlers``.
+"""
+from django.conf import settings
 from django.contrib.syndication.views import Feed
+from django.core.urlresolvers import reverse, NoReverseMatch
+from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
 from django.utils.feedgenerator import Atom1Feed
+from django.utils.hashcompat import md5_constructor
+from django.views.decorators.http import condition
+from cache import cache, cache_timeout
+from handlers import site_request
 from models import Entry
+from StringIO import StringIO
+import gzip
+
+FEED_ITEMS = getattr(settings, 'LOFT_FEED_ITEMS', 20)
+FEED_FULL_CONTENT = getattr(settings, 'LOFT_FEED_FULL_CONTENT', False)
+FEED_CACHE_TIMEOUT = 60 * 60 * 24 * 7
+
+
+def gzip_string(content):
+    buf = StringIO()
+    # A fixed mtime gives the same bytes for the same feed
+    gz = gzip.GzipFile(mode='wb', compresslevel=9, fileobj=buf, mtime=0)
+    gz.write(content)
+    gz.close()
+    return buf.getvalue()
+
+
+class CachedFeed(Feed):
+    """
+    A feed served from a serialized copy in the cache. ``url_name`` names the
+    feed's URL pattern, which is requested to rebuild the feed when an entry
+    changes.
+    """
+    url_name = None
+
+    def cache_key(self):
+        return 'loft:feed:%s' % self.url_name
+
+    def build(self, request=None):
+        """
+        Serialize the feed, store it in the cache and return it
+        """
+        if request is None:
+            request = site_request(reverse(self.url_name))
+        content = Feed.__call__(self, request).content
+        feed = {
+            'content': content,
+            'gzip': gzip_string(content),
+            'content_type': self.feed_type.mime_type,
+            'etag': md5_constructor(content).hexdigest(),
+            'last_modified': None,
+            'oldest': None,
+        }
+        items = list(self.items().values_list('publish_date', 'updated'))
+        if items:
+            feed['last_modified'] = max([updated for publish_date, updated in items])
+            if len(items) == FEED_ITEMS:
+                feed['oldest'] = items[-1][0]
+        cache.set(self.cache_key(), feed, cache_timeout(FEED_CACHE_TIMEOUT))
+        return feed
 
-class LoftEntryFeedRSS(Feed):
+    def get_cached(self, request):
+        return cache.get(self.cache_key()) or self.build(request)
+
+    def shows(self, feed, state):
+        """
+        Whether an entry in ``state`` is, or would be, one of the feed's items.
+        An entry without a publish date might be anywhere in the feed, so it's
+        taken to be in it.
+        """
+        return (state is not None and state.status == Entry.PUBLISHED and
+            (feed['oldest'] is None or state.publish_date is None or state.publish_date >= feed['oldest']))
+
+    def refresh(self, changes):
+        """
+        Rebuild the feed if any of the changed entries appear, or appeared, in
+        it. ``changes`` is as sent with the entries_changed signal.
+        """
+        feed = cache.get(self.cache_key())
+        if feed is not None:
+            for previous, current in changes.values():
+                if self.shows(feed, previous) or self.shows(feed, current):
+                    break
+            else:
+                return
+        try:
+            self.build()
+        except NoReverseMatch:
+            # The feed isn't in the URLconf, so there's nothing to serve
+            pass
+
+    def __call__(self, request, *args, **kwargs):
+        feed = self.get_cached(request)
+        gzipped = 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', '')
+        etag = feed['etag'] + (gzipped and '-gzip' or '')
+
+        def serve(request):
+            response = HttpResponse(gzipped and feed['gzip'] or feed['content'],
+                content_type=feed['content_type'])
+            if gzipped:
+                response['Content-Encoding'] = 'gzip'
+            patch_vary_headers(response, ('Accept-Encoding',))
+            return response
+
+        return condition(
+            etag_func=lambda request: etag,
+            last_modified_func=lambda request: feed['last_modified']
+        )(serve)(request)
+
+
+class LoftEntryFeedRSS(CachedFeed):
     title = "Timothy Fletcher's Blog Feed"
     link = "/"
     description = "A web developer's blog."
+    url_name = 'blog_rss_feed'
 
     def items(self):
-        return Entry.objects.published()[:20]
+        return Entry.objects.published()[:FEED_ITEMS]
 
     def item_title(self, item):
         return item.title
 
     def item_description(self, item):
-        return item.excerpt_html
+        if FEED_FULL_CONTENT:
+            return item.body_html
+        return item.lead_in()
 
 class LoftEntryFeedAtom(LoftEntryFeedRSS):
-    feed_type = Atom1Feed
\ No newline at end of file
+    feed_type = Atom1Feed
+    url_name = 'blog_atom_feed'
+
+
+def refresh_feeds(sender, changes, **kwargs):
+    """
+    Rebuild the feeds that show changed entries. Connected to the
+    entries_changed signal.
+    """
+    for feed in (LoftEntryFeedRSS(), LoftEntryFeedAtom()):
+        feed.refresh(changes)
@@ -0,0 +1,56 @@
+"""
+Requests for loft's own pages made outside of a web request, such as when
+the feeds are rebuilt after an entry is saved from a management command or
+the blog is exported as static files.
+
+They're addressed to the current Site's domain, so absolute URLs built from
+them point at the live site, over ``LOFT_SITE_SCHEME`` (default ``http``).
+"""
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.core.handlers.base import BaseHandler
+from django.core.handlers.wsgi import WSGIRequest
+from StringIO import StringIO
+import sys
+
+SITE_SCHEME = getattr(settings, 'LOFT_SITE_SCHEME', 'http')
+
+
+def site_request(path):
+    """
+    Returns a GET request for ``path`` on the current Site
+    """
+    domain = Site.objects.get_current().domain
+    host, port = domain, SITE_SCHEME == 'https' and '443' or '80'
+    if ':' in domain:
+        host, port = domain.rsplit(':', 1)
+    return WSGIRequest({
+        'REQUEST_METHOD': 'GET',
+        'SCRIPT_NAME': '',
+        'PATH_INFO': path,
+        'QUERY_STRING': '',
+        'SERVER_NAME': host,
+        'SERVER_PORT': port,
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'HTTP_HOST': domain,
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': SITE_SCHEME,
+        'wsgi.input': StringIO(),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': False,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    })
+
+
+class SiteHandler(BaseHandler):
+    """
+    Renders pages of the current Site through the project's middleware and
+    URLconf, as a server would but without sending the request signals,
+    which close the database connection after each page
+    """
+
+    def __call__(self, path):
+        if self._request_middleware is None:
+            self.load_middleware()
+        return self.get_response(site_request(path))
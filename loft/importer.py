@@ -0,0 +1,310 @@
+"""
+Importing entries from other blogs.
+
+``./manage.py loft_import`` reads a WordPress export (WXR) file or a
+directory of Markdown files with front matter, and writes the entries in
+batches: each batch is inserted with one statement per table in its own
+transaction, then rendered on a process pool. The export is parsed
+incrementally and each Markdown file read on its own, so memory use doesn't
+grow with the size of the import.
+
+Entries whose slug is already taken are skipped, so an import that failed
+part way can be run again. Entries without a slug are given one that stays
+the same from run to run: Markdown files their path within the directory,
+less the extension and any date, and WordPress entries, such as drafts,
+their title and WordPress post ID.
+
+A Markdown file looks like this, with every front matter field optional::
+
+    ---
+    title: My first entry
+    slug: my-first-entry
+    date: 2011-03-01 09:30
+    status: published
+    categories: Django, Python
+    excerpt: An entry about nothing in particular
+    markup: markdown
+    ---
+    The body of the entry...
+"""
+from django.template.defaultfilters import slugify
+from django.utils.encoding import force_unicode
+from bulk import HTML_FIELDS, Renderer, insert_rows, invalidate_all, render_job, update_rows
+from datetime import datetime
+from xml.etree import cElementTree
+import os
+import re
+
+BATCH_SIZE = 500
+
+MARKDOWN_EXTENSIONS = ('.md', '.markdown', '.mdown', '.txt')
+
+DATE_PREFIX = re.compile(r'^\d{4}-\d{2}-\d{2}-')
+
+DATE_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d')
+
+
+def parse_date(value):
+    value = (value or '').strip()
+    for format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, format)
+        except ValueError:
+            pass
+    return None
+
+
+def local_name(tag):
+    """
+    Returns an element's tag without its namespace, and the namespace
+    """
+    if tag.startswith('{'):
+        namespace, tag = tag[1:].split('}', 1)
+        return tag, namespace
+    return tag, ''
+
+
+def wxr_items(path):
+    """
+    Yields the posts in a WordPress export file. Pages, attachments and
+    comments are left out.
+    """
+    from models import Entry
+    statuses = {
+        'publish': Entry.PUBLISHED,
+        'future': Entry.SCHEDULED,
+    }
+    events = cElementTree.iterparse(path, events=('start', 'end'))
+    channel = None
+    for event, element in events:
+        if event == 'start':
+            if local_name(element.tag)[0] == 'channel':
+                channel = element
+            continue
+        if local_name(element.tag)[0] != 'item':
+            continue
+        item = {'categories': [], 'markup': Entry.MARKDOWN, 'body': '', 'excerpt': ''}
+        post_type, post_id = 'post', ''
+        for child in element:
+            name, namespace = local_name(child.tag)
+            text = child.text or ''
+            if name == 'title' and not namespace:
+                item['title'] = text.strip()
+            elif name == 'encoded':
+                item['excerpt' in namespace and 'excerpt' or 'body'] = text
+            elif name == 'post_name':
+                item['slug'] = text.strip()
+            elif name == 'post_date':
+                item['publish_date'] = parse_date(text)
+            elif name == 'status':
+                item['status'] = statuses.get(text.strip(), Entry.DRAFT)
+            elif name == 'post_type':
+                post_type = text.strip()
+            elif name == 'post_id':
+                post_id = text.strip()
+            elif name == 'category' and child.get('domain') == 'category':
+                item['categories'].append((child.get('nicename') or slugify(text), text.strip()))
+        # Drop the parsed item, and the items before it, as we go
+        if channel is not None:
+            channel.clear()
+        else:
+            element.clear()
+        if not item.get('slug') and post_id:
+            item['slug'] = '%s-%s' % (slugify(item.get('title', ''))[:60] or 'entry', post_id)
+        if post_type == 'post':
+            yield item
+
+
+def markdown_item(text):
+    """
+    Returns the item described by the front matter and body of a Markdown
+    file
+    """
+    from models import Entry
+    item = {'categories': [], 'markup': Entry.MARKDOWN, 'status': Entry.PUBLISHED}
+    lines = text.splitlines(True)
+    if lines and lines[0].strip() == '---':
+        for i, line in enumerate(lines[1:]):
+            if line.strip() == '---':
+                lines = lines[i + 2:]
+                break
+            if ':' not in line:
+                continue
+            key, value = [part.strip() for part in line.split(':', 1)]
+            key = key.lower()
+            if key == 'title' or key == 'slug' or key == 'excerpt' or key.startswith('meta_'):
+                item[key] = value.strip('"\'')
+            elif key == 'date':
+                item['publish_date'] = parse_date(value)
+            elif key == 'status':
+                item['status'] = {
+                    'draft': Entry.DRAFT,
+                    'scheduled': Entry.SCHEDULED,
+                }.get(value.lower(), Entry.PUBLISHED)
+            elif key == 'markup':
+                item['markup'] = value.lower() == 'textile' and Entry.TEXTILE or Entry.MARKDOWN
+            elif key in ('categories', 'tags', 'category'):
+                names = [name.strip().strip('"\'') for name in value.strip('[]').split(',')]
+                item['categories'] = [(slugify(name), name) for name in names if name]
+    item['body'] = ''.join(lines).strip()
+    return item
+
+
+def markdown_items(directory):
+    """
+    Yields the items of the Markdown files in a directory and its
+    subdirectories, in name order
+    """
+    for path, dirs, files in os.walk(directory):
+        dirs.sort()
+        parents = [part for part in os.path.relpath(path, directory).split(os.sep) if part != '.']
+        for filename in sorted(files):
+            name, extension = os.path.splitext(filename)
+            if extension.lower() not in MARKDOWN_EXTENSIONS or filename.startswith('.'):
+                continue
+            item = markdown_item(force_unicode(open(os.path.join(path, filename)).read()))
+            name = DATE_PREFIX.sub('', name)
+            item['slug'] = item.get('slug') or '-'.join(parents + [name])
+            item.setdefault('title', name.replace('-', ' ').replace('_', ' '))
+            yield item
+
+
+def batches(items, size=BATCH_SIZE):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class Importer(object):
+    """
+    Writes items to the database a batch at a time, as ``author``'s entries.
+    Call ``finish()`` once every batch has been written.
+    """
+
+    def __init__(self, author, processes=None):
+        self.author = author
+        # The pool must be started before writing, as it closes the connection
+        self.renderer = Renderer(processes)
+        self.categories = {}
+        self.imported = 0
+        self.skipped = 0
+
+    def close(self):
+        self.renderer.close()
+
+    def category_ids(self, pairs):
+        """
+        Returns a dictionary mapping category slugs to primary keys for
+        ``(slug, name)`` pairs, creating the categories that don't exist
+        """
+        from models import Category
+        pairs = dict((slug[:50], name[:150]) for slug, name in pairs if slug)
+        wanted = [slug for slug in pairs if slug not in self.categories]
+        if wanted:
+            self.categories.update(Category.objects.filter(slug__in=wanted).values_list('slug', 'pk'))
+            now = datetime.now()
+            insert_rows(Category, ('name', 'slug', 'description', 'updated', 'version', 'entry_count'), [
+                (pairs[slug], slug, '', now, 1, 0) for slug in wanted if slug not in self.categories
+            ])
+            self.categories.update(Category.objects.filter(slug__in=wanted).values_list('slug', 'pk'))
+        return self.categories
+
+    def unique_slugs(self, batch):
+        """
+        Gives every item in a batch a slug, dropping the items whose own slug
+        is already taken. Only items with neither a slug nor a key to make one
+        from get a slug from their title, made unique.
+        """
+        from models import Entry
+        for item in batch:
+            item['given'] = bool(item.get('slug'))
+            item['slug'] = slugify(item.get('slug') or item.get('title') or 'entry')[:70] or 'entry'
+        taken = set(Entry.objects.filter(slug__in=[item['slug'] for item in batch]).values_list('slug', flat=True))
+        items = []
+        for item in batch:
+            if item['given'] and item['slug'] in taken:
+                self.skipped += 1
+                continue
+            slug, n = item['slug'], 1
+            while slug in taken or (n > 1 and Entry.objects.filter(slug=slug).exists()):
+                n += 1
+                suffix = '-%d' % n
+                slug = item['slug'][:70 - len(suffix)] + suffix
+            item['slug'] = slug
+            taken.add(slug)
+            items.append(item)
+        return items
+
+    def write(self, batch):
+        """
+        Insert a batch of items, link them to their categories and render
+        them. Returns the number of entries created.
+        """
+        from django.db import transaction
+        from models import Entry
+        import search
+
+        @transaction.commit_on_success
+        def write():
+            items = self.unique_slugs(batch)
+            if not items:
+                return []
+            now = datetime.now()
+            rows = []
+            for item in items:
+                publish_date = item.get('publish_date') or now
+                status = item.get('status', Entry.DRAFT)
+                if status in (Entry.PUBLISHED, Entry.SCHEDULED):
+                    status = publish_date > now and Entry.SCHEDULED or Entry.PUBLISHED
+                rows.append((
+                    (item.get('title') or item['slug'])[:250], item['slug'], item.get('excerpt', ''),
+                    item.get('body', ''), self.author.pk, publish_date, True, status, False,
+                    item.get('markup', Entry.MARKDOWN), now, 1,
+                    (item.get('meta_keywords') or '')[:250], (item.get('meta_description') or '')[:250],
+                    '', '', '', '', '',
+                ))
+            insert_rows(Entry, (
+                'title', 'slug', 'excerpt', 'body', 'author', 'publish_date', 'enable_comments',
+                'status', 'featured', 'markup', 'updated', 'version', 'meta_keywords',
+                'meta_description', 'page_title', 'generic_meta_tags', 'body_html',
+                'excerpt_html', 'lead_in_html',
+            ), rows)
+            pks = dict(Entry.objects.filter(slug__in=[item['slug'] for item in items]).values_list('slug', 'pk'))
+
+            categories = self.category_ids([pair for item in items for pair in item['categories']])
+            links = set()
+            for item in items:
+                for slug, name in item['categories']:
+                    if slug[:50] in categories:
+                        links.add((pks[item['slug']], categories[slug[:50]]))
+            insert_rows(Entry.categories.through, ('entry', 'category'), sorted(links))
+
+            entries = list(Entry.objects.filter(pk__in=pks.values()).only(
+                'id', 'markup', 'body', 'excerpt', 'slug', 'status', 'title'
+            ))
+            results = self.renderer.render([render_job(entry) for entry in entries])
+            rendered = dict((result[0], result[1:]) for result in results)
+            update_rows(Entry, HTML_FIELDS, [rendered[pk] + (pk,) for pk in sorted(rendered)])
+            for entry in entries:
+                entry.body_html, entry.excerpt_html, entry.lead_in_html = rendered[entry.pk]
+            search.index_entries(entries)
+            return entries
+
+        entries = write()
+        self.imported += len(entries)
+        return len(entries)
+
+    def finish(self):
+        """
+        Bring the data kept alongside entries up to date with the imported
+        entries, and throw away cached pages and feeds
+        """
+        from models import ArchiveCount, Category
+        ArchiveCount.objects.rebuild()
+        Category.objects.rebuild_counts()
+        invalidate_all()
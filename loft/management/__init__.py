@@ -0,0 +1,10 @@
+from django.db.models.signals import post_syncdb
+from loft import models as loft_models
+from loft import search
+
+def install_search(sender, **kwargs):
+    """
+    Create the search index's table if it isn't a model, such as the FTS5 table
+    """
+    search.get_backend().install()
+post_syncdb.connect(install_search, sender=loft_models)
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+from loft.models import ArchiveCount
+
+class Command(BaseCommand):
+    help = ("Rebuild the per-month counts of published entries used by the archive "
+            "tree, e.g. after loading entries without going through the ORM.")
+
+    def handle(self, **options):
+        months = ArchiveCount.objects.rebuild()
+        if int(options['verbosity']) > 0:
+            self.stdout.write("Counted entries in %d month%s\n" % (months, months != 1 and 's' or ''))
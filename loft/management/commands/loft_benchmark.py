@@ -0,0 +1,83 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.simple import DjangoTestSuiteRunner
+from django.utils import simplejson
+from optparse import make_option
+from loft.benchmarks import corpus, suite
+import os
+import subprocess
+import time
+
+class Command(BaseCommand):
+    help = ("Time loft's views, feeds, sitemap, template tags and rendering against a "
+            "generated blog in a test database, and write the results as JSON.")
+    option_list = BaseCommand.option_list + (
+        make_option('--entries', type='int', dest='entries', default=1000,
+            help='Number of entries to generate. Default 1000.'),
+        make_option('--seed', type='int', dest='seed', default=0,
+            help='Seed for generating entries, so runs can be compared. Default 0.'),
+        make_option('--iterations', type='int', dest='iterations', default=10,
+            help='Number of times to run each benchmark. Default 10.'),
+        make_option('--benchmark', action='append', dest='benchmarks', default=None,
+            help='Only run the named benchmark. May be given more than once.'),
+        make_option('--output', dest='output', default=None,
+            help='File to write the results to. Defaults to standard output.'),
+        make_option('--processes', type='int', dest='processes', default=None,
+            help='Number of processes rendering the generated entries. Defaults to the number of CPUs.'),
+    )
+
+    def commit(self):
+        """
+        The git commit of the code being benchmarked, if it's in a repository
+        """
+        try:
+            process = subprocess.Popen(['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE, cwd=os.path.dirname(os.path.abspath(__file__)))
+            output = process.communicate()[0].strip()
+        except OSError:
+            return None
+        return process.returncode == 0 and output or None
+
+    def handle(self, **options):
+        if options['entries'] < 1:
+            raise CommandError("--entries must be at least 1")
+        verbosity = int(options['verbosity'])
+        runner = DjangoTestSuiteRunner(verbosity=0, interactive=False)
+        old_config = runner.setup_databases()
+        try:
+            processes = options['processes']
+            if connection.vendor == 'sqlite' and connection.settings_dict['NAME'] in ('', ':memory:'):
+                # Worker processes would close the only connection to the database
+                processes = 1
+            author = User.objects.create_user('benchmark', 'benchmark@example.com')
+            if verbosity > 0:
+                self.stderr.write("Generating %d entries\n" % options['entries'])
+            start = time.time()
+            blog = corpus.populate(author, options['entries'], options['seed'], processes)
+            generated = time.time() - start
+            if verbosity > 0:
+                self.stderr.write("Generated in %.1fs, running benchmarks\n" % generated)
+            try:
+                results = suite.run(options['iterations'], options['benchmarks'])
+            except ValueError, e:
+                raise CommandError(str(e))
+        finally:
+            runner.teardown_databases(old_config)
+
+        report = {
+            'commit': self.commit(),
+            'environment': suite.environment(),
+            'corpus': {
+                'entries': options['entries'],
+                'categories': len(blog.categories),
+                'seed': options['seed'],
+                'seconds': generated,
+            },
+            'benchmarks': results,
+        }
+        output = simplejson.dumps(report, indent=2, sort_keys=True)
+        if options['output']:
+            open(options['output'], 'w').write(output + '\n')
+        else:
+            self.stdout.write(output + '\n')
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+from loft.models import Category
+
+class Command(BaseCommand):
+    help = ("Recount the published entries in each category, e.g. after loading "
+            "entries without going through the ORM.")
+
+    def handle(self, **options):
+        Category.objects.rebuild_counts()
+        if int(options['verbosity']) > 0:
+            self.stdout.write("Recounted entries in %d categories\n" % Category.objects.count())
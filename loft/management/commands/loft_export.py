@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+from loft.bulk import Renderer
+from loft.export import Manifest, export_page, public_paths, remove_page
+import os
+import time
+
+class Command(BaseCommand):
+    args = '<output directory>'
+    help = ("Export the blog's public pages as static files, with gzipped copies. "
+        "After the first export only the pages of changed entries are rendered.")
+    option_list = BaseCommand.option_list + (
+        make_option('--full', action='store_true', dest='full', default=False,
+            help='Render every page, not just those of changed entries.'),
+        make_option('--processes', type='int', dest='processes', default=None,
+            help='Number of rendering processes. Defaults to the number of CPUs.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Usage: loft_export %s" % self.args)
+        output = os.path.abspath(args[0])
+        start = time.time()
+
+        previous = not options['full'] and Manifest.load(output) or None
+        current = Manifest.current(public_paths())
+        paths = previous and previous.changed_paths(current)
+        if paths is None:
+            paths = current.paths
+        else:
+            # Pages that haven't been exported yet, e.g. after a failed run
+            paths = (paths | (current.paths - previous.paths)) & current.paths
+        stale = previous and previous.paths - current.paths or set()
+
+        renderer = Renderer(options['processes'], export_page)
+        try:
+            results = renderer.render([(output, path) for path in sorted(paths)])
+        finally:
+            renderer.close()
+        failed = [(path, status) for path, status in results if status != 200]
+        for path, status in failed:
+            self.stderr.write("%s returned %d, not exported\n" % (path, status))
+            current.paths.discard(path)
+        for path in stale:
+            remove_page(output, path)
+        current.save(output)
+
+        elapsed = time.time() - start
+        self.stdout.write("Exported %d pages and removed %d in %.1fs\n" % (
+            len(results) - len(failed), len(stale), elapsed
+        ))
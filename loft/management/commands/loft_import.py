@@ -0,0 +1,59 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+from loft.importer import BATCH_SIZE, Importer, batches, markdown_items, wxr_items
+import os
+import time
+
+class Command(BaseCommand):
+    args = '<WordPress export file or Markdown directory>'
+    help = ("Import entries from a WordPress export (WXR) file, or from a directory of "
+            "Markdown files with front matter.")
+    option_list = BaseCommand.option_list + (
+        make_option('--author', dest='author', default=None,
+            help='Username of the imported entries\' author. Defaults to the first superuser.'),
+        make_option('--batch-size', type='int', dest='batch_size', default=BATCH_SIZE,
+            help='Number of entries written in each transaction. Default %d.' % BATCH_SIZE),
+        make_option('--processes', type='int', dest='processes', default=None,
+            help='Number of rendering processes. Defaults to the number of CPUs.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Usage: loft_import %s" % self.args)
+        path = args[0]
+        if os.path.isdir(path):
+            items = markdown_items(path)
+        elif os.path.isfile(path):
+            items = wxr_items(path)
+        else:
+            raise CommandError("%s doesn't exist" % path)
+
+        try:
+            if options['author']:
+                author = User.objects.get(username=options['author'])
+            else:
+                author = User.objects.filter(is_superuser=True).order_by('pk')[0]
+        except (User.DoesNotExist, IndexError):
+            raise CommandError("No such author; use --author to choose one")
+
+        importer = Importer(author, options['processes'])
+        start = time.time()
+        try:
+            for batch in batches(items, options['batch_size']):
+                importer.write(batch)
+                if int(options['verbosity']) > 1:
+                    self.stdout.write("Imported %d entries\n" % importer.imported)
+        finally:
+            importer.close()
+            # Batches written before a failure are committed, so they still
+            # need counting and the caches clearing
+            if importer.imported:
+                importer.finish()
+
+        elapsed = time.time() - start
+        self.stdout.write("Imported %d entries and skipped %d in %.1fs (%.1f entries/s)\n" % (
+            importer.imported, importer.skipped, elapsed, elapsed and importer.imported / elapsed or 0
+        ))
+        if importer.imported:
+            self.stdout.write("Run ./manage.py loft_related to relate the new entries\n")
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from optparse import make_option
+from loft.notifications import NOTIFICATION_DIGEST, send_due
+import time
+
+class Command(BaseCommand):
+    help = ("Email the notifications waiting in the outbox to the site's managers. "
+            "Run it from cron, or with --loop as a long-running worker.")
+    option_list = BaseCommand.option_list + (
+        make_option('--loop', action='store_true', dest='loop', default=False,
+            help='Keep running, sending notifications as they are queued.'),
+        make_option('--interval', type='int', dest='interval', default=60,
+            help='With --loop, seconds to sleep between sends. Notifications queued '
+                 'in the meantime are combined into digests. Default 60.'),
+        make_option('--digest', type='int', dest='digest', default=NOTIFICATION_DIGEST,
+            help='Most notifications to combine into one email. Default %d.' % NOTIFICATION_DIGEST),
+    )
+
+    def handle(self, **options):
+        verbosity = int(options['verbosity'])
+        while True:
+            sent, failed = send_due(digest=options['digest'])
+            if verbosity > 0 and (sent or failed):
+                self.stdout.write("Sent %d notifications, %d failed and will be retried\n" % (sent, failed))
+            if sent and not failed:
+                # A full batch was sent, so more may be waiting
+                continue
+            if not options['loop']:
+                break
+            # Don't hold a transaction or connection open while sleeping
+            transaction.commit_unless_managed()
+            connection.close()
+            time.sleep(options['interval'])
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from optparse import make_option
+from loft.models import Entry
+from datetime import datetime
+import time
+
+class Command(BaseCommand):
+    help = ("Publish scheduled entries that have come due. Run it from cron, or "
+            "with --loop as a long-running worker that wakes when the next entry is due.")
+    option_list = BaseCommand.option_list + (
+        make_option('--loop', action='store_true', dest='loop', default=False,
+            help='Keep running, publishing entries as they come due.'),
+        make_option('--interval', type='int', dest='interval', default=60,
+            help='With --loop, the longest time in seconds to sleep between checks '
+                 'for newly scheduled entries. Default 60.'),
+    )
+
+    def handle(self, **options):
+        verbosity = int(options['verbosity'])
+        while True:
+            count = Entry.objects.publish_scheduled()
+            if count and verbosity > 0:
+                self.stdout.write("Published %d scheduled entr%s\n" % (count, count == 1 and 'y' or 'ies'))
+            if not options['loop']:
+                break
+
+            # Sleep until the next entry is due, but wake up regularly to pick
+            # up entries scheduled in the meantime
+            delay = options['interval']
+            next_date = Entry.objects.next_publish_date()
+            if next_date is not None:
+                due = next_date - datetime.now()
+                delay = min(delay, max(0, due.days * 86400 + due.seconds + 1))
+            # Don't hold a transaction or connection open while sleeping
+            transaction.commit_unless_managed()
+            connection.close()
+            time.sleep(delay)
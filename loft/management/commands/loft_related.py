@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+from loft.models import RelatedEntry, StaleEntry
+from loft.related import RELATED_COUNT, update_related
+import time
+
+class Command(BaseCommand):
+    help = ("Compute the related entries of entries that have changed since the last run, "
+            "or of every entry with --full. Run it from cron.")
+    option_list = BaseCommand.option_list + (
+        make_option('--full', action='store_true', dest='full', default=False,
+            help='Recompute the related entries of every entry.'),
+        make_option('--count', type='int', dest='count', default=RELATED_COUNT,
+            help='Number of related entries to store for each entry. Default %d.' % RELATED_COUNT),
+    )
+
+    def handle(self, **options):
+        start = time.time()
+        stale = list(StaleEntry.objects.values_list('entry_id', flat=True))
+        full = options['full'] or not RelatedEntry.objects.exists()
+        if not full and not stale:
+            return
+        try:
+            count = update_related(not full and stale or None, options['count'])
+        except ImportError, e:
+            raise CommandError(str(e))
+        # Entries changed while this ran stay queued for the next run
+        StaleEntry.objects.filter(entry_id__in=stale).delete()
+        if int(options['verbosity']) > 0:
+            self.stdout.write("Updated the related entries of %d entr%s in %.1fs\n" % (
+                count, count == 1 and 'y' or 'ies', time.time() - start
+            ))
@@ -0,0 +1,60 @@
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+from loft.models import Entry
+from loft.bulk import RENDER_FIELDS, Renderer, invalidate_all, iter_batches, render_job, update_rendered
+from datetime import datetime
+import time
+
+MARKUPS = {
+    'markdown': Entry.MARKDOWN,
+    'textile': Entry.TEXTILE,
+}
+
+class Command(BaseCommand):
+    help = "Re-render the stored HTML of every entry, e.g. after upgrading Markdown or Pygments."
+    option_list = BaseCommand.option_list + (
+        make_option('--since', dest='since', default=None,
+            help='Only re-render entries published on or after this date (YYYY-MM-DD).'),
+        make_option('--markup', dest='markup', choices=MARKUPS.keys(), default=None,
+            help='Only re-render entries using this markup (markdown or textile).'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+            help='Render entries without writing the results.'),
+        make_option('--batch-size', type='int', dest='batch_size', default=500,
+            help='Number of entries loaded, rendered and written at a time. Default 500.'),
+        make_option('--processes', type='int', dest='processes', default=None,
+            help='Number of rendering processes. Defaults to the number of CPUs.'),
+    )
+
+    def handle(self, **options):
+        queryset = Entry.objects.only(*RENDER_FIELDS)
+        if options['since']:
+            try:
+                since = datetime.strptime(options['since'], '%Y-%m-%d')
+            except ValueError:
+                raise CommandError("--since must be a date in the form YYYY-MM-DD")
+            queryset = queryset.filter(publish_date__gte=since)
+        if options['markup']:
+            queryset = queryset.filter(markup=MARKUPS[options['markup']])
+
+        renderer = Renderer(options['processes'])
+        count = 0
+        start = time.time()
+        try:
+            for batch in iter_batches(queryset, options['batch_size']):
+                results = renderer.render([render_job(entry) for entry in batch])
+                if not options['dry_run']:
+                    update_rendered(Entry, results)
+                count += len(results)
+                if int(options['verbosity']) > 1:
+                    self.stdout.write("Rendered %d entries\n" % count)
+        finally:
+            renderer.close()
+        if count and not options['dry_run']:
+            # Cached pages, feeds and entry data hold the old HTML
+            invalidate_all()
+
+        elapsed = time.time() - start
+        self.stdout.write("%s %d entries in %.1fs (%.1f entries/s)\n" % (
+            options['dry_run'] and "Rendered (dry run)" or "Re-rendered",
+            count, elapsed, elapsed and count / elapsed or 0
+        ))
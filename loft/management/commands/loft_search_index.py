@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from optparse import make_option
+from loft import search
+import time
+
+class Command(BaseCommand):
+    help = "Rebuild the search index from every entry, e.g. after upgrading or changing LOFT_SEARCH_BACKEND."
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=500,
+            help='Number of entries loaded and indexed at a time. Default 500.'),
+    )
+
+    @transaction.commit_on_success
+    def handle(self, **options):
+        start = time.time()
+        count = search.rebuild(options['batch_size'])
+        self.stdout.write("Indexed %d entries in %.1fs\n" % (count, time.time() - start))
@@ -0,0 +1,50 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from optparse import make_option
+from loft.spam import SPAM_CHECK_THREADS, SpamChecker
+from akismet import AkismetError
+import time
+
+class Command(BaseCommand):
+    help = ("Check comments held for spam checking with Akismet, and make public those "
+            "it passes. Run it from cron, or with --loop as a long-running worker.")
+    option_list = BaseCommand.option_list + (
+        make_option('--loop', action='store_true', dest='loop', default=False,
+            help='Keep running, checking comments as they are posted.'),
+        make_option('--interval', type='int', dest='interval', default=10,
+            help='With --loop, seconds to sleep when no comments are waiting. Default 10.'),
+        make_option('--threads', type='int', dest='threads', default=SPAM_CHECK_THREADS,
+            help='Number of comments checked at once. Default %d.' % SPAM_CHECK_THREADS),
+    )
+
+    def handle(self, **options):
+        if not getattr(settings, 'AKISMET_API_KEY', None):
+            raise CommandError("Set AKISMET_API_KEY to check comments for spam")
+        verbosity = int(options['verbosity'])
+        checker = SpamChecker(threads=options['threads'])
+        try:
+            while True:
+                ham = spam = failed = 0
+                try:
+                    if not checker.client.verify_key():
+                        raise CommandError("Akismet rejected AKISMET_API_KEY")
+                    ham, spam, failed = checker.check()
+                except AkismetError, e:
+                    if not options['loop']:
+                        raise CommandError("Couldn't reach Akismet: %s" % e)
+                if verbosity > 0 and (ham or spam or failed):
+                    self.stdout.write("Passed %d comments, held %d as spam and couldn't check %d\n" % (
+                        ham, spam, failed
+                    ))
+                if ham or spam:
+                    # More comments may be waiting
+                    continue
+                if not options['loop']:
+                    break
+                # Don't hold a transaction or connection open while sleeping
+                transaction.commit_unless_managed()
+                connection.close()
+                time.sleep(options['interval'])
+        finally:
+            checker.close()
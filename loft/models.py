@@ -1,5 +1,6 @@
-from django.db import models
-from django.db.models import Q
+from django.db import models, transaction, IntegrityError
+from django.db.models import Q, Min, F, Count
+from django.db.models.signals import post_init, post_save, pre_delete, post_delete, m2m_changed
 from django.contrib.auth.models import User
 from django.contrib.comments.models import Comment
 from django.contrib.comments.signals import comment_was_posted, comment_will_be_posted
@@ -10,26 +11,153 @@ from django.utils.translation import ugettext_lazy as _, ugettext
 from django.core.urlresolvers import reverse
 from django.template.defaultfilters import slugify
 from django import http
-from markdown import markdown
-from signals import comment_notifier, comment_spam_check
+from signals import comment_notifier, comment_spam_check, queue_spam_check, entries_changed
+from cache import cache, cache_key, bump_generation, CACHE_TIMEOUT
+from collections import namedtuple
 from datetime import datetime
-import textile
+import pagecache
+import rendering
+import search
+
+# The fields of an entry that decide which public pages it appears on
+EntryState = namedtuple('EntryState', 'status publish_date slug')
+
+def entry_states(queryset):
+    """
+    Returns a dictionary mapping the primary keys of a queryset's entries to
+    their EntryStates
+    """
+    return dict(
+        (row[0], EntryState(*row[1:]))
+        for row in queryset.values_list('pk', *EntryState._fields)
+    )
 
 
 class BlogManager(models.Manager):
 
     def published(self):
-        return self.filter(
-            Q(publish_date__lte=datetime.now()) | Q(publish_date__isnull=True),
-            status=self.model.PUBLISHED
+        """
+        Live entries. Entries with a future publish date are held back as
+        scheduled until publish_scheduled() publishes them, so this is a plain
+        filter on status.
+        """
+        return self.filter(status=self.model.PUBLISHED)
+
+    def scheduled(self):
+        return self.filter(status=self.model.SCHEDULED)
+
+    def next_publish_date(self):
+        """
+        Returns the publish date of the next scheduled entry, or None
+        """
+        return self.scheduled().aggregate(Min('publish_date'))['publish_date__min']
+
+    def publish_scheduled(self):
+        """
+        Publish scheduled entries that have come due, schedule any published
+        entries with a future publish date and date any published or scheduled
+        without one. Entries are saved one by one so that caches are invalidated.
+        Returns the number of entries published.
+        """
+        now = datetime.now()
+        for entry in self.published().filter(Q(publish_date__gt=now) | Q(publish_date__isnull=True)):
+            entry.save()
+        due = self.scheduled().filter(Q(publish_date__lte=now) | Q(publish_date__isnull=True))
+        count = 0
+        for entry in due:
+            entry.save()
+            count += 1
+        return count
+
+    def neighbours(self, entry):
+        """
+        Returns a (previous, next) tuple of the published entries either side
+        of ``entry`` by publish date, with the primary key breaking ties. Both
+        lookups run in one query as a UNION of two single-row selects.
+        """
+        if entry.publish_date is None:
+            return (None, None)
+        date, pk = entry.publish_date, entry.pk
+        qs = self.published()
+        earlier = qs.filter(
+            Q(publish_date__lt=date) | Q(publish_date=date, pk__lt=pk)
+        ).order_by('-publish_date', '-pk')[:1]
+        later = qs.filter(
+            Q(publish_date__gt=date) | Q(publish_date=date, pk__gt=pk)
+        ).order_by('publish_date', 'pk')[:1]
+
+        earlier_sql, earlier_params = earlier.query.get_compiler(using=self.db).as_sql()
+        later_sql, later_params = later.query.get_compiler(using=self.db).as_sql()
+        rows = self.raw(
+            'SELECT * FROM (%s) earlier UNION ALL SELECT * FROM (%s) later' % (earlier_sql, later_sql),
+            tuple(earlier_params) + tuple(later_params)
         )
 
+        previous_entry = next_entry = None
+        for row in rows:
+            if (row.publish_date, row.pk) < (date, pk):
+                previous_entry = row
+            else:
+                next_entry = row
+        return (previous_entry, next_entry)
+
+
+class CategoryManager(models.Manager):
+
+    def add_to_counts(self, pks, delta):
+        """
+        Add ``delta`` to the entry counts of the categories with primary keys
+        in ``pks``
+        """
+        pks = list(pks)
+        if not pks or not delta:
+            return
+        categories = self.filter(pk__in=pks)
+        if delta < 0:
+            categories = categories.filter(entry_count__gte=-delta)
+        categories.update(entry_count=F('entry_count') + delta)
+
+    @transaction.commit_on_success
+    def rebuild_counts(self):
+        """
+        Recount the published entries in every category
+        """
+        counts = Entry.categories.through.objects.filter(
+            entry__status=Entry.PUBLISHED
+        ).values('category').annotate(count=Count('entry'))
+        self.update(entry_count=0)
+        for row in counts:
+            self.filter(pk=row['category']).update(entry_count=row['count'])
+
+    def cloud(self, steps=5):
+        """
+        Returns the categories with published entries, by name, each with a
+        ``weight`` from 1 to ``steps`` in proportion to its entry count. The
+        list is cached until an entry or category changes.
+        """
+        key = cache_key('category_cloud', steps)
+        categories = cache.get(key)
+        if categories is None:
+            categories = list(self.filter(entry_count__gt=0).order_by('name'))
+            if categories:
+                counts = [category.entry_count for category in categories]
+                low, spread = min(counts), max(counts) - min(counts)
+                for category in categories:
+                    category.weight = spread and 1 + (category.entry_count - low) * (steps - 1) // spread or 1
+            cache.set(key, categories, CACHE_TIMEOUT)
+        return categories
+
 
 class Category(models.Model):
 
     name        = models.CharField(_('name'), max_length=150, db_index=True, help_text=_('Maximum 150 characters'))
     slug        = models.SlugField(_('slug'), unique=True, help_text=_('Auto-generated, must be unique'))
     description = models.CharField(_('description'), max_length=250, blank=True, help_text=_('Maximum 250 characters'))
+    updated     = models.DateTimeField(auto_now=True, editable=False, db_index=True)
+    version     = models.PositiveIntegerField(default=0, editable=False)
+    entry_count = models.PositiveIntegerField(_('published entries'), default=0, editable=False)
+
+    objects = CategoryManager()
     
     class Meta:
         verbose_name = _('category')
@@ -42,17 +170,19 @@ class Category(models.Model):
     def save(self, **kwargs):
         if not self.slug:
             self.slug = slugify(self.name)
+        self.version += 1
         super(Category, self).save(**kwargs)
 
 
 class Entry(models.Model):
 
-    PUBLISHED, DRAFT = range(1,3)
+    PUBLISHED, DRAFT, SCHEDULED = range(1,4)
     STATUS_CHOICES = (
         (PUBLISHED, _('Published')),
-        (DRAFT, _('Draft'))
+        (DRAFT, _('Draft')),
+        (SCHEDULED, _('Scheduled')),
     )
-    MARKDOWN, TEXTILE = range(1,3)
+    MARKDOWN, TEXTILE = rendering.MARKDOWN, rendering.TEXTILE
     MARKUP_CHOICES = (
         (MARKDOWN, _('Markdown')),
         (TEXTILE, _('Textile')),
@@ -66,8 +196,9 @@ class Entry(models.Model):
     title        = models.CharField(_('title'), max_length=250, db_index=True)
     excerpt      = models.TextField(_('excerpt'), blank=True)
     excerpt_html = models.TextField(editable=False, blank=True)
-    body         = models.TextField(_('body'), db_index=True)
+    body         = models.TextField(_('body'))
     body_html    = models.TextField(editable=False, blank=True)
+    lead_in_html = models.TextField(editable=False, blank=True)
 
     # Meta
     author          = models.ForeignKey(User, verbose_name=_('user'))
@@ -77,6 +208,8 @@ class Entry(models.Model):
     featured        = models.BooleanField(_('featured'), default=False)
     markup          = models.IntegerField(_('markup'), choices=MARKUP_CHOICES, default=MARKDOWN, help_text=MARKUP_HELP)
     categories      = models.ManyToManyField('loft.Category', blank=True, related_name="entry_categories", verbose_name=Category._meta.verbose_name_plural)
+    updated         = models.DateTimeField(auto_now=True, editable=False, db_index=True)
+    version         = models.PositiveIntegerField(default=0, editable=False)
 
     # SEO
     slug              = models.SlugField(_('URL Slug'), unique=True, max_length=70)
@@ -87,6 +220,7 @@ class Entry(models.Model):
     
     objects = BlogManager()
 
+    # Composite indexes that Django can't declare are created from sql/entry.sql
     class Meta:
         verbose_name_plural = _('entries')
         ordering = ['-publish_date']
@@ -105,19 +239,38 @@ class Entry(models.Model):
                 self.slug = self.create_slug(self.title)
             if not self.publish_date:
                 self.publish_date = datetime.now()
+
+        # Entries published or scheduled without a date are published now,
+        # and those with a future date wait until they're due
+        if self.status in (self.PUBLISHED, self.SCHEDULED):
+            if not self.publish_date:
+                self.publish_date = datetime.now()
+            if self.publish_date > datetime.now():
+                self.status = self.SCHEDULED
+            else:
+                self.status = self.PUBLISHED
+
+        self.version += 1
+        for attr in ('_neighbours', '_categories'):
+            self.__dict__.pop(attr, None)
+
+        # A new draft's permalink needs its id, so its lead-in can only be
+        # created once it has been saved
+        new_draft = not self.id and not self.is_published()
+        if not new_draft:
+            self.lead_in_html = self.create_lead_in()
         super(Entry, self).save(**kwargs)
+        if new_draft:
+            self.lead_in_html = self.create_lead_in()
+            Entry.objects.filter(pk=self.pk).update(lead_in_html=self.lead_in_html)
 
     def create_markup(self, content):
         """
         Create textile OR markdown versions of the excerpt and body fields.
-        Syntax highlight any code found if using Markdown.
+        Syntax highlight any code found if using Markdown. Renderings are
+        cached by content, so unchanged fields are not rendered again.
         """
-        if self.markup == Entry.MARKDOWN:
-            return markdown(content, ['codehilite'])
-        elif self.markup == Entry.TEXTILE:
-            return textile.textile(content)
-        else:
-            return content
+        return rendering.render(content, self.markup)
 
     def create_slug(self, title):
         return slugify(title)
@@ -130,42 +283,79 @@ class Entry(models.Model):
         if title is None: title = ugettext("Permalink to this post")
         return mark_safe('<a href="%s" rel="bookmark permalink" title="%s">%s</a>' % (self.get_absolute_url(), title, text))
 
-    def lead_in(self):
+    def lead_in_source(self):
         """
-        Returns a truncated version of the excerpt or main content with an
-        appended 'read more...' link
+        Returns the unrendered lead-in: a truncated version of the excerpt or
+        main content with an appended 'read more...' link
         """
         if self.excerpt:
             html = self.excerpt
         else:
             html = truncate_html_words(self.body, 50, end_text='')
         permalink = self.permalink(text=ugettext("read more&hellip;"), title=ugettext("Read full article"))
-        content = "%s %s" % (html, permalink)
+        return u"%s %s" % (html, permalink)
 
-        if self.markup == Entry.MARKDOWN:
-            return mark_safe(markdown(self.excerpt, ['codehilite']))
-        elif self.markup == Entry.TEXTILE:
-            return mark_safe(textile.textile(content))
+    def create_lead_in(self):
+        return self.create_markup(self.lead_in_source())
+
+    def lead_in(self):
+        """
+        Returns the lead-in HTML created when the entry was saved. Entries
+        saved before lead-ins were stored have theirs created on demand.
+        """
+        if not self.lead_in_html:
+            self.lead_in_html = self.create_lead_in()
+        return mark_safe(self.lead_in_html)
+
+    def get_state(self):
+        return EntryState(self.status, self.publish_date, self.slug)
+
+    def get_categories(self):
+        """
+        Returns the entry's categories as a list, loaded once per instance
+        """
+        if not hasattr(self, '_categories'):
+            self._categories = list(self.categories.all())
+        return self._categories
+
+    def get_neighbours(self):
+        """
+        Returns a (previous, next) tuple of the published entries either side
+        of this one. Both are found with a single query, and the result is
+        cached until an entry next changes.
+        """
+        if not hasattr(self, '_neighbours'):
+            key = cache_key('neighbours', self.pk)
+            neighbours = cache.get(key)
+            if neighbours is None:
+                neighbours = Entry.objects.neighbours(self)
+                cache.set(key, neighbours, CACHE_TIMEOUT)
+            self._neighbours = neighbours
+        return self._neighbours
+
+    def get_related_entries(self, limit=None):
+        """
+        Returns the published entries most related to this one, most related
+        first, as computed by loft.related. Only the fields needed to list
+        and link to them are loaded, with one query.
+        """
+        entries = Entry.objects.published().filter(related_to__entry=self).order_by('related_to__position')
+        entries = entries.only('id', 'title', 'slug', 'status', 'publish_date', 'featured')
+        if limit is not None:
+            entries = entries[:limit]
+        return entries
 
     def get_previous_entry(self):
         """
         Utility method to return the previous published entry
         """
-        qs = Entry.objects.published().exclude(pk=self.pk)
-        try:
-            return qs.filter(publish_date__lte=self.publish_date).order_by('publish_date')[0]
-        except IndexError, e:
-            return None
+        return self.get_neighbours()[0]
 
     def get_next_entry(self):
         """
         Utility method to return the next published entry
         """
-        qs = Entry.objects.published().exclude(pk=self.pk)
-        try:
-            return qs.filter(publish_date__gte=self.publish_date).order_by('-publish_date')[0]
-        except IndexError, e:
-            return None
+        return self.get_neighbours()[1]
 
     def is_draft(self):
         return self.status == self.DRAFT
@@ -173,6 +363,9 @@ class Entry(models.Model):
     def is_published(self):
         return self.status == self.PUBLISHED
 
+    def is_scheduled(self):
+        return self.status == self.SCHEDULED
+
     def get_absolute_url(self, user=None):
         """
         Return a url based on the publication status of the object. Access
@@ -186,6 +379,231 @@ class Entry(models.Model):
             kwargs = {'object_id': self.id}
         return reverse(name, kwargs=kwargs)
     
+class SearchTerm(models.Model):
+    """
+    A word in an entry, for the portable search index in loft.search. The
+    entry is referenced by its primary key alone so that deleting an entry
+    doesn't load its terms.
+    """
+
+    term     = models.CharField(max_length=50)
+    entry_id = models.PositiveIntegerField(db_index=True)
+    weight   = models.PositiveIntegerField()
+
+    class Meta:
+        unique_together = ('term', 'entry_id')
+
+    def __unicode__(self):
+        return self.term
+
+
+class RelatedEntry(models.Model):
+    """
+    One of the entries most related to an entry, stored by loft.related
+    """
+
+    entry    = models.ForeignKey(Entry, related_name='related_entries')
+    related  = models.ForeignKey(Entry, related_name='related_to')
+    position = models.PositiveSmallIntegerField()
+    score    = models.FloatField()
+
+    class Meta:
+        unique_together = ('entry', 'position')
+        ordering = ['entry', 'position']
+
+    def __unicode__(self):
+        return u'%s: %s' % (self.entry_id, self.related_id)
+
+
+class StaleEntry(models.Model):
+    """
+    An entry that has changed since its related entries were last computed
+    """
+
+    entry_id = models.PositiveIntegerField(unique=True)
+
+    @classmethod
+    def add(cls, pks):
+        pks = set(pks)
+        pks -= set(cls.objects.filter(entry_id__in=pks).values_list('entry_id', flat=True))
+        for pk in pks:
+            sid = transaction.savepoint()
+            try:
+                cls.objects.create(entry_id=pk)
+                transaction.savepoint_commit(sid)
+            except IntegrityError:
+                # Queued by someone else in the meantime
+                transaction.savepoint_rollback(sid)
+
+
+class Revision(models.Model):
+    """
+    A count of the changes to what the blog shows, and the time of the latest,
+    kept in a single row that is bumped whenever an entry, category or comment
+    changes. loft.conditional builds its validators from it.
+    """
+
+    number  = models.PositiveIntegerField(default=0)
+    updated = models.DateTimeField(default=datetime.now)
+
+    @classmethod
+    def current(cls):
+        """
+        Returns the number and time of the latest change
+        """
+        rows = list(cls.objects.filter(pk=1).values_list('number', 'updated'))
+        return rows and rows[0] or (0, None)
+
+    @classmethod
+    def bump(cls):
+        now = datetime.now()
+        if cls.objects.filter(pk=1).update(number=F('number') + 1, updated=now):
+            return
+        sid = transaction.savepoint()
+        try:
+            cls.objects.create(pk=1, number=1, updated=now)
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            # Created by someone else in the meantime
+            transaction.savepoint_rollback(sid)
+            cls.objects.filter(pk=1).update(number=F('number') + 1, updated=now)
+
+
+class SpamCheck(models.Model):
+    """
+    A comment held back from the site until Akismet has checked it, with the
+    details of the request that posted it
+    """
+
+    comment      = models.OneToOneField(Comment, related_name='spam_check')
+    user_agent   = models.TextField(blank=True)
+    referrer     = models.TextField(blank=True)
+    attempts     = models.PositiveSmallIntegerField(default=0)
+    queued       = models.DateTimeField(default=datetime.now)
+    next_attempt = models.DateTimeField(default=datetime.now, db_index=True)
+
+    def __unicode__(self):
+        return unicode(self.comment_id)
+
+    def retry(self):
+        """
+        Put off checking the comment again, for longer after each failure
+        """
+        from notifications import retry_delay
+        self.attempts += 1
+        self.next_attempt = datetime.now() + retry_delay(self.attempts)
+        SpamCheck.objects.filter(pk=self.pk).update(attempts=self.attempts, next_attempt=self.next_attempt)
+
+    def release(self):
+        """
+        Make the comment public, as Akismet has passed it, and tell managers
+        """
+        comment = self.comment
+        comment.is_public = True
+        comment.save()
+        self.delete()
+        comment_notifier(sender=Comment, comment=comment)
+
+
+class Notification(models.Model):
+    """
+    An email to the site's managers waiting to be sent by loft.notifications
+    """
+
+    subject      = models.CharField(max_length=255)
+    body         = models.TextField()
+    created      = models.DateTimeField(default=datetime.now)
+    attempts     = models.PositiveSmallIntegerField(default=0)
+    next_attempt = models.DateTimeField(default=datetime.now, db_index=True)
+
+    def __unicode__(self):
+        return self.subject
+
+
+ArchiveYear = namedtuple('ArchiveYear', 'year count months')
+ArchiveMonth = namedtuple('ArchiveMonth', 'date count')
+
+class ArchiveCountManager(models.Manager):
+
+    def apply(self, changes):
+        """
+        Update the counts for the entries_changed ``changes``: an entry stops
+        counting towards the month it was published in and starts counting
+        towards the month it's published in now.
+        """
+        deltas = {}
+        for previous, current in changes.values():
+            for state, delta in ((previous, -1), (current, 1)):
+                if state is not None and state.status == Entry.PUBLISHED and state.publish_date:
+                    month = (state.publish_date.year, state.publish_date.month)
+                    deltas[month] = deltas.get(month, 0) + delta
+        for (year, month), delta in deltas.items():
+            if delta:
+                self.add(year, month, delta)
+
+    def add(self, year, month, delta):
+        if self.filter(year=year, month=month).update(count=F('count') + delta):
+            if delta < 0:
+                self.filter(year=year, month=month, count__lte=0).delete()
+        elif delta > 0:
+            sid = transaction.savepoint()
+            try:
+                self.create(year=year, month=month, count=delta)
+                transaction.savepoint_commit(sid)
+            except IntegrityError:
+                # Created by someone else in the meantime
+                transaction.savepoint_rollback(sid)
+                self.filter(year=year, month=month).update(count=F('count') + delta)
+
+    @transaction.commit_on_success
+    def rebuild(self):
+        """
+        Recount every month from the published entries. Entries without a
+        publish date aren't in any month, as in apply(). Returns the number of
+        months with entries.
+        """
+        counts = {}
+        dated = Entry.objects.published().filter(publish_date__isnull=False)
+        for date in dated.values_list('publish_date', flat=True).iterator():
+            counts[(date.year, date.month)] = counts.get((date.year, date.month), 0) + 1
+        self.all().delete()
+        for (year, month), count in counts.items():
+            self.create(year=year, month=month, count=count)
+        return len(counts)
+
+    def tree(self):
+        """
+        Returns the archive as a list of ArchiveYears, newest first, each with
+        a list of ArchiveMonths
+        """
+        years = []
+        for row in self.order_by('-year', '-month'):
+            if not years or years[-1].year != row.year:
+                years.append(ArchiveYear(row.year, 0, []))
+            years[-1].months.append(ArchiveMonth(datetime(row.year, row.month, 1), row.count))
+            years[-1] = years[-1]._replace(count=years[-1].count + row.count)
+        return years
+
+
+class ArchiveCount(models.Model):
+    """
+    The number of entries published in each month, kept up to date from the
+    entries_changed signal so archive listings needn't aggregate entries.
+    Rebuild it with ``./manage.py loft_archive_counts``.
+    """
+
+    year    = models.PositiveSmallIntegerField()
+    month   = models.PositiveSmallIntegerField()
+    count   = models.PositiveIntegerField(default=0)
+
+    objects = ArchiveCountManager()
+
+    class Meta:
+        unique_together = ('year', 'month')
+
+    def __unicode__(self):
+        return u'%d-%02d: %d' % (self.year, self.month, self.count)
+
 # If we're using static-generator, blow away the cached files on save.
 if 'staticgenerator.middleware.StaticGeneratorMiddleware' in settings.MIDDLEWARE_CLASSES:
     from django.dispatch import dispatcher
@@ -195,6 +613,153 @@ if 'staticgenerator.middleware.StaticGeneratorMiddleware' in settings.MIDDLEWARE
         quick_delete(instance, '/')
     post_save.connect(delete, sender=Entry)
 
+# Remember the state each entry was loaded in, and send entries_changed with
+# the old and new states whenever an entry is saved or deleted. Bulk updates
+# send entries_changed themselves.
+def remember_state(sender, instance, **kwargs):
+    # Read from __dict__ so that deferred fields aren't loaded
+    instance._loft_original = EntryState(*[instance.__dict__.get(f) for f in EntryState._fields])
+post_init.connect(remember_state, sender=Entry)
+
+def entry_saved(sender, instance, created, **kwargs):
+    previous = not created and instance._loft_original or None
+    instance._loft_original = instance.get_state()
+    entries_changed.send(sender=Entry, changes={instance.pk: (previous, instance._loft_original)})
+post_save.connect(entry_saved, sender=Entry)
+
+def entry_deleted(sender, instance, **kwargs):
+    entries_changed.send(sender=Entry, changes={instance.pk: (instance._loft_original, None)})
+post_delete.connect(entry_deleted, sender=Entry)
+
+# Throw away cached entry data whenever an entry changes
+def invalidate_cache(sender, **kwargs):
+    bump_generation()
+entries_changed.connect(invalidate_cache, sender=Entry)
+post_save.connect(invalidate_cache, sender=Category)
+post_delete.connect(invalidate_cache, sender=Category)
+m2m_changed.connect(invalidate_cache, sender=Entry.categories.through)
+
+# Change the conditional GET validators whenever what the blog shows changes
+def bump_revision(sender, **kwargs):
+    if kwargs.get('action', 'post_').startswith('post_'):
+        Revision.bump()
+entries_changed.connect(bump_revision, sender=Entry)
+post_save.connect(bump_revision, sender=Category)
+post_delete.connect(bump_revision, sender=Category)
+m2m_changed.connect(bump_revision, sender=Entry.categories.through)
+post_save.connect(bump_revision, sender=Comment)
+post_delete.connect(bump_revision, sender=Comment)
+
+# Purge cached pages that show changed entries and categories
+entries_changed.connect(pagecache.purge_entries, sender=Entry)
+m2m_changed.connect(pagecache.purge_entry_categories, sender=Entry.categories.through)
+post_save.connect(pagecache.purge_category, sender=Category)
+post_delete.connect(pagecache.purge_category, sender=Category)
+
+# Keep the archive counts up to date
+def update_archive_counts(sender, changes, **kwargs):
+    ArchiveCount.objects.apply(changes)
+entries_changed.connect(update_archive_counts, sender=Entry)
+
+# Keep the categories' counts of published entries up to date. Deleted
+# entries are counted out before their categories are cleared.
+def count_published_entries(sender, changes, **kwargs):
+    through = Entry.categories.through.objects
+    for pk, (previous, current) in changes.items():
+        was = previous is not None and previous.status == Entry.PUBLISHED
+        now = current is not None and current.status == Entry.PUBLISHED
+        if current is not None and was != now:
+            Category.objects.add_to_counts(
+                through.filter(entry=pk).values_list('category', flat=True),
+                now and 1 or -1
+            )
+entries_changed.connect(count_published_entries, sender=Entry)
+
+def count_deleted_entry(sender, instance, **kwargs):
+    if instance.status == Entry.PUBLISHED:
+        Category.objects.add_to_counts(
+            instance.categories.values_list('pk', flat=True), -1
+        )
+pre_delete.connect(count_deleted_entry, sender=Entry)
+
+def count_categorised_entries(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_remove':
+        # remove() sends every primary key it was given, linked or not, so
+        # note the links that are really there to count out afterwards
+        through = Entry.categories.through.objects
+        if not reverse:
+            linked = through.filter(entry=instance, category__in=pk_set).values_list('category', flat=True)
+        else:
+            linked = through.filter(category=instance, entry__in=pk_set).values_list('entry', flat=True)
+        instance._loft_removed_links = set(linked)
+        return
+    if action == 'post_remove':
+        pk_set = instance.__dict__.pop('_loft_removed_links', set())
+    delta = {'post_add': 1, 'post_remove': -1, 'pre_clear': -1}.get(action)
+    if delta is None:
+        return
+    if not reverse:
+        # Categories added to or removed from an entry
+        if instance.status == Entry.PUBLISHED:
+            if action == 'pre_clear':
+                pk_set = instance.categories.values_list('pk', flat=True)
+            Category.objects.add_to_counts(pk_set, delta)
+    else:
+        # Entries added to or removed from a category
+        entries = Entry.objects.published()
+        if action == 'pre_clear':
+            entries = entries.filter(categories=instance)
+        else:
+            entries = entries.filter(pk__in=pk_set)
+        Category.objects.add_to_counts([instance.pk], delta * entries.count())
+m2m_changed.connect(count_categorised_entries, sender=Entry.categories.through)
+
+# Keep the search index up to date
+def index_entry(sender, instance, **kwargs):
+    search.index_entries([instance])
+post_save.connect(index_entry, sender=Entry)
+
+def unindex_entry(sender, instance, **kwargs):
+    search.remove_entries([instance.pk])
+post_delete.connect(unindex_entry, sender=Entry)
+
+# Queue changed entries for loft.related, and take unpublished and deleted
+# entries out of other entries' related lists straight away
+def queue_related(sender, changes, **kwargs):
+    StaleEntry.add(changes.keys())
+    gone = [pk for pk, (previous, current) in changes.items()
+            if current is None or current.status != Entry.PUBLISHED]
+    if gone:
+        links = RelatedEntry.objects.filter(related__in=gone)
+        StaleEntry.add(links.values_list('entry', flat=True))
+        links.delete()
+entries_changed.connect(queue_related, sender=Entry)
+
+def queue_related_deleted(sender, instance, **kwargs):
+    # Deleting the entry deletes the links to it before entries_changed
+    StaleEntry.add(instance.related_to.values_list('entry', flat=True))
+pre_delete.connect(queue_related_deleted, sender=Entry)
+
+def queue_related_categories(sender, instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith('post_') and action != 'pre_clear':
+        return
+    if not reverse:
+        StaleEntry.add([instance.pk])
+    elif action == 'pre_clear':
+        StaleEntry.add(instance.entry_categories.values_list('pk', flat=True))
+    elif pk_set:
+        StaleEntry.add(pk_set)
+m2m_changed.connect(queue_related_categories, sender=Entry.categories.through)
+
+# Rebuild the cached feeds when an entry in them changes
+def refresh_feeds(sender, changes, **kwargs):
+    from feeds import refresh_feeds
+    refresh_feeds(sender, changes)
+entries_changed.connect(refresh_feeds, sender=Entry)
+
 # Comment signals
 comment_will_be_posted.connect(comment_spam_check, sender=Comment)
-comment_was_posted.connect(comment_notifier, sender=Comment)
\ No newline at end of file
+comment_was_posted.connect(queue_spam_check, sender=Comment)
+comment_was_posted.connect(comment_notifier, sender=Comment)
+post_save.connect(pagecache.purge_comment, sender=Comment)
+post_delete.connect(pagecache.purge_comment, sender=Comment)
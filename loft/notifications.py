@@ -0,0 +1,113 @@
+"""
+Email notifications to the site's managers, sent from an outbox.
+
+Notifications, such as those for new comments, are saved as Notification rows
+rather than emailed while the visitor waits. ``./manage.py loft_notify``
+sends the ones that are due over a single SMTP connection. Run it from cron,
+or as a worker with ``--loop``.
+
+``LOFT_NOTIFICATION_DIGEST`` sets how many notifications may be combined into
+one email (default ``1``, an email each). A notification that can't be sent
+is retried after ``RETRY_DELAY`` seconds, doubling with each failure up to
+``MAX_RETRY_DELAY``, and is kept in the outbox unsent after ``MAX_ATTEMPTS``
+tries.
+"""
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.contrib.sites.models import Site
+from datetime import datetime, timedelta
+import smtplib
+import socket
+
+NOTIFICATION_DIGEST = getattr(settings, 'LOFT_NOTIFICATION_DIGEST', 1)
+
+MAX_ATTEMPTS = 10
+
+RETRY_DELAY = 60
+
+MAX_RETRY_DELAY = 60 * 60 * 6
+
+BATCH_SIZE = 500
+
+
+def notify_managers(subject, body):
+    """
+    Queue an email to the site's managers
+    """
+    from models import Notification
+    if settings.MANAGERS:
+        Notification.objects.create(subject=subject, body=body)
+
+
+def retry_delay(attempts):
+    return timedelta(seconds=min(RETRY_DELAY * 2 ** (attempts - 1), MAX_RETRY_DELAY))
+
+
+def digests(notifications, size):
+    """
+    Split notifications into groups of up to ``size``, one for each email
+    """
+    return [notifications[i:i + size] for i in range(0, len(notifications), size)]
+
+
+def message(group, connection):
+    """
+    Returns the email for a group of notifications
+    """
+    if len(group) == 1:
+        subject, body = group[0].subject, group[0].body
+    else:
+        subject = "%d notifications from %s" % (len(group), Site.objects.get_current().domain)
+        body = ('\n\n%s\n\n' % ('-' * 70)).join(
+            ['%s\n\n%s' % (notification.subject, notification.body) for notification in group]
+        )
+    return EmailMessage(
+        u'%s%s' % (settings.EMAIL_SUBJECT_PREFIX, subject), body,
+        settings.SERVER_EMAIL, [address for name, address in settings.MANAGERS],
+        connection=connection
+    )
+
+
+def send_due(connection=None, digest=NOTIFICATION_DIGEST):
+    """
+    Send the notifications that are due over one connection. Returns the
+    numbers of notifications sent and that failed.
+    """
+    from models import Notification
+    now = datetime.now()
+    due = list(Notification.objects.filter(
+        next_attempt__lte=now, attempts__lt=MAX_ATTEMPTS
+    ).order_by('next_attempt', 'pk')[:BATCH_SIZE])
+    if not due:
+        return 0, 0
+    if not settings.MANAGERS:
+        Notification.objects.filter(pk__in=[n.pk for n in due]).delete()
+        return 0, 0
+
+    connection = connection or get_connection(fail_silently=False)
+    sent = []
+    failed = []
+    try:
+        connection.open()
+        for group in digests(due, max(1, digest)):
+            try:
+                connection.send_messages([message(group, connection)])
+            except (smtplib.SMTPException, socket.error):
+                # The server is likely down, so don't try the rest now
+                failed = due[len(sent):]
+                break
+            sent.extend(group)
+    except (smtplib.SMTPException, socket.error):
+        failed = due[len(sent):]
+    finally:
+        try:
+            connection.close()
+        except (smtplib.SMTPException, socket.error):
+            pass
+
+    Notification.objects.filter(pk__in=[n.pk for n in sent]).delete()
+    for notification in failed:
+        notification.attempts += 1
+        notification.next_attempt = now + retry_delay(notification.attempts)
+        notification.save()
+    return len(sent), len(failed)
@@ -0,0 +1,195 @@
+"""
+A response cache for loft's public pages that is purged by dependency.
+
+Each cached page is stored under its path plus a per-path version number.
+Purging a path bumps its version, which invalidates every variant of it at
+once: paginated index pages, AJAX and NDJSON responses and so on.
+
+When an entry changes, only the pages that show it are purged: its detail
+page, the index, search results, its year and month archives, the feeds, the
+sitemap and the detail pages of the entries either side of it, which link to
+it. An entry that has been re-dated, renamed or unpublished has the pages for
+its old position purged too. Anything else stays cached.
+
+Enable it with ``LOFT_PAGE_CACHE = True``. Pages are cached in the
+``LOFT_CACHE_BACKEND`` cache for ``LOFT_PAGE_CACHE_TIMEOUT`` seconds (default
+one day), or until the next scheduled entry is published if that's sooner.
+Requests from visitors with a session, responses that set cookies and pages
+holding a CSRF token, such as entry pages with a comment form, are never
+cached, since the token belongs to one visitor. Posting, moderating or
+deleting a comment purges its entry's page.
+"""
+from django.conf import settings
+from django.core.urlresolvers import reverse, NoReverseMatch
+from django.utils.hashcompat import md5_constructor
+from cache import cache, cache_timeout
+import time
+
+PAGE_CACHE_TIMEOUT = getattr(settings, 'LOFT_PAGE_CACHE_TIMEOUT', 60 * 60 * 24)
+
+ALL_PAGES_KEY = 'loft:pages:version'
+
+
+def _version(key):
+    version = cache.get(key)
+    if version is None:
+        # Start from the clock so purged keys are never reused
+        version = int(time.time() * 1000)
+        if not cache.add(key, version, PAGE_CACHE_TIMEOUT * 2):
+            version = cache.get(key, version)
+    return version
+
+
+def _bump(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        _version(key)
+
+
+def _path_key(path):
+    return 'loft:page:%s:version' % md5_constructor(path).hexdigest()
+
+
+def page_key(request):
+    variant = md5_constructor('|'.join([
+        request.META.get('QUERY_STRING', ''),
+        str(request.is_ajax()),
+        request.META.get('HTTP_ACCEPT', ''),
+    ])).hexdigest()
+    return 'loft:page:%s:%s:%s:%s' % (
+        md5_constructor(request.path).hexdigest(),
+        _version(ALL_PAGES_KEY),
+        _version(_path_key(request.path)),
+        variant,
+    )
+
+
+def purge_paths(paths):
+    for path in set(paths):
+        _bump(_path_key(path))
+
+
+def purge_all():
+    _bump(ALL_PAGES_KEY)
+
+
+def cache_page(view):
+    """
+    Decorator caching a view's successful responses until the pages that
+    depend on them are purged.
+    """
+    def wrapper(request, *args, **kwargs):
+        if (not getattr(settings, 'LOFT_PAGE_CACHE', False)
+                or request.method not in ('GET', 'HEAD')
+                or settings.SESSION_COOKIE_NAME in request.COOKIES):
+            return view(request, *args, **kwargs)
+        key = page_key(request)
+        response = cache.get(key)
+        if response is None:
+            response = view(request, *args, **kwargs)
+            # Streamed responses can't be stored, and nor can pages with a
+            # CSRF token, whose cookie is only set after this returns
+            if (response.status_code == 200 and not response.cookies and response._is_string
+                    and not request.META.get('CSRF_COOKIE_USED')):
+                cache.set(key, response, cache_timeout(PAGE_CACHE_TIMEOUT))
+        return response
+    wrapper.__name__ = getattr(view, '__name__', view.__class__.__name__)
+    wrapper.__module__ = view.__module__
+    wrapper.__doc__ = view.__doc__
+    return wrapper
+
+
+def sitemap_paths(pk=None):
+    """
+    Returns the paths of the sitemap index and, given an entry's primary key,
+    the sitemap section it's listed in. Includes the path of
+    ``loft.sitemaps.sitemap`` if a project routes it.
+    """
+    from sitemaps import sitemap, section_number
+    paths = [reverse('blog_sitemap')]
+    if pk is not None:
+        paths.append(reverse('blog_sitemap_section', kwargs={'section': section_number(pk)}))
+    try:
+        paths.append(reverse(sitemap))
+    except NoReverseMatch:
+        pass
+    return paths
+
+
+def entry_paths(pk, state):
+    """
+    Returns the paths of the public pages that show the entry with primary
+    key ``pk`` when it's in ``state``.
+    """
+    from models import Entry
+    if state is None or state.status != Entry.PUBLISHED:
+        return []
+    date = state.publish_date
+    paths = [
+        reverse('blog_entry_detail', kwargs={'slug': state.slug}),
+        reverse('blog_index'),
+        reverse('blog_search'),
+        reverse('blog_rss_feed'),
+        reverse('blog_atom_feed'),
+    ] + sitemap_paths(pk)
+    if date is not None:
+        paths += [
+            reverse('blog_entry_archive_year', kwargs={'year': date.year}),
+            reverse('blog_entry_archive_month', kwargs={
+                'year': date.year, 'month': date.strftime('%b').lower()
+            }),
+        ]
+        for neighbour in Entry.objects.neighbours(Entry(pk=pk, publish_date=date)):
+            if neighbour is not None:
+                paths.append(neighbour.get_absolute_url())
+    return [path for path in paths if path]
+
+
+def purge_entries(sender, changes, **kwargs):
+    """
+    Purge the pages showing changed entries, both where they were and where
+    they are now. Connected to the entries_changed signal.
+    """
+    paths = []
+    for pk, (previous, current) in changes.items():
+        paths += entry_paths(pk, previous)
+        if current != previous:
+            paths += entry_paths(pk, current)
+    purge_paths(paths)
+
+
+def purge_entry_categories(sender, instance, action, reverse, **kwargs):
+    """
+    Purge the pages of an entry whose categories have changed. Changes made
+    from the category side may affect any number of entries, so they purge
+    everything. Connected to m2m_changed for Entry.categories.
+    """
+    if not action.startswith('post_'):
+        return
+    if reverse:
+        purge_all()
+    else:
+        purge_paths(entry_paths(instance.pk, instance.get_state()))
+
+
+def purge_category(sender, **kwargs):
+    """
+    Category names and descriptions may be shown on any page, so a changed
+    category purges everything.
+    """
+    purge_all()
+
+
+def purge_comment(sender, instance, **kwargs):
+    """
+    Purge the page of an entry whose comments have changed. Connected to
+    post_save and post_delete for comments, which cover comments being
+    posted, approved, removed and deleted.
+    """
+    from django.contrib.contenttypes.models import ContentType
+    from models import Entry
+    if instance.content_type_id != ContentType.objects.get_for_model(Entry).pk:
+        return
+    for entry in Entry.objects.filter(pk=instance.object_pk).only('id', 'slug', 'status'):
+        purge_paths([entry.get_absolute_url()])
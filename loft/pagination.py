@@ -0,0 +1,169 @@
+"""
+Keyset (cursor) pagination over entries.
+
+Pages are found by seeking past the (publish_date, id) of the last entry on the
+previous page rather than with OFFSET, so a deep page costs the same as the
+first one and pages don't shift when entries are published. Cursors are
+opaque, URL-safe strings.
+"""
+from django.conf import settings
+from django.db.models import Q
+from datetime import datetime
+import base64
+
+PER_PAGE = getattr(settings, 'LOFT_PAGE_SIZE', 10)
+
+CURSOR_DATE_FORMAT = '%Y%m%d%H%M%S%f'
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+def encode_cursor(publish_date, pk):
+    value = '%s.%d' % (publish_date.strftime(CURSOR_DATE_FORMAT), pk)
+    return base64.urlsafe_b64encode(value).rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        value = base64.urlsafe_b64decode(str(cursor) + '=' * (-len(cursor) % 4))
+        date, pk = value.split('.')
+        return datetime.strptime(date, CURSOR_DATE_FORMAT), int(pk)
+    except (TypeError, ValueError, UnicodeError):
+        raise InvalidCursor(cursor)
+
+
+class Page(object):
+    """
+    One page of a queryset, newest first. ``after`` and ``before`` are cursors
+    from a neighbouring page's ``next_cursor`` or ``previous_cursor``.
+
+    The page is only fetched when it's first used. It can be iterated, and
+    ``values()`` returns the same page as dictionaries for JSON responses.
+    """
+
+    def __init__(self, queryset, per_page=PER_PAGE, after=None, before=None):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.after = after
+        self.before = before
+        self.position = None
+        if after:
+            self.position = decode_cursor(after)
+        elif before:
+            self.position = decode_cursor(before)
+        self._rows = None
+
+    def values(self, *fields):
+        for field in ('id', 'publish_date'):
+            if fields and field not in fields:
+                fields += (field,)
+        return ValuesPage(self.queryset.values(*fields), self.per_page, self.after, self.before)
+
+    def _fetch(self):
+        if self._rows is not None:
+            return
+        qs = self.queryset
+        if self.position is not None:
+            date, pk = self.position
+            if self.before:
+                qs = qs.filter(Q(publish_date__gt=date) | Q(publish_date=date, pk__gt=pk))
+            else:
+                qs = qs.filter(Q(publish_date__lt=date) | Q(publish_date=date, pk__lt=pk))
+        if self.before:
+            qs = qs.order_by('publish_date', 'pk')
+        else:
+            qs = qs.order_by('-publish_date', '-pk')
+        rows = list(qs[:self.per_page + 1])
+        more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if self.before:
+            rows.reverse()
+            self._has_previous, self._has_next = more, True
+        else:
+            self._has_previous, self._has_next = self.after is not None, more
+        self._rows = rows
+
+    def _cursor(self, row):
+        if isinstance(row, dict):
+            return encode_cursor(row['publish_date'], row['id'])
+        return encode_cursor(row.publish_date, row.pk)
+
+    @property
+    def object_list(self):
+        self._fetch()
+        return self._rows
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def __repr__(self):
+        return repr(self.object_list)
+
+    def has_next(self):
+        self._fetch()
+        return self._has_next and bool(self._rows)
+
+    def has_previous(self):
+        self._fetch()
+        return self._has_previous and bool(self._rows)
+
+    def next_cursor(self):
+        if self.has_next():
+            return self._cursor(self._rows[-1])
+
+    def previous_cursor(self):
+        if self.has_previous():
+            return self._cursor(self._rows[0])
+
+    def next_url(self):
+        """ The query string for the next (older) page """
+        cursor = self.next_cursor()
+        return cursor and '?after=%s' % cursor
+
+    def previous_url(self):
+        """ The query string for the previous (newer) page """
+        cursor = self.previous_cursor()
+        return cursor and '?before=%s' % cursor
+
+    def links(self):
+        return PageLinks(self)
+
+
+class ValuesPage(Page):
+    """
+    A page of dictionaries from ``Page.values()``, which can be returned as
+    JSON by ``add_ajax``
+    """
+
+    def as_json(self):
+        return self.object_list
+
+    def iter_rows(self, chunk_size):
+        rows = self.object_list
+        for i in range(0, len(rows), chunk_size):
+            yield rows[i:i + chunk_size]
+
+
+class PageLinks(object):
+    """
+    The cursors and links of a page, for JSON responses
+    """
+
+    def __init__(self, page):
+        self.page = page
+
+    def as_json(self):
+        return {
+            'next_cursor': self.page.next_cursor(),
+            'previous_cursor': self.page.previous_cursor(),
+            'next_url': self.page.next_url(),
+            'previous_url': self.page.previous_url(),
+        }
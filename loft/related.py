@@ -0,0 +1,201 @@
+"""
+Related entries, precomputed.
+
+Each published entry is described by a TF-IDF vector of the words in its
+title, meta keywords and body, and by the categories it's in. Two entries are
+related in proportion to the cosine similarity of their words and, with
+weight ``LOFT_RELATED_CATEGORY_WEIGHT`` (default 0.3), of their categories.
+The ``LOFT_RELATED_ENTRIES`` (default 5) most related entries of each entry
+are stored in the RelatedEntry table, so showing them costs one indexed
+query.
+
+Computing them needs NumPy. ``./manage.py loft_related`` updates the entries
+that have changed since it last ran, which are queued as StaleEntry rows, and
+any entries whose lists they now belong in. Run it from cron. Entries that are
+unpublished or deleted drop out of other entries' lists straight away.
+
+The word vectors are kept to the ``LOFT_RELATED_FEATURES`` (default 2000)
+words found in the most entries, so memory use is about ``entries x features
+x 4`` bytes.
+"""
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils.html import strip_tags
+from search import tokenize
+import math
+
+RELATED_COUNT = getattr(settings, 'LOFT_RELATED_ENTRIES', 5)
+CATEGORY_WEIGHT = getattr(settings, 'LOFT_RELATED_CATEGORY_WEIGHT', 0.3)
+MAX_FEATURES = getattr(settings, 'LOFT_RELATED_FEATURES', 2000)
+
+BLOCK_SIZE = 500
+
+
+def entry_words(title, meta_keywords, body_html):
+    """
+    Returns the words describing an entry. Words in the title and keywords
+    count twice.
+    """
+    return tokenize(title) * 2 + tokenize(meta_keywords) * 2 + tokenize(strip_tags(body_html))
+
+
+def vectorize(numpy):
+    """
+    Returns the primary keys of the published entries, a matrix of their
+    normalized TF-IDF word vectors and a matrix of their normalized category
+    vectors, one row per entry
+    """
+    from models import Entry
+    from bulk import iter_batches
+    pks, documents, frequency = [], [], {}
+    entries = Entry.objects.published().only('id', 'title', 'meta_keywords', 'body_html')
+    for batch in iter_batches(entries):
+        for entry in batch:
+            counts = {}
+            for word in entry_words(entry.title, entry.meta_keywords, entry.body_html):
+                counts[word] = counts.get(word, 0) + 1
+            for word in counts:
+                frequency[word] = frequency.get(word, 0) + 1
+            pks.append(entry.pk)
+            documents.append(counts)
+
+    # Words found in only one entry can't relate it to anything
+    vocabulary = sorted(
+        [word for word, df in frequency.items() if df > 1],
+        key=lambda word: (-frequency[word], word)
+    )[:MAX_FEATURES]
+    columns = dict((word, i) for i, word in enumerate(vocabulary))
+    words = numpy.zeros((len(pks), len(vocabulary)), dtype=numpy.float32)
+    for row, counts in enumerate(documents):
+        for word, count in counts.items():
+            column = columns.get(word)
+            if column is not None:
+                idf = math.log(float(len(pks)) / frequency[word]) + 1
+                words[row, column] = (1 + math.log(count)) * idf
+    del documents
+
+    rows = dict((pk, i) for i, pk in enumerate(pks))
+    through = Entry.categories.through.objects.filter(entry__status=Entry.PUBLISHED)
+    memberships = list(through.values_list('entry', 'category').iterator())
+    category_columns = dict((pk, i) for i, pk in enumerate(sorted(set([c for e, c in memberships]))))
+    categories = numpy.zeros((len(pks), len(category_columns)), dtype=numpy.float32)
+    for entry_id, category_id in memberships:
+        if entry_id in rows:
+            categories[rows[entry_id], category_columns[category_id]] = 1
+
+    for matrix in (words, categories):
+        norms = numpy.sqrt((matrix * matrix).sum(axis=1))
+        norms[norms == 0] = 1
+        matrix /= norms[:, numpy.newaxis]
+    return pks, words, categories
+
+
+def similarities(numpy, words, categories, rows):
+    """
+    Returns the similarity of the entries in ``rows`` to every entry, with
+    each entry's similarity to itself set to -1
+    """
+    scores = numpy.dot(words[rows], words.T) * (1 - CATEGORY_WEIGHT)
+    if categories.shape[1]:
+        scores += numpy.dot(categories[rows], categories.T) * CATEGORY_WEIGHT
+    scores[numpy.arange(len(rows)), rows] = -1
+    return scores
+
+
+def top(numpy, scores, count):
+    """
+    Returns the columns of the ``count`` highest scores in each row, highest
+    first, leaving out scores of zero or less
+    """
+    count = min(count, scores.shape[1] - 1)
+    if count <= 0:
+        return [[] for row in scores]
+    best = numpy.argpartition(-scores, count - 1, axis=1)[:, :count]
+    results = []
+    for row, columns in zip(scores, best):
+        columns = sorted(columns, key=lambda column: -row[column])
+        results.append([column for column in columns if row[column] > 0])
+    return results
+
+
+def replace_rows(entry_pks, related):
+    """
+    Replace the related entries stored for ``entry_pks`` with ``related``, a
+    list of (entry_id, related_id, position, score) rows
+    """
+    from models import RelatedEntry
+    table = connection.ops.quote_name(RelatedEntry._meta.db_table)
+    cursor = connection.cursor()
+    for i in range(0, len(entry_pks), BLOCK_SIZE):
+        block = entry_pks[i:i + BLOCK_SIZE]
+        cursor.execute('DELETE FROM %s WHERE entry_id IN (%s)' % (
+            table, ', '.join(['%s'] * len(block))
+        ), block)
+    if related:
+        cursor.executemany(
+            'INSERT INTO %s (entry_id, related_id, position, score) VALUES (%%s, %%s, %%s, %%s)' % table,
+            related
+        )
+
+
+@transaction.commit_on_success
+def update_related(pks=None, count=RELATED_COUNT):
+    """
+    Compute and store the related entries of the published entries with
+    primary keys in ``pks``, or of every published entry if ``pks`` is None.
+    Entries whose lists the updated entries now belong in, or whose lists
+    include them, are updated too. Returns the number of entries updated.
+    """
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError("Computing related entries requires NumPy")
+    from models import RelatedEntry
+
+    entry_pks, words, categories = vectorize(numpy)
+    index = dict((pk, i) for i, pk in enumerate(entry_pks))
+    if pks is None:
+        connection.cursor().execute('DELETE FROM %s' % connection.ops.quote_name(RelatedEntry._meta.db_table))
+        targets = range(len(entry_pks))
+        thresholds = None
+    else:
+        targets = sorted(set([index[pk] for pk in pks if pk in index]))
+        # The lowest stored score of each entry with a full list, and the
+        # entries listing one of the targets, whose scores for it may change
+        thresholds = numpy.zeros(len(entry_pks), dtype=numpy.float32)
+        stored = {}
+        listing = set()
+        target_pks = set([entry_pks[row] for row in targets])
+        for entry_id, related_id, score in RelatedEntry.objects.values_list('entry', 'related', 'score').iterator():
+            stored.setdefault(entry_id, []).append(score)
+            if related_id in target_pks and entry_id in index:
+                listing.add(index[entry_id])
+        for entry_id, scores in stored.items():
+            if entry_id in index and len(scores) >= count:
+                thresholds[index[entry_id]] = min(scores)
+
+    def update(rows):
+        """ Store the related entries of a block of rows and return their scores """
+        scores = similarities(numpy, words, categories, rows)
+        related = []
+        for i, columns in enumerate(top(numpy, scores, count)):
+            related.extend([
+                (entry_pks[rows[i]], entry_pks[column], position, float(scores[i, column]))
+                for position, column in enumerate(columns)
+            ])
+        replace_rows([entry_pks[row] for row in rows], related)
+        return scores
+
+    others = set()
+    for i in range(0, len(targets), BLOCK_SIZE):
+        rows = targets[i:i + BLOCK_SIZE]
+        scores = update(rows)
+        if thresholds is not None:
+            # Entries whose weakest related entry a target now outscores
+            outscored = numpy.nonzero((scores > thresholds[numpy.newaxis, :]).any(axis=0))[0]
+            others.update(outscored.tolist())
+    if thresholds is not None:
+        others = sorted((others | listing) - set(targets))
+        for i in range(0, len(others), BLOCK_SIZE):
+            update(others[i:i + BLOCK_SIZE])
+    return len(targets) + len(others)
@@ -0,0 +1,277 @@
+"""
+Markup rendering for entries.
+
+Rendering Markdown (with Pygments syntax highlighting) or Textile is by far the
+most expensive part of saving an entry, so rendered HTML is cached by a digest
+of the source text, the markup type and the versions of the renderers. A saved
+entry whose content hasn't changed never reaches the renderer again.
+
+The cache has two tiers:
+
+* A bounded, in-process LRU of ``LOFT_RENDER_CACHE_SIZE`` items (default 500).
+* An optional shared tier on a Django cache backend, enabled by setting
+  ``LOFT_RENDER_CACHE_BACKEND`` to a cache alias or backend URI. Items are kept
+  for ``LOFT_RENDER_CACHE_TIMEOUT`` seconds (default 30 days); the key is
+  content-addressed so they never go stale.
+
+Hit and miss counts are available from ``render_cache.stats()``.
+
+Syntax highlighted code blocks are cached individually in the same way, by
+``highlight_cache``, so editing the prose of an entry doesn't run Pygments on
+its code again. ``LOFT_HIGHLIGHT_CACHE_BACKEND`` selects the shared tier for
+code blocks; it defaults to ``LOFT_RENDER_CACHE_BACKEND`` and then to the
+``default`` cache. Code blocks follow the conventions of Markdown's codehilite
+extension (a ``:::lang`` or ``#!lang`` first line names the language) but are
+highlighted by an extension of loft's own, built on Markdown's public
+extension API, which caches each ``pygments.highlight()`` call.
+"""
+from django.conf import settings
+from django.core.cache import get_cache
+from django.utils.encoding import smart_str
+from django.utils.datastructures import SortedDict
+from markdown import Extension, Markdown
+from markdown.treeprocessors import Treeprocessor
+from pygments.formatters import HtmlFormatter
+from pygments.lexers import get_lexer_by_name, guess_lexer, TextLexer
+import markdown as markdown_module
+import pygments
+import textile
+import hashlib
+import re
+import threading
+
+MARKDOWN, TEXTILE = range(1,3)
+
+
+def render_markdown(content):
+    return Markdown(extensions=[HighlightExtension()]).convert(content)
+
+def render_textile(content):
+    return textile.textile(content)
+
+RENDERERS = {
+    MARKDOWN: render_markdown,
+    TEXTILE: render_textile,
+}
+
+
+def renderer_version():
+    """
+    A string identifying everything that can change the rendered output for a
+    given source text. Upgrading Markdown, Pygments or Textile therefore
+    invalidates every cached rendering.
+    """
+    return '|'.join([
+        getattr(markdown_module, 'version', getattr(markdown_module, '__version__', '')),
+        'highlight',
+        pygments.__version__,
+        getattr(textile, '__version__', ''),
+    ])
+
+
+class LRUCache(object):
+    """
+    A minimal thread-safe least-recently-used mapping with a fixed capacity.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.data = SortedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        self.lock.acquire()
+        try:
+            if key not in self.data:
+                return default
+            # Move the key to the most-recently-used end
+            value = self.data.pop(key)
+            self.data[key] = value
+            return value
+        finally:
+            self.lock.release()
+
+    def set(self, key, value):
+        if self.size <= 0:
+            return
+        self.lock.acquire()
+        try:
+            if key in self.data:
+                del self.data[key]
+            self.data[key] = value
+            while len(self.data) > self.size:
+                del self.data[self.data.keyOrder[0]]
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.data.clear()
+        finally:
+            self.lock.release()
+
+
+class RenderCache(object):
+    """
+    Content-addressed cache of rendered markup.
+    """
+
+    def __init__(self, prefix, size=500, backend=None, timeout=None):
+        self.prefix = prefix
+        self.local = LRUCache(size)
+        self.backend = backend and get_cache(backend) or None
+        self.timeout = timeout
+        self.version = renderer_version()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = self.misses = self.shared_hits = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'shared_hits': self.shared_hits,
+            'misses': self.misses,
+            'size': len(self.local),
+        }
+
+    def clear(self):
+        """
+        Empty the in-process tier. The shared tier is left alone, as its
+        backend may be shared with other data.
+        """
+        self.local.clear()
+        self.reset_stats()
+
+    def key(self, content, variant):
+        digest = hashlib.sha1(smart_str(content))
+        digest.update('|%s|%s' % (variant, self.version))
+        return '%s:%s' % (self.prefix, digest.hexdigest())
+
+    def render(self, content, markup):
+        renderer = RENDERERS.get(markup)
+        if renderer is None:
+            return content
+        return self.fetch(self.key(content, markup), renderer, content)
+
+    def fetch(self, key, renderer, *args):
+        """
+        Return the cached value for ``key``, calling ``renderer(*args)`` to
+        create and cache it on a miss.
+        """
+        html = self.local.get(key)
+        if html is not None:
+            self.hits += 1
+            return html
+
+        if self.backend is not None:
+            html = self.backend.get(key)
+            if html is not None:
+                self.hits += 1
+                self.shared_hits += 1
+                self.local.set(key, html)
+                return html
+
+        self.misses += 1
+        html = renderer(*args)
+        self.local.set(key, html)
+        if self.backend is not None:
+            self.backend.set(key, html, self.timeout)
+        return html
+
+
+render_cache = RenderCache('loft:render',
+    size=getattr(settings, 'LOFT_RENDER_CACHE_SIZE', 500),
+    backend=getattr(settings, 'LOFT_RENDER_CACHE_BACKEND', None),
+    timeout=getattr(settings, 'LOFT_RENDER_CACHE_TIMEOUT', 60 * 60 * 24 * 30),
+)
+
+highlight_cache = RenderCache('loft:highlight',
+    size=getattr(settings, 'LOFT_RENDER_CACHE_SIZE', 500),
+    backend=getattr(settings, 'LOFT_HIGHLIGHT_CACHE_BACKEND',
+        getattr(settings, 'LOFT_RENDER_CACHE_BACKEND', None) or 'default'),
+    timeout=getattr(settings, 'LOFT_RENDER_CACHE_TIMEOUT', 60 * 60 * 24 * 30),
+)
+
+
+CODE_HEADER = re.compile(r"""
+    (?:(?:::+)|(?P<shebang>[#]!))   # :::lang, or #!lang to number the lines
+    (?P<path>(?:/\w+)*[/ ])?        # the path of a real shebang, which is kept
+    (?P<lang>[\w+-]*)
+""", re.VERBOSE)
+
+
+def split_code(src):
+    """
+    Returns the source of a code block without any first line naming its
+    language, the language and whether to number its lines
+    """
+    lines = src.strip('\n').split('\n')
+    lang, linenos = None, False
+    match = CODE_HEADER.search(lines[0])
+    if match:
+        lang = match.group('lang').lower() or None
+        linenos = bool(match.group('shebang'))
+        if not match.group('path'):
+            lines.pop(0)
+    return '\n'.join(lines).strip('\n'), lang, linenos
+
+
+def highlight_code(src, lang, linenos, css_class):
+    lexer = None
+    if lang:
+        try:
+            lexer = get_lexer_by_name(lang)
+        except ValueError:
+            pass
+    if lexer is None:
+        try:
+            lexer = guess_lexer(src)
+        except ValueError:
+            lexer = TextLexer()
+    return pygments.highlight(src, lexer, HtmlFormatter(linenos=linenos, cssclass=css_class))
+
+
+def highlight(text, css_class='codehilite'):
+    """
+    Returns the highlighted HTML of a code block's text, from
+    ``highlight_cache`` if it has been highlighted before
+    """
+    src, lang, linenos = split_code(text)
+    key = highlight_cache.key(src, repr((lang, linenos, css_class)))
+    return highlight_cache.fetch(key, highlight_code, src, lang, linenos, css_class)
+
+
+class HighlightTreeprocessor(Treeprocessor):
+
+    def run(self, root):
+        """ Replace each code block with its highlighted HTML """
+        for block in root.getiterator('pre'):
+            children = block.getchildren()
+            if len(children) == 1 and children[0].tag == 'code':
+                placeholder = self.markdown.htmlStash.store(highlight(children[0].text or ''))
+                block.clear()
+                block.tag = 'p'
+                block.text = placeholder
+
+
+class HighlightExtension(Extension):
+    """
+    Syntax highlighting of code blocks with Pygments, each block's output
+    cached
+    """
+
+    def extendMarkdown(self, md, md_globals):
+        md.treeprocessors.add('hilite', HighlightTreeprocessor(md), '_begin')
+
+
+def render(content, markup):
+    """
+    Render ``content`` as Markdown or Textile according to ``markup``. Content
+    with an unknown markup type is returned unchanged.
+    """
+    return render_cache.render(content, markup)
@@ -0,0 +1,302 @@
+"""
+Full-text search over entries.
+
+Entries are indexed by title, excerpt and body as they're saved. A search
+finds the entries containing every word searched for, best matches first,
+with matches in titles counting most and matches in bodies least.
+
+Two kinds of index are available, chosen with ``LOFT_SEARCH_BACKEND``:
+
+* ``fts5`` keeps an SQLite FTS5 table, ``loft_entry_fts``, with stemming and
+  BM25 ranking. It's the default on SQLite builds that include FTS5.
+* ``tokens`` keeps an inverted index of words in the ``SearchTerm`` model and
+  works on any database. It's the default elsewhere.
+
+The FTS5 table is created by ``./manage.py syncdb``. After upgrading, or after
+switching backends, fill the index with ``./manage.py loft_search_index``.
+"""
+from django.conf import settings
+from django.db import connection
+from django.utils.html import strip_tags
+from HTMLParser import HTMLParser
+import re
+
+WORD = re.compile(r'\w+', re.UNICODE)
+
+MAX_WORD_LENGTH = 50
+
+# How much a match in each field counts towards an entry's score
+WEIGHTS = (('title', 3), ('excerpt', 2), ('body', 1))
+
+# Repeating a word in the body stops raising an entry's score after this many
+MAX_BODY_COUNT = 10
+
+STOP_WORDS = frozenset("""
+a an and are as at be but by for from has have in is it its of on or that the
+this to was were will with
+""".split())
+
+
+def tokenize(text):
+    """
+    Returns the lower-cased words of ``text`` that are worth indexing
+    """
+    return [
+        word[:MAX_WORD_LENGTH] for word in WORD.findall(text.lower())
+        if len(word) > 1 and word not in STOP_WORDS
+    ]
+
+
+def entry_text(entry):
+    """
+    Returns the title, excerpt and body of an entry as plain text
+    """
+    unescape = HTMLParser().unescape
+    return (
+        entry.title,
+        unescape(strip_tags(entry.excerpt_html)),
+        unescape(strip_tags(entry.body_html)),
+    )
+
+
+def in_list(values):
+    return ', '.join(['%s'] * len(values))
+
+
+class TokenIndex(object):
+    """
+    A portable inverted index: a row in the SearchTerm table for each word of
+    each entry, weighted by where and how often it appears
+    """
+
+    def table(self):
+        from models import SearchTerm
+        return connection.ops.quote_name(SearchTerm._meta.db_table)
+
+    def install(self):
+        pass
+
+    def index(self, entries):
+        rows = []
+        for entry in entries:
+            weights = {}
+            for (field, weight), text in zip(WEIGHTS, entry_text(entry)):
+                counts = {}
+                for word in tokenize(text):
+                    counts[word] = counts.get(word, 0) + 1
+                for word, count in counts.items():
+                    if field == 'body':
+                        count = min(count, MAX_BODY_COUNT)
+                    weights[word] = weights.get(word, 0) + weight * count
+            rows.extend([(word, entry.pk, weight) for word, weight in weights.items()])
+        connection.cursor().executemany(
+            'INSERT INTO %s (term, entry_id, weight) VALUES (%%s, %%s, %%s)' % self.table(),
+            rows
+        )
+
+    def remove(self, pks):
+        connection.cursor().execute(
+            'DELETE FROM %s WHERE entry_id IN (%s)' % (self.table(), in_list(pks)), pks
+        )
+
+    def clear(self):
+        connection.cursor().execute('DELETE FROM %s' % self.table())
+
+    def matches(self, query):
+        """
+        Returns SQL and parameters selecting the entry_id and score of each
+        entry matching a search
+        """
+        terms = sorted(set(tokenize(query)))
+        return (
+            'SELECT entry_id, SUM(weight) AS score FROM %s WHERE term IN (%s) '
+            'GROUP BY entry_id HAVING COUNT(*) = %%s' % (self.table(), in_list(terms)),
+            terms + [len(terms)]
+        )
+
+
+class FTS5Index(object):
+    """
+    An SQLite FTS5 table of entries' text, whose rowids are the entries'
+    primary keys. Words are stemmed, and matches ranked with BM25.
+    """
+
+    table = 'loft_entry_fts'
+
+    def install(self):
+        connection.cursor().execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(%s, tokenize='porter unicode61')" % (
+                self.table, ', '.join([field for field, weight in WEIGHTS])
+            )
+        )
+
+    def index(self, entries):
+        connection.cursor().executemany(
+            'INSERT INTO %s (rowid, %s) VALUES (%%s, %%s, %%s, %%s)' % (
+                self.table, ', '.join([field for field, weight in WEIGHTS])
+            ),
+            [(entry.pk,) + entry_text(entry) for entry in entries]
+        )
+
+    def remove(self, pks):
+        connection.cursor().execute(
+            'DELETE FROM %s WHERE rowid IN (%s)' % (self.table, in_list(pks)), pks
+        )
+
+    def clear(self):
+        connection.cursor().execute('DELETE FROM %s' % self.table)
+
+    def matches(self, query):
+        # Quote each word so that nothing in a search is read as FTS syntax
+        terms = sorted(set(tokenize(query)))
+        return (
+            'SELECT rowid AS entry_id, -bm25(%s, %s) AS score FROM %s WHERE %s MATCH %%s' % (
+                self.table, ', '.join(['%.1f' % weight for field, weight in WEIGHTS]),
+                self.table, self.table
+            ),
+            [' '.join(['"%s"' % term for term in terms])]
+        )
+
+
+BACKENDS = {
+    'tokens': TokenIndex,
+    'fts5': FTS5Index,
+}
+
+_backend = None
+
+def fts5_available():
+    """
+    Whether the database is SQLite with FTS5. Checked on a connection of its
+    own, since SQLite commits the open transaction before DDL.
+    """
+    if connection.vendor != 'sqlite':
+        return False
+    from django.db.backends.sqlite3.base import Database
+    test = Database.connect(':memory:')
+    try:
+        test.execute('CREATE VIRTUAL TABLE fts5_test USING fts5(content)')
+        return True
+    except Database.Error:
+        return False
+    finally:
+        test.close()
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        name = getattr(settings, 'LOFT_SEARCH_BACKEND', None)
+        if name is None:
+            name = fts5_available() and 'fts5' or 'tokens'
+        _backend = BACKENDS[name]()
+    return _backend
+
+
+def index_entries(entries):
+    """
+    Add ``entries`` to the search index, replacing what was indexed for them
+    """
+    entries = list(entries)
+    if entries:
+        remove_entries([entry.pk for entry in entries])
+        get_backend().index(entries)
+
+
+def remove_entries(pks):
+    pks = list(pks)
+    if pks:
+        get_backend().remove(pks)
+
+
+def rebuild(batch_size=500):
+    """
+    Clear the search index and index every entry. Returns the number of
+    entries indexed.
+    """
+    from models import Entry
+    from bulk import iter_batches
+    backend = get_backend()
+    backend.install()
+    backend.clear()
+    count = 0
+    entries = Entry.objects.only('id', 'title', 'excerpt_html', 'body_html')
+    for batch in iter_batches(entries, batch_size):
+        backend.index(batch)
+        count += len(batch)
+    return count
+
+
+def matching(queryset, query):
+    """
+    Returns ``queryset`` restricted to the entries matching a search, in the
+    queryset's own order
+    """
+    if not tokenize(query):
+        return queryset.none()
+    sql, params = get_backend().matches(query)
+    column = '%s.%s' % (
+        connection.ops.quote_name(queryset.model._meta.db_table),
+        connection.ops.quote_name(queryset.model._meta.pk.column),
+    )
+    return queryset.extra(
+        where=['%s IN (SELECT entry_id FROM (%s) matches)' % (column, sql)],
+        params=params
+    )
+
+
+class SearchResults(object):
+    """
+    The entries of ``queryset`` matching a search, best first. Results can
+    be counted and sliced, so they can be paginated with Django's Paginator.
+    Each entry returned has its ``score``.
+    """
+
+    def __init__(self, query, queryset):
+        self.query = query
+        self.queryset = queryset
+        self.empty = not tokenize(query)
+        self._count = None
+
+    def _sql(self, select, suffix=''):
+        sql, params = get_backend().matches(self.query)
+        pks = self.queryset.values('pk').order_by().query
+        pk_sql, pk_params = pks.get_compiler(using=self.queryset.db).as_sql()
+        return (
+            'SELECT %s FROM (%s) matches WHERE entry_id IN (%s)%s' % (select, sql, pk_sql, suffix),
+            params + list(pk_params)
+        )
+
+    def count(self):
+        if self._count is None:
+            self._count = 0
+            if not self.empty:
+                cursor = connection.cursor()
+                cursor.execute(*self._sql('COUNT(*)'))
+                self._count = cursor.fetchone()[0]
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self[index:index + 1][0]
+        start, stop = index.start or 0, index.stop
+        if stop is None:
+            stop = self.count()
+        if self.empty or stop <= start:
+            return []
+        sql, params = self._sql(
+            'entry_id, score',
+            ' ORDER BY score DESC, entry_id DESC LIMIT %s OFFSET %s'
+        )
+        cursor = connection.cursor()
+        cursor.execute(sql, params + [stop - start, start])
+        scores = cursor.fetchall()
+        entries = self.queryset.in_bulk([pk for pk, score in scores])
+        results = []
+        for pk, score in scores:
+            if pk in entries:
+                entries[pk].score = score
+                results.append(entries[pk])
+        return results
@@ -1,36 +1,38 @@
 from django.contrib.sites.models import Site
 from django.template.loader import render_to_string
-from django.core.mail import mail_managers
-from django.conf import settings
-from akismet import Akismet
+from django.dispatch import Signal
+from notifications import notify_managers
+import spam
+
+# Sent with a dictionary mapping the primary key of each entry that has been
+# saved, deleted or bulk updated to a (previous, current) pair of EntryStates.
+# previous is None for new entries and current is None for deleted ones.
+entries_changed = Signal(providing_args=['changes'])
 
 def comment_spam_check(sender, comment, request, **kwargs):
     """
-    Check a comment to see if Akismet flags it as spam and (ultimately) return
-    a 400 bad request if it was detected as such.
+    Hold a comment back from the site until Akismet has checked it. The check
+    is queued once the comment has been saved.
     """
-    AKISMET_API_KEY = getattr(settings, 'AKISMET_API_KEY', False)
-    if AKISMET_API_KEY and not settings.DEBUG:
-        ak = Akismet(
-            key=AKISMET_API_KEY,
-            blog_url='http://%s/' % Site.objects.get_current().domain
-        )
-        if ak.verify_key():
-            data = {
-                'user_ip': request.META.get('REMOTE_ADDR', '127.0.0.1'),
-                'user_agent': request.META.get('HTTP_USER_AGENT', ''),
-                'referrer': request.META.get('HTTP_REFERER', ''),
-                'comment_type': 'comment',
-                'comment_author': comment.user_name.encode('utf-8'),
-            }
-            
-            if ak.comment_check(comment.comment.encode('utf-8'), data=data, build_data=True):
-                comment.is_public = False
-                comment.save()
+    if spam.enabled():
+        comment.is_public = False
+        comment._loft_spam_check = {
+            'user_agent': request.META.get('HTTP_USER_AGENT', ''),
+            'referrer': request.META.get('HTTP_REFERER', ''),
+        }
+
+def queue_spam_check(sender, comment, **kwargs):
+    """
+    Queue a held comment for ./manage.py loft_spam_check
+    """
+    data = getattr(comment, '_loft_spam_check', None)
+    if data is not None:
+        from models import SpamCheck
+        SpamCheck.objects.create(comment=comment, **data)
 
 def comment_notifier(sender, comment, **kwargs):
     """
-    Email managers when a new comment is posted
+    Queue an email to managers when a new comment is posted
     """
     if comment.is_public:
         subject = "New comment by %s on %s" % (comment.user_name, Site.objects.get_current().domain)
@@ -39,4 +41,4 @@ def comment_notifier(sender, comment, **kwargs):
                 'comment': comment
             }
         )
-        mail_managers(subject, body, fail_silently=False, connection=None)
\ No newline at end of file
+        notify_managers(subject, body)
@@ -1,12 +1,144 @@
+"""
+The sitemap of published entries.
+
+loft's URLconf serves a sitemap index at ``sitemap.xml`` and numbered
+sections at ``sitemap-1.xml``, ``sitemap-2.xml`` and so on. Section ``n``
+holds the published entries with primary keys from ``(n - 1) * size + 1`` to
+``n * size``, where ``size`` is ``LOFT_SITEMAP_SIZE`` (default 50,000, the
+protocol's limit). Old sections therefore never move, and each is listed in
+the index with the time its newest entry was updated.
+
+Sections are streamed, reading only the slug and update time of their entries
+a chunk at a time, so memory use doesn't grow with the size of the archive.
+"""
+from django.conf import settings
 from django.contrib.sitemaps import Sitemap
+from django.contrib.sitemaps.views import sitemap as sitemap_view
+from django.contrib.sites.models import get_current_site
+from django.core.urlresolvers import reverse
+from django.db.models import Max
+from django.http import HttpResponse, Http404
+from django.utils.html import escape
+from conditional import conditional
+from pagecache import cache_page
 from models import Entry
+import itertools
+
+SITEMAP_SIZE = getattr(settings, 'LOFT_SITEMAP_SIZE', 50000)
+
+SITEMAP_CHUNK_SIZE = 1000
+
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
 
 class LoftSitemap(Sitemap):
+    """
+    A sitemap for use with django.contrib.sitemaps, loading only the columns
+    needed for each URL. Large blogs should use loft's own sitemap views.
+    """
     changefreq = "never"
     priority = 0.8
 
     def items(self):
-        return Entry.objects.published()
+        return Entry.objects.published().values('slug', 'updated')
+
+    def location(self, obj):
+        return reverse('blog_entry_detail', kwargs={'slug': obj['slug']})
 
     def lastmod(self, obj):
-        return obj.updated
\ No newline at end of file
+        return obj['updated']
+
+# Use in place of django.contrib.sitemaps.views.sitemap to answer conditional
+# requests for the sitemap and cache it
+sitemap = conditional(cache_page(sitemap_view))
+
+
+def section_number(pk):
+    return (pk - 1) // SITEMAP_SIZE + 1
+
+
+def sections():
+    """
+    Returns a list of (section number, lastmod) for the sections with
+    published entries
+    """
+    last_pk = Entry.objects.published().aggregate(Max('pk'))['pk__max']
+    if last_pk is None:
+        return []
+    found = []
+    for number in range(1, section_number(last_pk) + 1):
+        lastmod = Entry.objects.published().filter(
+            pk__gt=(number - 1) * SITEMAP_SIZE,
+            pk__lte=number * SITEMAP_SIZE,
+        ).aggregate(Max('updated'))['updated__max']
+        if lastmod is not None:
+            found.append((number, lastmod))
+    return found
+
+
+def section_urls(number):
+    """
+    Yields the (path, lastmod) of the published entries in a section
+    """
+    entries = Entry.objects.published().filter(
+        pk__gt=(number - 1) * SITEMAP_SIZE,
+        pk__lte=number * SITEMAP_SIZE,
+    ).order_by('pk').values_list('pk', 'slug', 'updated')
+    last_pk = None
+    while True:
+        qs = entries
+        if last_pk is not None:
+            qs = qs.filter(pk__gt=last_pk)
+        rows = list(qs[:SITEMAP_CHUNK_SIZE])
+        if not rows:
+            break
+        for pk, slug, updated in rows:
+            yield reverse('blog_entry_detail', kwargs={'slug': slug}), updated
+        last_pk = rows[-1][0]
+
+
+def index(request):
+    """
+    The sitemap index, listing every section with its lastmod
+    """
+    base = '%s://%s' % (request.is_secure() and 'https' or 'http', get_current_site(request).domain)
+    xml = ['<?xml version="1.0" encoding="UTF-8"?>\n',
+        '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n']
+    for number, lastmod in sections():
+        xml.append('<sitemap><loc>%s%s</loc>%s</sitemap>\n' % (
+            base,
+            escape(reverse('blog_sitemap_section', kwargs={'section': number})),
+            lastmod and '<lastmod>%s</lastmod>' % lastmod.strftime(DATE_FORMAT) or '',
+        ))
+    xml.append('</sitemapindex>\n')
+    return HttpResponse(''.join(xml), mimetype='application/xml')
+
+
+def section(request, section):
+    """
+    One section of the sitemap, streamed a chunk of entries at a time
+    """
+    number = int(section)
+    if number < 1:
+        raise Http404("No sitemap section %s" % section)
+    base = '%s://%s' % (request.is_secure() and 'https' or 'http', get_current_site(request).domain)
+    urls = section_urls(number)
+    try:
+        first = urls.next()
+    except StopIteration:
+        raise Http404("No sitemap section %s" % section)
+
+    def stream():
+        yield ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+        for path, lastmod in itertools.chain([first], urls):
+            yield ('<url><loc>%s%s</loc><lastmod>%s</lastmod>'
+                '<changefreq>%s</changefreq><priority>%s</priority></url>\n' % (
+                base, escape(path), lastmod.strftime(DATE_FORMAT),
+                LoftSitemap.changefreq, LoftSitemap.priority,
+            ))
+        yield '</urlset>\n'
+    return HttpResponse(stream(), mimetype='application/xml')
+
+index = conditional(cache_page(index))
+section = conditional(section)
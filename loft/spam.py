@@ -0,0 +1,209 @@
+"""
+Akismet spam checking of comments, kept out of the comment POST request.
+
+When ``AKISMET_API_KEY`` is set, and ``DEBUG`` isn't, posted comments are held
+back from the site and queued as SpamCheck rows. ``./manage.py
+loft_spam_check`` sends them to Akismet on a bounded pool of threads, makes
+public the comments Akismet passes and emails managers about them. Run it
+from cron, or as a worker with ``--loop``.
+
+Each thread keeps its HTTP connection to Akismet open between checks, and the
+result of verifying the key is kept in the ``LOFT_CACHE_BACKEND`` cache, so a
+check costs one round trip. ``LOFT_AKISMET_URL`` sets the API's address
+(default ``https://rest.akismet.com/1.1/``) and ``LOFT_SPAM_CHECK_THREADS``
+the number of threads (default 4). A comment that can't be checked is tried
+again later, after a delay that doubles with each failure as it does for
+notifications. After ``MAX_ATTEMPTS`` tries it stays held for a moderator,
+and managers are told.
+"""
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.utils.hashcompat import md5_constructor
+from akismet import Akismet, AkismetError
+from cache import cache
+from notifications import notify_managers
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
+from urllib import urlencode
+import httplib
+import socket
+import threading
+import urlparse
+
+AKISMET_URL = 'https://rest.akismet.com/1.1/'
+
+SPAM_CHECK_THREADS = getattr(settings, 'LOFT_SPAM_CHECK_THREADS', 4)
+
+MAX_ATTEMPTS = 10
+
+TIMEOUT = 10
+
+VERIFY_TIMEOUT = 60 * 60 * 24
+
+
+def enabled():
+    return bool(getattr(settings, 'AKISMET_API_KEY', None)) and not settings.DEBUG
+
+
+class AkismetClient(Akismet):
+    """
+    An Akismet client that sends every request to ``api_url`` over an HTTP
+    connection kept open between requests, one for each thread
+    """
+
+    def __init__(self, key, blog_url, api_url=AKISMET_URL, timeout=TIMEOUT):
+        Akismet.__init__(self, key=key, blog_url=blog_url, agent='loft')
+        self.api_url = api_url
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _getURL(self):
+        return self.api_url
+
+    def connection(self):
+        conn = getattr(self._local, 'connection', None)
+        if conn is None:
+            scheme, host = urlparse.urlsplit(self.api_url)[:2]
+            connection_class = scheme == 'https' and httplib.HTTPSConnection or httplib.HTTPConnection
+            conn = self._local.connection = connection_class(host, timeout=self.timeout)
+        return conn
+
+    def close(self):
+        conn = getattr(self._local, 'connection', None)
+        if conn is not None:
+            conn.close()
+            self._local.connection = None
+
+    def _safeRequest(self, url, data, headers):
+        path = urlparse.urlsplit(url)[2]
+        headers = dict(headers, **{'Content-Type': 'application/x-www-form-urlencoded'})
+        for retry in (True, False):
+            try:
+                conn = self.connection()
+                conn.request('POST', path, data, headers)
+                response = conn.getresponse()
+                body = response.read()
+            except (httplib.HTTPException, socket.error), e:
+                self.close()
+                # Akismet may have closed a connection that had been idle
+                if retry:
+                    continue
+                raise AkismetError(str(e))
+            if response.status != 200:
+                raise AkismetError("Akismet returned status %d" % response.status)
+            return body
+
+    def verify_key(self):
+        """
+        Returns whether the key is valid, asking Akismet at most once a day
+        """
+        cache_key = 'loft:akismet:%s' % md5_constructor(
+            '|'.join([self.key, self.blog_url, self.api_url])
+        ).hexdigest()
+        valid = cache.get(cache_key)
+        if valid is None:
+            response = self._safeRequest(
+                self.api_url + 'verify-key',
+                urlencode({'key': self.key, 'blog': self.blog_url}),
+                {'User-Agent': self.user_agent}
+            )
+            valid = response.lower() == 'valid'
+            # Check again soon after a failure, in case the key is fixed
+            cache.set(cache_key, valid, valid and VERIFY_TIMEOUT or 60 * 5)
+        return valid
+
+    def comment_check(self, comment, data=None, build_data=True, DEBUG=False):
+        data = dict(data or {}, api_key=self.key)
+        return Akismet.comment_check(self, comment, data, build_data, DEBUG)
+
+
+def get_client():
+    return AkismetClient(
+        key=settings.AKISMET_API_KEY,
+        blog_url='http://%s/' % Site.objects.get_current().domain,
+        api_url=getattr(settings, 'LOFT_AKISMET_URL', AKISMET_URL),
+    )
+
+
+def check_data(check):
+    """
+    Returns the comment text and Akismet parameters of a queued comment
+    """
+    comment = check.comment
+    data = {
+        'user_ip': comment.ip_address or '127.0.0.1',
+        'user_agent': check.user_agent.encode('utf-8'),
+        'referrer': check.referrer.encode('utf-8'),
+        'comment_type': 'comment',
+        'comment_author': comment.user_name.encode('utf-8'),
+        'comment_author_email': comment.user_email.encode('utf-8'),
+        'comment_author_url': comment.user_url.encode('utf-8'),
+    }
+    target = comment.content_object
+    if target is not None and hasattr(target, 'get_absolute_url'):
+        data['permalink'] = 'http://%s%s' % (Site.objects.get_current().domain, target.get_absolute_url())
+    return comment.comment.encode('utf-8'), data
+
+
+def classify(client, text, data):
+    """
+    Returns True for spam, False for ham or None if Akismet couldn't be asked
+    """
+    try:
+        return client.comment_check(text, data=data, build_data=True)
+    except AkismetError:
+        return None
+
+
+def give_up(check):
+    """
+    Tell managers that a comment is held for a moderator, as Akismet couldn't
+    be asked about it
+    """
+    comment = check.comment
+    notify_managers(
+        "Comment by %s on %s couldn't be checked for spam" % (
+            comment.user_name, Site.objects.get_current().domain),
+        "Akismet couldn't be reached after %d tries, so this comment is held until a "
+        "moderator makes it public:\n\n%s" % (check.attempts, comment.comment)
+    )
+
+
+class SpamChecker(object):
+    """
+    Checks queued comments on a pool of ``threads`` threads. Only the threads
+    talk to Akismet; the database is used from the calling thread alone.
+    """
+
+    def __init__(self, client=None, threads=SPAM_CHECK_THREADS):
+        self.client = client or get_client()
+        self.pool = ThreadPool(threads)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def check(self, batch_size=100):
+        """
+        Check a batch of queued comments. Returns the numbers of comments
+        found to be ham, spam and that couldn't be checked.
+        """
+        from models import SpamCheck
+        checks = list(SpamCheck.objects.filter(next_attempt__lte=datetime.now(), attempts__lt=MAX_ATTEMPTS)
+            .select_related('comment').order_by('next_attempt', 'pk')[:batch_size])
+        jobs = [check_data(check) for check in checks]
+        results = self.pool.map(lambda (text, data): classify(self.client, text, data), jobs)
+        counts = [0, 0, 0]
+        for check, spam in zip(checks, results):
+            if spam is None:
+                check.retry()
+                if check.attempts >= MAX_ATTEMPTS:
+                    give_up(check)
+                counts[2] += 1
+            elif spam:
+                check.delete()
+                counts[1] += 1
+            else:
+                check.release()
+                counts[0] += 1
+        return tuple(counts)
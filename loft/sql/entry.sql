@@ -0,0 +1,10 @@
+-- Custom indexes for loft, installed by syncdb. See "Upgrading" in the README
+-- for adding them to an existing database.
+
+-- Live entries are always filtered on status and then ordered, paged, sliced
+-- into archives and searched for neighbours by publish date.
+CREATE INDEX loft_entry_status_publish_date ON loft_entry (status, publish_date);
+
+-- Finding the entries in a category. The unique index Django creates covers
+-- lookups from the entry side.
+CREATE INDEX loft_entry_categories_category_entry ON loft_entry_categories (category_id, entry_id);
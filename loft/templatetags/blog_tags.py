@@ -1,5 +1,6 @@
 from django import template
-from loft.models import Entry
+from loft.models import Entry, ArchiveCount, Category
+from loft.cache import cache, cache_key, cache_timeout
 from django.template import TemplateSyntaxError
 
 register = template.Library()
@@ -10,33 +11,196 @@ def get_latest_entries(parser, token):
     Add a variable to the template context containing the latest [x] blog entries.
     Default context variable is entry_list
 
+    Only the fields needed to list, link to and summarise entries are loaded:
+    title, slug, status, publish_date, featured, markup, excerpt_html and
+    lead_in_html. Other fields, such as the body, cost a query per entry. The
+    list is cached until an entry or category changes.
+
     Syntax::
 
     {% get_latest_entries [limit] %}
     {% get_latest_entries [limit] as [varname] %}
+    {% get_latest_entries [limit] category=[category or slug] featured as [varname] %}
 
     Example usage::
 
     {% get_latest_entries 5 %}
     {% get_latest_entries 5 as some_variable %}
+    {% get_latest_entries 5 category="django" as django_entries %}
+    {% get_latest_entries 3 featured as featured_entries %}
     """
 
     tokens = token.contents.split()
-    if len(tokens) not in (2,4):
-        raise template.TemplateSyntaxError("%r tag requires 1 or 3 arguments" % tokens[0])
+    if len(tokens) < 2:
+        raise template.TemplateSyntaxError("%r tag requires at least 1 argument" % tokens[0])
     if not tokens[1].isdigit():
         raise template.TemplateSyntaxError("First argument in %r tag must be an integer" % tokens[0])
+    varname = None
+    if len(tokens) > 2 and tokens[-2] == 'as':
+        varname = tokens[-1]
+        tokens = tokens[:-2]
+    elif 'as' in tokens:
+        raise template.TemplateSyntaxError("'as' in %r tag must be followed by one variable name" % tokens[0])
+    category, featured = None, False
+    for option in tokens[2:]:
+        if option.startswith('category='):
+            category = parser.compile_filter(option[len('category='):])
+        elif option == 'featured':
+            featured = True
+        else:
+            raise template.TemplateSyntaxError("Unknown option %r in %r tag" % (option, tokens[0]))
+    return LatestEntriesNode(tokens[1], varname, category, featured)
+register.tag('get_latest_entries', get_latest_entries)
+
+LATEST_ENTRY_FIELDS = ('id', 'title', 'slug', 'status', 'publish_date', 'featured', 'markup',
+    'excerpt_html', 'lead_in_html')
+
+class LatestEntriesNode(template.Node):
+    def __init__(self, limit, varname=None, category=None, featured=False):
+        self.limit, self.varname = int(limit), varname
+        self.category, self.featured = category, featured
+
+    def render(self, context):
+        category = self.category and self.category.resolve(context)
+        if isinstance(category, Category):
+            category = category.slug
+        key = cache_key('latest_entries', self.limit, category or '', self.featured)
+        entries = cache.get(key)
+        if entries is None:
+            entries = Entry.objects.published().only(*LATEST_ENTRY_FIELDS)
+            if category:
+                entries = entries.filter(categories__slug=category)
+            if self.featured:
+                entries = entries.filter(featured=True)
+            entries = list(entries[:self.limit])
+            cache.set(key, entries, cache_timeout())
+        context[self.varname or 'entry_list'] = entries
+        return ''
+
+
+def get_archive_tree(parser, token):
+
+    """
+    Add a variable to the template context containing the years and months
+    with published entries, newest first, and the number of entries in each.
+    Read from loft's archive counts rather than the entries themselves.
+    Default context variable is archive_tree
+
+    Syntax::
+
+    {% get_archive_tree %}
+    {% get_archive_tree as [varname] %}
+
+    Example usage::
+
+    {% get_archive_tree %}
+    {% for year in archive_tree %}
+        <a href="{% url blog_entry_archive_year year.year %}">{{ year.year }}</a> ({{ year.count }})
+        {% for month in year.months %}
+            <a href="{% url blog_entry_archive_month month.date.year month.date|date:"b" %}">{{ month.date|date:"F" }}</a> ({{ month.count }})
+        {% endfor %}
+    {% endfor %}
+    """
+
+    tokens = token.contents.split()
+    if len(tokens) not in (1,3):
+        raise template.TemplateSyntaxError("%r tag requires 0 or 2 arguments" % tokens[0])
+    if len(tokens) == 3:
+        if tokens[1] != 'as':
+            raise template.TemplateSyntaxError("First argument in %r tag must be 'as'" % tokens[0])
+        return ArchiveTreeNode(tokens[2])
+    return ArchiveTreeNode()
+register.tag('get_archive_tree', get_archive_tree)
+
+class ArchiveTreeNode(template.Node):
+    def __init__(self, varname=None):
+        self.varname = varname
+
+    def render(self, context):
+        context[self.varname or 'archive_tree'] = ArchiveCount.objects.tree()
+        return ''
+
+
+def get_category_cloud(parser, token):
+
+    """
+    Add a variable to the template context containing the categories with
+    published entries, by name. Each has an entry_count and a weight from 1 to
+    [steps] (default 5) for sizing it in a tag cloud. Default context variable
+    is category_cloud
+
+    Syntax::
+
+    {% get_category_cloud %}
+    {% get_category_cloud [steps] %}
+    {% get_category_cloud [steps] as [varname] %}
+
+    Example usage::
+
+    {% get_category_cloud 5 as cloud %}
+    {% for category in cloud %}
+        <span class="weight-{{ category.weight }}">{{ category.name }} ({{ category.entry_count }})</span>
+    {% endfor %}
+    """
+
+    tokens = token.contents.split()
+    if len(tokens) not in (1,2,4):
+        raise template.TemplateSyntaxError("%r tag requires 0, 1 or 3 arguments" % tokens[0])
+    if len(tokens) > 1 and not tokens[1].isdigit():
+        raise template.TemplateSyntaxError("First argument in %r tag must be an integer" % tokens[0])
     if len(tokens) == 4:
         if tokens[2] != 'as':
             raise template.TemplateSyntaxError("Second argument in %r tag must be 'as'" % tokens[0])
-        return LatestEntriesNode(tokens[1], tokens[3])
-    return LatestEntriesNode(tokens[1])
-register.tag('get_latest_entries', get_latest_entries)
+        return CategoryCloudNode(tokens[1], tokens[3])
+    return CategoryCloudNode(len(tokens) == 2 and tokens[1] or 5)
+register.tag('get_category_cloud', get_category_cloud)
 
-class LatestEntriesNode(template.Node):
-    def __init__(self, limit, varname=None):
-        self.limit, self.varname = limit, varname
+class CategoryCloudNode(template.Node):
+    def __init__(self, steps, varname=None):
+        self.steps, self.varname = int(steps), varname
+
+    def render(self, context):
+        context[self.varname or 'category_cloud'] = Category.objects.cloud(self.steps)
+        return ''
+
+
+def get_related_entries(parser, token):
+
+    """
+    Add a variable to the template context containing the entries most
+    related to an entry, as computed by ./manage.py loft_related. Default
+    context variable is related_entries
+
+    Syntax::
+
+    {% get_related_entries [entry] %}
+    {% get_related_entries [entry] [limit] %}
+    {% get_related_entries [entry] [limit] as [varname] %}
+
+    Example usage::
+
+    {% get_related_entries object 3 as related %}
+    """
+
+    tokens = token.contents.split()
+    if len(tokens) not in (2,3,5):
+        raise template.TemplateSyntaxError("%r tag requires 1, 2 or 4 arguments" % tokens[0])
+    if len(tokens) > 2 and not tokens[2].isdigit():
+        raise template.TemplateSyntaxError("Second argument in %r tag must be an integer" % tokens[0])
+    if len(tokens) == 5:
+        if tokens[3] != 'as':
+            raise template.TemplateSyntaxError("Third argument in %r tag must be 'as'" % tokens[0])
+        return RelatedEntriesNode(tokens[1], tokens[2], tokens[4])
+    return RelatedEntriesNode(tokens[1], len(tokens) == 3 and tokens[2] or None)
+register.tag('get_related_entries', get_related_entries)
+
+class RelatedEntriesNode(template.Node):
+    def __init__(self, entry, limit=None, varname=None):
+        self.entry = template.Variable(entry)
+        self.limit = limit and int(limit)
+        self.varname = varname
 
     def render(self, context):
-        context[self.varname or 'entry_list'] = Entry.objects.published()[:self.limit]
+        entry = self.entry.resolve(context)
+        context[self.varname or 'related_entries'] = entry.get_related_entries(self.limit)
         return ''
@@ -1,2 +1,4 @@
 from models import *
-from views import *
\ No newline at end of file
+from views import *
+from commands import *
+from queries import *
@@ -0,0 +1,60 @@
+"""
+A local stand-in for the Akismet API, for testing spam checking without the
+network. Any key but ``invalid`` is valid, and comments containing ``spam``
+are spam. While ``failing`` is set, comment checks fail with a 503.
+"""
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from urlparse import parse_qs
+import threading
+
+
+class AkismetHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_POST(self):
+        data = dict((k, v[0]) for k, v in parse_qs(
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))).items())
+        self.server.requests.append((self.path, data))
+        if self.path.endswith('/verify-key'):
+            body = data.get('key') == 'invalid' and 'invalid' or 'valid'
+        elif self.path.endswith('/comment-check') and self.server.failing:
+            self.send_error(503)
+            return
+        elif self.path.endswith('/comment-check'):
+            body = 'spam' in data.get('comment_content', '') and 'true' or 'false'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeAkismet(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), AkismetHandler)
+        self.connections = 0
+        self.requests = []
+        self.failing = False
+        self.url = 'http://127.0.0.1:%d/1.1/' % self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
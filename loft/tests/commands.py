@@ -0,0 +1,447 @@
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import TestCase
+from loft.models import Entry, ArchiveCount, Category, RelatedEntry, StaleEntry
+from loft import search
+from django.core.urlresolvers import reverse
+from StringIO import StringIO
+from datetime import datetime, timedelta
+import gzip
+import os
+import shutil
+import sys
+import tempfile
+
+class CommandTestCase(TestCase):
+
+    fixtures = ['users.json']
+
+    def setUp(self):
+        self.superuser = User.objects.get(username='superuser')
+        self._stdout = sys.stdout
+        sys.stdout = StringIO()
+
+    def tearDown(self):
+        sys.stdout = self._stdout
+
+    def new_entry(self, title, body, **kwargs):
+        """
+        Return a new entry object
+        """
+        return Entry.objects.create(
+            title=title,
+            body=body,
+            author=self.superuser,
+            **kwargs
+        )
+
+    def test_rerender(self):
+        """
+        Re-rendering stale HTML
+        """
+        e1 = self.new_entry("entry 1", "A *markdown* entry", status=Entry.PUBLISHED)
+        e2 = self.new_entry("entry 2", "A _textile_ entry", markup=Entry.TEXTILE)
+        Entry.objects.update(body_html='stale', lead_in_html='stale')
+
+        call_command('loft_rerender', markup='textile', dry_run=True, processes=1)
+        self.assertEquals(['stale', 'stale'], [e.body_html for e in Entry.objects.order_by('pk')])
+
+        call_command('loft_rerender', markup='textile', processes=1)
+        self.assertEquals(e2.body_html, Entry.objects.get(pk=e2.pk).body_html)
+        self.assertEquals('stale', Entry.objects.get(pk=e1.pk).body_html)
+
+        # Everything cached with the old HTML is thrown away
+        from loft.cache import cache, generation
+        from loft.feeds import LoftEntryFeedRSS
+        from loft.models import Revision
+        feed = LoftEntryFeedRSS()
+        feed.build()
+        before = generation(), Revision.current()
+        call_command('loft_rerender', batch_size=1, processes=2)
+        for entry in (e1, e2):
+            stored = Entry.objects.get(pk=entry.pk)
+            self.assertEquals(entry.body_html, stored.body_html)
+            self.assertEquals(entry.lead_in_html, stored.lead_in_html)
+        self.assertEquals(None, cache.get(feed.cache_key()))
+        self.assertNotEquals(before[0], generation())
+        self.assertNotEquals(before[1], Revision.current())
+
+    def test_publish(self):
+        """
+        Publishing scheduled entries that have come due
+        """
+        e1 = self.new_entry("entry 1", "An entry", status=Entry.PUBLISHED,
+            publish_date=datetime.now() + timedelta(days=1))
+        call_command('loft_publish')
+        self.assertEquals(Entry.objects.published().count(), 0)
+        Entry.objects.filter(pk=e1.pk).update(publish_date=datetime.now())
+        call_command('loft_publish')
+        self.assertEquals(list(Entry.objects.published()), [e1])
+        e1 = Entry.objects.get(pk=e1.pk)
+        self.assertTrue(e1.get_absolute_url() in e1.lead_in_html)
+
+    def test_archive_counts(self):
+        """
+        Rebuilding the archive counts
+        """
+        self.new_entry("entry 1", "An entry", status=Entry.PUBLISHED, publish_date=datetime(2010, 3, 5))
+        ArchiveCount.objects.all().delete()
+        call_command('loft_archive_counts')
+        self.assertEquals([(c.year, c.month, c.count) for c in ArchiveCount.objects.all()], [(2010, 3, 1)])
+
+    def test_category_counts(self):
+        """
+        Recounting category entries
+        """
+        category = Category.objects.create(name="Category")
+        self.new_entry("entry 1", "An entry", status=Entry.PUBLISHED).categories.add(category)
+        Category.objects.update(entry_count=0)
+        call_command('loft_category_counts')
+        self.assertEquals(Category.objects.get(pk=category.pk).entry_count, 1)
+
+    def test_search_index(self):
+        """
+        Rebuilding the search index
+        """
+        original, search._backend = search.get_backend(), search.TokenIndex()
+        try:
+            self.new_entry("entry 1", "Indexed entry", status=Entry.PUBLISHED)
+            search.get_backend().clear()
+            call_command('loft_search_index')
+            self.assertEquals(search.SearchResults("indexed", Entry.objects.all()).count(), 1)
+        finally:
+            search._backend = original
+
+    def test_related(self):
+        """
+        Computing related entries, in full and for queued entries
+        """
+        def related(entry):
+            return [e.pk for e in entry.get_related_entries()]
+        e1 = self.new_entry("Django caching", "Caching with memcached", status=Entry.PUBLISHED)
+        e2 = self.new_entry("Django templates", "Caching templates", status=Entry.PUBLISHED)
+        call_command('loft_related')
+        self.assertEquals(related(e1), [e2.pk])
+        self.assertFalse(StaleEntry.objects.exists())
+
+        e3 = self.new_entry("Memcached", "Django with memcached", status=Entry.PUBLISHED)
+        self.assertTrue(StaleEntry.objects.exists())
+        call_command('loft_related')
+        self.assertEquals(related(e3), [e1.pk, e2.pk])
+        self.assertFalse(StaleEntry.objects.exists())
+
+        RelatedEntry.objects.all().delete()
+        call_command('loft_related', full=True)
+        self.assertEquals(RelatedEntry.objects.filter(entry=e3).count(), 2)
+
+    def test_export(self):
+        """
+        Exporting static pages, then only those of changed entries
+        """
+        e1 = self.new_entry("entry 1", "An entry", status=Entry.PUBLISHED,
+            publish_date=datetime.now() - timedelta(days=1))
+        e2 = self.new_entry("entry 2", "An entry", status=Entry.PUBLISHED,
+            publish_date=datetime.now() - timedelta(days=400))
+        self.new_entry("entry 3", "A draft", status=Entry.DRAFT)
+        output = tempfile.mkdtemp()
+        try:
+            from loft.export import file_path
+            def read(path, suffix=''):
+                path = file_path(output, path)
+                if suffix == '.gz':
+                    return gzip.open(path + suffix).read()
+                return open(path + suffix).read()
+            def mark(path):
+                path = os.path.join(output, *path.strip('/').split('/') + ['index.html'])
+                open(path, 'w').write('not re-rendered')
+
+            call_command('loft_export', output, processes=1)
+            year = reverse('blog_entry_archive_year', kwargs={'year': e2.publish_date.year})
+            for path in ('/', e1.get_absolute_url(), year, reverse('blog_rss_feed')):
+                self.assertTrue('entry' in read(path))
+                self.assertEquals(read(path), read(path, '.gz'))
+            self.assertFalse(os.path.exists(os.path.join(output, 'entry-3')))
+            self.assertTrue(os.path.exists(os.path.join(output, '.loft-export.json')))
+            # Feeds are written as XML and link to the site
+            from django.contrib.sites.models import Site
+            self.assertTrue(file_path(output, reverse('blog_atom_feed')).endswith('index.xml'))
+            self.assertTrue('http://%s/' % Site.objects.get_current().domain in read(reverse('blog_atom_feed')))
+
+            # Nothing has changed, so nothing is rendered
+            mark('/')
+            call_command('loft_export', output, processes=1)
+            self.assertEquals(read('/'), 'not re-rendered')
+
+            # Unpublishing an entry re-renders the pages that showed it and
+            # removes its own page, leaving the rest alone
+            mark(year)
+            e1.status = Entry.DRAFT
+            e1.save()
+            call_command('loft_export', output, processes=1)
+            self.assertFalse('entry 1' in read('/'))
+            self.assertFalse(os.path.exists(os.path.join(output, 'entry-1')))
+            self.assertEquals(read(year), 'not re-rendered')
+
+            call_command('loft_export', output, full=True, processes=1)
+            self.assertTrue('entry 2' in read(year))
+        finally:
+            shutil.rmtree(output)
+
+    def test_spam_check(self):
+        """
+        Posted comments are held until Akismet has checked them
+        """
+        from django.conf import settings
+        from django.contrib.comments.models import Comment
+        from django.contrib.comments.signals import comment_will_be_posted, comment_was_posted
+        from django.test.client import RequestFactory
+        from loft.models import Notification, SpamCheck
+        from loft.spam import AkismetClient
+        from loft.tests.akismet_server import FakeAkismet
+
+        server = FakeAkismet()
+        server.start()
+        overrides = {'AKISMET_API_KEY': 'key', 'LOFT_AKISMET_URL': server.url}
+        original = dict((name, getattr(settings, name, None)) for name in overrides)
+        for name, value in overrides.items():
+            setattr(settings, name, value)
+        try:
+            entry = self.new_entry("entry 1", "An entry", status=Entry.PUBLISHED)
+            request = RequestFactory().post('/', HTTP_USER_AGENT='Browser')
+            comments = []
+            for text in ("A good comment", "A spam comment", "Another comment"):
+                comment = Comment(content_object=entry, site_id=settings.SITE_ID, user_name="Visitor",
+                    comment=text, ip_address='127.0.0.1')
+                comment_will_be_posted.send(sender=Comment, comment=comment, request=request)
+                comment.save()
+                comment_was_posted.send(sender=Comment, comment=comment, request=request)
+                comments.append(comment)
+            self.assertFalse(Comment.objects.filter(is_public=True).exists())
+            self.assertEquals(SpamCheck.objects.count(), 3)
+            self.assertFalse(Notification.objects.exists())
+            self.assertEquals(server.requests, [])
+
+            call_command('loft_spam_check', threads=2)
+            public = Comment.objects.filter(is_public=True).values_list('pk', flat=True)
+            self.assertEquals(sorted(public), [comments[0].pk, comments[2].pk])
+            self.assertFalse(SpamCheck.objects.exists())
+            self.assertEquals(Notification.objects.count(), 2)
+            paths = [path for path, data in server.requests]
+            self.assertEquals(paths.count('/1.1/verify-key'), 1)
+            self.assertEquals(paths.count('/1.1/comment-check'), 3)
+            check = dict(server.requests)['/1.1/comment-check']
+            self.assertEquals(check['user_agent'], 'Browser')
+            self.assertEquals(check['api_key'], 'key')
+            self.assertTrue(check['permalink'].endswith(entry.get_absolute_url()))
+
+            # Connections are kept open between requests, and a verified key
+            # isn't verified again
+            client = AkismetClient('key', 'http://example.com/', server.url)
+            connections = server.connections
+            for i in range(3):
+                self.assertTrue(client.verify_key())
+                self.assertFalse(client.comment_check("Hello", {'user_ip': '127.0.0.1', 'user_agent': 'Browser'}))
+            client.close()
+            self.assertEquals(server.connections, connections + 1)
+            self.assertEquals(len(server.requests), 7)
+
+            # While Akismet is down, checks are put off for longer each time,
+            # and managers are told when a comment is given up on
+            from loft import spam
+            from loft.notifications import retry_delay
+            server.failing = True
+            Notification.objects.all().delete()
+            comment = Comment.objects.create(content_object=entry, site_id=settings.SITE_ID,
+                user_name="Visitor", comment="Held", ip_address='127.0.0.1', is_public=False)
+            check = SpamCheck.objects.create(comment=comment)
+            call_command('loft_spam_check', threads=2)
+            check = SpamCheck.objects.get(pk=check.pk)
+            self.assertEquals(check.attempts, 1)
+            self.assertTrue(check.next_attempt > datetime.now() + retry_delay(1) - timedelta(seconds=10))
+            call_command('loft_spam_check', threads=2)
+            self.assertEquals(SpamCheck.objects.get(pk=check.pk).attempts, 1)
+            SpamCheck.objects.filter(pk=check.pk).update(
+                attempts=spam.MAX_ATTEMPTS - 1, next_attempt=datetime.now())
+            call_command('loft_spam_check', threads=2)
+            self.assertEquals(SpamCheck.objects.get(pk=check.pk).attempts, spam.MAX_ATTEMPTS)
+            self.assertFalse(Comment.objects.get(pk=comment.pk).is_public)
+            self.assertEquals(Notification.objects.count(), 1)
+            call_command('loft_spam_check', threads=2)
+            self.assertEquals(Notification.objects.count(), 1)
+        finally:
+            for name, value in original.items():
+                if value is None:
+                    delattr(settings, name)
+                else:
+                    setattr(settings, name, value)
+            server.stop()
+
+    def test_notify(self):
+        """
+        Notifications are sent from the outbox over one connection, in
+        digests, and retried with backoff when the server fails
+        """
+        from django.conf import settings
+        from loft.models import Notification
+        from loft.notifications import notify_managers, retry_delay
+        from loft.tests.smtp_server import FakeSMTP
+
+        server = FakeSMTP()
+        server.start()
+        overrides = {
+            'EMAIL_BACKEND': 'django.core.mail.backends.smtp.EmailBackend',
+            'EMAIL_HOST': '127.0.0.1',
+            'EMAIL_PORT': server.port,
+        }
+        original = dict((name, getattr(settings, name)) for name in overrides)
+        for name, value in overrides.items():
+            setattr(settings, name, value)
+        try:
+            for i in range(5):
+                notify_managers("Subject %d" % i, "Body %d" % i)
+            call_command('loft_notify', digest=2)
+            self.assertEquals(server.connections, 1)
+            self.assertEquals(len(server.messages), 3)
+            self.assertTrue('Subject 0' in server.messages[0][2] and 'Body 1' in server.messages[0][2])
+            self.assertTrue('Subject 4' in server.messages[2][2])
+            self.assertFalse(Notification.objects.exists())
+
+            server.fail = True
+            notify_managers("Subject", "Body")
+            call_command('loft_notify')
+            notification = Notification.objects.get()
+            self.assertEquals(notification.attempts, 1)
+            self.assertTrue(notification.next_attempt > datetime.now())
+            self.assertTrue(retry_delay(3) > retry_delay(2) > retry_delay(1))
+
+            # Not due yet
+            server.fail = False
+            call_command('loft_notify')
+            self.assertEquals(len(server.messages), 3)
+            Notification.objects.update(next_attempt=datetime.now())
+            call_command('loft_notify')
+            self.assertEquals(len(server.messages), 4)
+            self.assertFalse(Notification.objects.exists())
+        finally:
+            for name, value in original.items():
+                setattr(settings, name, value)
+            server.stop()
+
+    def test_import(self):
+        """
+        Importing a WordPress export and a directory of Markdown files
+        """
+        from loft import search
+        directory = tempfile.mkdtemp()
+        try:
+            wxr = os.path.join(directory, 'export.xml')
+            open(wxr, 'w').write("""<?xml version="1.0" encoding="UTF-8"?>
+<rss version="2.0" xmlns:excerpt="http://wordpress.org/export/1.2/excerpt/"
+    xmlns:content="http://purl.org/rss/1.0/modules/content/"
+    xmlns:wp="http://wordpress.org/export/1.2/">
+<channel>
+<title>Old blog</title>
+<item>
+    <title>Hello world</title>
+    <content:encoded><![CDATA[<p>Welcome to the <em>old</em> blog.</p>]]></content:encoded>
+    <excerpt:encoded><![CDATA[]]></excerpt:encoded>
+    <wp:post_date>2010-03-01 10:00:00</wp:post_date>
+    <wp:post_name>hello-world</wp:post_name>
+    <wp:status>publish</wp:status>
+    <wp:post_type>post</wp:post_type>
+    <category domain="category" nicename="news"><![CDATA[News]]></category>
+    <category domain="post_tag" nicename="misc"><![CDATA[Misc]]></category>
+    <wp:comment><wp:comment_content>Nice</wp:comment_content></wp:comment>
+</item>
+<item>
+    <title>Unfinished</title>
+    <content:encoded><![CDATA[Not done yet]]></content:encoded>
+    <wp:post_id>12</wp:post_id>
+    <wp:post_date>0000-00-00 00:00:00</wp:post_date>
+    <wp:post_name></wp:post_name>
+    <wp:status>draft</wp:status>
+    <wp:post_type>post</wp:post_type>
+</item>
+<item>
+    <title>About</title>
+    <wp:post_type>page</wp:post_type>
+</item>
+</channel>
+</rss>
+""")
+            call_command('loft_import', wxr, processes=1)
+            entry = Entry.objects.get(slug='hello-world')
+            self.assertTrue(entry.is_published())
+            self.assertEquals(entry.publish_date, datetime(2010, 3, 1, 10))
+            self.assertTrue('<em>old</em>' in entry.body_html)
+            self.assertTrue(entry.get_absolute_url() in entry.lead_in_html)
+            self.assertEquals([(c.name, c.entry_count) for c in entry.categories.all()], [("News", 1)])
+            # Drafts have no slug in WordPress, so one is made from the post ID
+            self.assertTrue(Entry.objects.get(slug='unfinished-12').is_draft())
+            self.assertFalse(Entry.objects.filter(title="About").exists())
+            self.assertEquals(ArchiveCount.objects.get(year=2010, month=3).count, 1)
+            self.assertEquals(search.SearchResults("welcome", Entry.objects.all()).count(), 1)
+            self.assertTrue('Imported 2 entries and skipped 0' in sys.stdout.getvalue())
+
+            # Importing again skips what's already there
+            call_command('loft_import', wxr, processes=1)
+            self.assertEquals(Entry.objects.count(), 2)
+            self.assertTrue('Imported 0 entries and skipped 2' in sys.stdout.getvalue())
+
+            markdown = os.path.join(directory, 'entries')
+            os.mkdir(markdown)
+            open(os.path.join(markdown, 'first.md'), 'w').write(
+                "---\ntitle: Hello world\ndate: 2011-01-02\ncategories: [News, Django]\n---\n"
+                "Some *Markdown*.\n"
+            )
+            open(os.path.join(markdown, '2011-01-03-second-entry.markdown'), 'w').write("Just a body\n")
+            os.mkdir(os.path.join(markdown, 'notes'))
+            open(os.path.join(markdown, 'notes', 'first.md'), 'w').write("Another first\n")
+            call_command('loft_import', markdown, processes=1, batch_size=1)
+            entry = Entry.objects.get(slug='first')
+            self.assertTrue('<em>Markdown</em>' in entry.body_html)
+            self.assertEquals(sorted([c.name for c in entry.categories.all()]), ["Django", "News"])
+            self.assertEquals(Category.objects.get(name="News").entry_count, 2)
+            self.assertEquals(Entry.objects.get(slug='second-entry').title, "second entry")
+            self.assertEquals(Entry.objects.get(slug='notes-first').body, "Another first")
+            count = Entry.objects.count()
+            call_command('loft_import', markdown, processes=1)
+            self.assertEquals(Entry.objects.count(), count)
+
+            # A failing batch leaves the ones written before it counted
+            broken = os.path.join(directory, 'broken')
+            os.mkdir(broken)
+            open(os.path.join(broken, 'a.md'), 'w').write("---\ndate: 2012-05-01\n---\nFine\n")
+            open(os.path.join(broken, 'b.md'), 'w').write("\xff\xfe not UTF-8\n")
+            self.assertRaises(UnicodeDecodeError, call_command, 'loft_import', broken, processes=1, batch_size=1)
+            self.assertTrue(Entry.objects.filter(slug='a').exists())
+            self.assertEquals(ArchiveCount.objects.get(year=2012, month=5).count, 1)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_benchmarks(self):
+        """
+        Generating a corpus and running the benchmarks against it
+        """
+        from django.utils import simplejson
+        from loft.benchmarks import corpus, suite
+        blog = corpus.populate(self.superuser, 20, seed=1, processes=1)
+        self.assertEquals(Entry.objects.count(), 20)
+        self.assertTrue(Entry.objects.published().exists())
+        self.assertTrue(Category.objects.filter(entry_count__gt=0).exists())
+        self.assertEquals(
+            [item['slug'] for item in corpus.Corpus(3, seed=1)],
+            [item['slug'] for item in list(blog)[:3]]
+        )
+
+        results = suite.run(iterations=1)
+        names = [result['name'] for result in results]
+        for name in ('create_markup', 'Entry.save new', 'list ajax', 'detail', 'feed rss',
+                'sitemap section', 'archive month', 'get_latest_entries'):
+            self.assertTrue(name in names)
+        for result in results:
+            self.assertTrue(result['seconds']['min'] >= 0)
+        detail = results[names.index('detail')]
+        self.assertTrue(detail['queries'] > 0)
+        simplejson.dumps(results)
+        self.assertEquals(len(suite.run(iterations=2, names=['list'])), 1)
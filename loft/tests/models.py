@@ -1,11 +1,15 @@
 from django.contrib.auth.models import User
 from django.test import TestCase
-from loft.models import Entry, Category
+from loft.models import Entry, Category, ArchiveCount, StaleEntry
+from loft.rendering import render_cache, highlight_cache
+from loft import search
+from loft.related import update_related
 from datetime import datetime, timedelta
 from django.core.urlresolvers import reverse
 from django.test import Client
 from django.core.handlers.wsgi import WSGIRequest
 from django.test.client import RequestFactory
+from django.template import Template, Context
 
 class EntryTestCase(TestCase):
 
@@ -46,6 +50,34 @@ class EntryTestCase(TestCase):
         self.new_entry("entry 4", "An entry", status=Entry.PUBLISHED, publish_date=self.yesterday)
         self.assertEquals(Entry.objects.published().count(), 2)
     
+    def test_scheduled_entries(self):
+        """
+        Entries published with a future date are scheduled until they're due
+        """
+        a1 = self.new_entry("entry 1", "An entry", status=Entry.PUBLISHED, publish_date=self.tomorrow)
+        self.assertEquals(a1.status, Entry.SCHEDULED)
+        self.assertEquals(Entry.objects.next_publish_date(), self.tomorrow)
+        self.assertEquals(Entry.objects.publish_scheduled(), 0)
+
+        Entry.objects.filter(pk=a1.pk).update(publish_date=self.yesterday)
+        self.assertEquals(Entry.objects.publish_scheduled(), 1)
+        self.assertEquals(list(Entry.objects.published()), [a1])
+        self.assertEquals(Entry.objects.next_publish_date(), None)
+
+        # Rows published with a future date by older versions are scheduled
+        Entry.objects.filter(pk=a1.pk).update(publish_date=self.next_week)
+        Entry.objects.publish_scheduled()
+        self.assertEquals(Entry.objects.get(pk=a1.pk).status, Entry.SCHEDULED)
+
+        # Entries scheduled without a date are published now, as in bulk
+        a1.publish_date = None
+        a1.save()
+        self.assertTrue(a1.is_published())
+        self.assertTrue(a1.publish_date is not None)
+        Entry.objects.filter(pk=a1.pk).update(status=Entry.SCHEDULED, publish_date=None)
+        self.assertEquals(Entry.objects.publish_scheduled(), 1)
+        self.assertTrue(Entry.objects.get(pk=a1.pk).is_published())
+
     def test_new_entry_status(self):
         """
         Default status when creating a new entry
@@ -69,6 +101,29 @@ class EntryTestCase(TestCase):
         a2 = self.new_entry("entry 2", "An entry", status=Entry.PUBLISHED)
         self.assertEquals(a2, a1.get_next_entry())
     
+    def test_neighbours(self):
+        """
+        Previous and next entries come from one query and are then cached
+        """
+        a1 = self.new_entry("entry 1", "An entry", status=Entry.PUBLISHED, publish_date=self.last_week)
+        a2 = self.new_entry("entry 2", "An entry", status=Entry.PUBLISHED, publish_date=self.yesterday)
+        a3 = self.new_entry("entry 3", "An entry", status=Entry.PUBLISHED, publish_date=self.yesterday)
+        self.new_entry("entry 4", "An entry", publish_date=self.yesterday)
+        a5 = self.new_entry("entry 5", "An entry", status=Entry.PUBLISHED)
+
+        entry = Entry.objects.get(pk=a2.pk)
+        self.assertNumQueries(1, entry.get_neighbours)
+        self.assertEquals((a1, a3), (entry.get_previous_entry(), entry.get_next_entry()))
+        entry = Entry.objects.get(pk=a3.pk)
+        self.assertEquals((a2, a5), entry.get_neighbours())
+        self.assertEquals((None, a2), Entry.objects.get(pk=a1.pk).get_neighbours())
+
+        # Cached between instances until an entry changes
+        self.assertNumQueries(0, Entry.objects.get(pk=a2.pk).get_neighbours)
+        a3.status = Entry.DRAFT
+        a3.save()
+        self.assertEquals((a1, a5), Entry.objects.get(pk=a2.pk).get_neighbours())
+
     def test_create_markup(self):
         """
         Creating markup
@@ -79,6 +134,322 @@ class EntryTestCase(TestCase):
         self.assertEquals("<p>An entry</p>", a1.create_markup(content))
         self.assertEquals("\t<p>An entry</p>", a2.create_markup(content))
 
+    def test_render_cache(self):
+        """
+        Saving an entry with unchanged content doesn't render it again
+        """
+        render_cache.clear()
+        a1 = self.new_entry("entry 1", "A *cached* entry", markup=Entry.MARKDOWN)
+        misses = render_cache.stats()['misses']
+        a1.title = "A new title"
+        a1.featured = True
+        a1.save()
+        self.assertEquals(misses, render_cache.stats()['misses'])
+        self.assertEquals("<p>A <em>cached</em> entry</p>", a1.body_html)
+        a1.body = "A *changed* entry"
+        a1.save()
+        # The body and the lead-in taken from it
+        self.assertEquals(misses + 2, render_cache.stats()['misses'])
+
+    def test_highlight_cache(self):
+        """
+        Editing the prose of an entry doesn't highlight its code again
+        """
+        from django.core.cache import get_cache
+        # A shared tier of its own, so blocks cached by other tests don't count
+        backend = highlight_cache.backend
+        highlight_cache.backend = get_cache('django.core.cache.backends.locmem.LocMemCache',
+            LOCATION='loft-test-highlight')
+        highlight_cache.backend.clear()
+        highlight_cache.clear()
+        try:
+            body = "Some prose\n\n    :::python\n    print 'hello'\n"
+            a1 = self.new_entry("entry 1", body, markup=Entry.MARKDOWN)
+            self.assertTrue('<div class="codehilite">' in a1.body_html)
+            self.assertEquals(1, highlight_cache.stats()['misses'])
+            a1.body = body.replace("Some prose", "Some edited prose")
+            a1.save()
+            self.assertEquals(1, highlight_cache.stats()['misses'])
+            self.assertTrue('Some edited prose' in a1.body_html)
+        finally:
+            highlight_cache.backend = backend
+
+    def test_lead_in(self):
+        """
+        Lead-ins are created on save and read without rendering
+        """
+        a1 = self.new_entry("entry 1", "A *draft* entry")
+        a2 = self.new_entry("entry 2", "A published entry", excerpt="An _excerpt_", status=Entry.PUBLISHED)
+        self.assertTrue(a1.get_absolute_url() in a1.lead_in_html)
+        self.assertTrue(a2.lead_in_html.startswith("<p>An <em>excerpt</em> <a href=\"%s\"" % a2.get_absolute_url()))
+        render_cache.clear()
+        Entry.objects.get(pk=a2.pk).lead_in()
+        self.assertEquals(0, render_cache.stats()['misses'])
+
+        # Older rows without a stored lead-in
+        Entry.objects.filter(pk=a2.pk).update(lead_in_html='')
+        self.assertEquals(a2.lead_in_html, Entry.objects.get(pk=a2.pk).lead_in())
+
+    def test_archive_counts(self):
+        """
+        Monthly archive counts follow publishing, re-dating and deleting
+        """
+        def counts():
+            return [(m.date.year, m.date.month, m.count)
+                    for year in ArchiveCount.objects.tree() for m in year.months]
+        march = datetime(2010, 3, 5)
+        e1 = self.new_entry("entry 1", "An entry", status=Entry.PUBLISHED, publish_date=march)
+        e2 = self.new_entry("entry 2", "An entry", status=Entry.PUBLISHED, publish_date=march)
+        e3 = self.new_entry("entry 3", "An entry", status=Entry.DRAFT, publish_date=datetime(2011, 1, 1))
+        self.assertEquals(counts(), [(2010, 3, 2)])
+
+        e3.status = Entry.PUBLISHED
+        e3.save()
+        e2.publish_date = datetime(2010, 4, 1)
+        e2.save()
+        self.assertEquals(counts(), [(2011, 1, 1), (2010, 4, 1), (2010, 3, 1)])
+        self.assertEquals([(y.year, y.count) for y in ArchiveCount.objects.tree()], [(2011, 1), (2010, 2)])
+
+        e1.status = Entry.DRAFT
+        e1.save()
+        e3.delete()
+        self.assertEquals(counts(), [(2010, 4, 1)])
+
+        # Entries written behind the ORM's back are picked up by a rebuild
+        Entry.objects.filter(pk=e1.pk).update(status=Entry.PUBLISHED)
+        self.assertEquals(ArchiveCount.objects.rebuild(), 2)
+        self.assertEquals(counts(), [(2010, 4, 1), (2010, 3, 1)])
+        self.new_entry("entry 4", "An entry", status=Entry.PUBLISHED)
+        Entry.objects.filter(slug='entry-4').update(publish_date=None)
+        self.assertEquals(ArchiveCount.objects.rebuild(), 2)
+        self.assertEquals(counts(), [(2010, 4, 1), (2010, 3, 1)])
+
+        with self.assertNumQueries(1):
+            output = Template(
+                "{% load blog_tags %}{% get_archive_tree as archive %}"
+                "{% for year in archive %}{{ year.year }} ({{ year.count }})"
+                "{% for month in year.months %} {{ month.date|date:'b' }} ({{ month.count }}){% endfor %};"
+                "{% endfor %}"
+            ).render(Context())
+        self.assertEquals(output, "2010 (2) apr (1) mar (1);")
+
+    def test_category_counts(self):
+        """
+        Categories count their published entries
+        """
+        def counts():
+            return [c.entry_count for c in Category.objects.order_by('name')]
+        python = Category.objects.create(name="Python")
+        django = Category.objects.create(name="Django")
+        e1 = self.new_entry("entry 1", "An entry", status=Entry.PUBLISHED, publish_date=self.last_week)
+        e2 = self.new_entry("entry 2", "An entry", status=Entry.DRAFT)
+        e1.categories.add(python, django)
+        e2.categories.add(python)
+        self.assertEquals(counts(), [1, 1])
+
+        e2.status = Entry.PUBLISHED
+        e2.save()
+        self.assertEquals(counts(), [1, 2])
+        python.entry_categories.remove(e1)
+        self.assertEquals(counts(), [1, 1])
+        # Removing links that aren't there changes nothing
+        python.entry_categories.remove(e1)
+        e1.categories.remove(python)
+        self.assertEquals(counts(), [1, 1])
+        python.entry_categories.add(e1)
+        e1.categories.clear()
+        self.assertEquals(counts(), [0, 1])
+        django.entry_categories.add(e1, e2)
+        e2.delete()
+        self.assertEquals(counts(), [1, 0])
+
+        Category.objects.update(entry_count=10)
+        Category.objects.rebuild_counts()
+        self.assertEquals(counts(), [1, 0])
+
+    def test_category_cloud(self):
+        """
+        The category cloud weighs categories by their entry counts
+        """
+        small = Category.objects.create(name="Small")
+        large = Category.objects.create(name="Large")
+        Category.objects.create(name="Empty")
+        for i in range(3):
+            entry = self.new_entry("entry %d" % i, "An entry", status=Entry.PUBLISHED, publish_date=self.last_week)
+            entry.categories.add(large)
+        entry.categories.add(small)
+
+        template = Template(
+            "{% load blog_tags %}{% get_category_cloud 3 as cloud %}"
+            "{% for c in cloud %}{{ c.name }} {{ c.entry_count }} {{ c.weight }};{% endfor %}"
+        )
+        self.assertEquals(template.render(Context()), "Large 3 3;Small 1 1;")
+        with self.assertNumQueries(0):
+            template.render(Context())
+        entry.categories.remove(small)
+        self.assertEquals(template.render(Context()), "Large 3 1;")
+
+    def test_latest_entries(self):
+        """
+        The latest entries tag loads a few fields and caches them
+        """
+        django = Category.objects.create(name="Django")
+        e1 = self.new_entry("entry 1", "An entry", status=Entry.PUBLISHED, publish_date=self.last_week, featured=True)
+        e2 = self.new_entry("entry 2", "An entry", status=Entry.PUBLISHED, publish_date=self.yesterday)
+        self.new_entry("entry 3", "A draft", status=Entry.DRAFT)
+        e2.categories.add(django)
+
+        def latest(arguments, **context):
+            return Template(
+                "{% load blog_tags %}{% get_latest_entries " + arguments + " as latest %}"
+                "{% for entry in latest %}{{ entry.title }} {{ entry.get_absolute_url }};{% endfor %}"
+            ).render(Context(context))
+        self.assertEquals(latest("5"), "entry 2 /entry-2/;entry 1 /entry-1/;")
+        self.assertEquals(latest("1"), "entry 2 /entry-2/;")
+        self.assertEquals(latest("5 featured"), "entry 1 /entry-1/;")
+        self.assertEquals(latest('5 category="django"'), "entry 2 /entry-2/;")
+        self.assertEquals(latest("5 category=c featured", c=django), "")
+        with self.assertNumQueries(0):
+            self.assertEquals(latest("5 category=c", c=django), "entry 2 /entry-2/;")
+
+        e2.status = Entry.DRAFT
+        e2.save()
+        self.assertEquals(latest("5"), "entry 1 /entry-1/;")
+
+        # The body isn't loaded, but what's needed to summarise entries is
+        context = Context()
+        Template("{% load blog_tags %}{% get_latest_entries 5 %}").render(context)
+        self.assertFalse('body' in context['entry_list'][0].__dict__)
+        e2.status = Entry.PUBLISHED
+        e2.save()
+        # One query for the entries and one for the cache timeout, however
+        # many entries there are
+        with self.assertNumQueries(2):
+            Template(
+                "{% load blog_tags %}{% get_latest_entries 4 %}{% for entry in entry_list %}"
+                "{{ entry.lead_in_html }}{{ entry.excerpt_html }}{{ entry.get_markup_display }}{% endfor %}"
+            ).render(Context())
+
+    def test_search_index(self):
+        """
+        Both kinds of search index find entries with every word searched for
+        """
+        backends = [search.TokenIndex()]
+        if search.fts5_available():
+            backends.append(search.FTS5Index())
+        original = search.get_backend()
+        e1 = self.new_entry("Caching", "Caching with *memcached*.", status=Entry.PUBLISHED)
+        e2 = self.new_entry("Django", "Caching &amp; templates.", excerpt="A draft")
+        try:
+            for backend in backends:
+                search._backend = backend
+                if isinstance(backend, search.FTS5Index):
+                    # Creating the table would commit the test's transaction
+                    backend.clear()
+                    search.index_entries(Entry.objects.all())
+                else:
+                    search.rebuild()
+
+                def titles(query, queryset=Entry.objects.all()):
+                    return sorted([e.title for e in search.matching(queryset, query)])
+                self.assertEquals(titles("caching"), ["Caching", "Django"])
+                self.assertEquals(titles("CACHING templates"), ["Django"])
+                self.assertEquals(titles("draft"), ["Django"])
+                self.assertEquals(titles("memcached templates"), [])
+                self.assertEquals(titles("caching", Entry.objects.published()), ["Caching"])
+                self.assertEquals(titles("amp"), [])
+                results = search.SearchResults("caching", Entry.objects.all())
+                self.assertEquals(results.count(), 2)
+                self.assertEquals([e.title for e in results[:1]], ["Caching"])
+
+                e2.title = "Templates"
+                e2.save()
+                self.assertEquals(titles("django"), [])
+                self.assertEquals(titles("templates"), ["Templates"])
+                e2.title = "Django"
+                e2.save()
+        finally:
+            search._backend = original
+        e1.delete()
+        self.assertEquals(search.SearchResults("memcached", Entry.objects.all()).count(), 0)
+
+    def test_related_entries(self):
+        """
+        Related entries share words, and are updated as entries change
+        """
+        def related(entry):
+            return [e.pk for e in entry.get_related_entries()]
+        e1 = self.new_entry("Django caching", "Caching templates with memcached in django", status=Entry.PUBLISHED)
+        e2 = self.new_entry("Django templates", "Template caching in django with memcached", status=Entry.PUBLISHED)
+        e3 = self.new_entry("Growing tomatoes", "Growing tomatoes in garden soil", status=Entry.PUBLISHED)
+        e4 = self.new_entry("Garden soil", "Soil for tomatoes in the garden", status=Entry.PUBLISHED)
+        self.assertEquals(update_related(), 4)
+        self.assertEquals(related(e1), [e2.pk])
+        self.assertEquals(related(e4), [e3.pk])
+        StaleEntry.objects.all().delete()
+
+        # A newly published entry is queued, and joins the lists it belongs in
+        e5 = self.new_entry("Memcached", "Caching django with memcached")
+        e5.status = Entry.PUBLISHED
+        e5.save()
+        self.assertEquals(list(StaleEntry.objects.values_list('entry_id', flat=True)), [e5.pk])
+        update_related([e5.pk])
+        self.assertEquals(set(related(e1)), set([e2.pk, e5.pk]))
+        self.assertEquals(set(related(e5)), set([e1.pk, e2.pk]))
+        self.assertEquals(related(e3), [e4.pk])
+        self.assertEquals(len(e1.get_related_entries(1)), 1)
+
+        # An unpublished entry drops out of other lists straight away
+        StaleEntry.objects.all().delete()
+        e2.status = Entry.DRAFT
+        e2.save()
+        self.assertEquals(related(e1), [e5.pk])
+        self.assertEquals(
+            sorted(StaleEntry.objects.values_list('entry_id', flat=True)),
+            sorted([e1.pk, e2.pk, e5.pk])
+        )
+
+        context = Context({'entry': e1})
+        Template("{% load blog_tags %}{% get_related_entries entry 3 as related %}").render(context)
+        self.assertEquals([e.pk for e in context['related']], [e5.pk])
+
+    def test_update_entries(self):
+        """
+        Bulk updates adjust and render entries as save() would, and send
+        entries_changed once
+        """
+        from loft.bulk import update_entries
+        from loft.signals import entries_changed
+        e1 = self.new_entry("entry 1", "First entry")
+        e2 = self.new_entry("entry 2", "Second entry", publish_date=self.next_week)
+        e3 = self.new_entry("entry 3", "Third entry", status=Entry.PUBLISHED)
+        Entry.objects.filter(pk=e3.pk).update(body_html='')
+        self.assertTrue(e1.get_absolute_url() in e1.lead_in())
+
+        sent = []
+        def receiver(sender, changes, **kwargs):
+            sent.append(changes)
+        entries_changed.connect(receiver, sender=Entry)
+        try:
+            self.assertEquals(update_entries(Entry.objects.all(), status=Entry.PUBLISHED), 2)
+        finally:
+            entries_changed.disconnect(receiver, sender=Entry)
+        self.assertEquals(len(sent), 1)
+        self.assertEquals(sorted(sent[0]), [e1.pk, e2.pk])
+        self.assertEquals(sent[0][e1.pk][1].status, Entry.PUBLISHED)
+
+        e1 = Entry.objects.get(pk=e1.pk)
+        self.assertEquals(e1.status, Entry.PUBLISHED)
+        self.assertTrue(reverse('blog_entry_detail', kwargs={'slug': e1.slug}) in e1.lead_in_html)
+        self.assertEquals(e1.version, 2)
+        self.assertEquals(Entry.objects.get(pk=e2.pk).status, Entry.SCHEDULED)
+
+        # Entries missing their HTML are rendered
+        self.assertEquals(update_entries(Entry.objects.all(), enable_comments=False), 3)
+        self.assertEquals(Entry.objects.get(pk=e3.pk).body_html, e3.body_html)
+        self.assertFalse(Entry.objects.filter(enable_comments=True).exists())
+        self.assertEquals(update_entries(Entry.objects.all(), enable_comments=False), 0)
+
     def test_create_slug(self):
         """
         Creating slug and making sure slug can only be changed explicitly
@@ -0,0 +1,126 @@
+from django.contrib.auth.models import User
+from django.contrib.sites.models import Site
+from django.test import TransactionTestCase
+from django.db import connection
+from django.template import Template, Context
+from django.core.urlresolvers import reverse
+from loft.models import Entry, Category
+from loft.sitemaps import LoftSitemap
+from loft import sitemaps
+from django.test.client import RequestFactory
+from loft.feeds import LoftEntryFeedRSS
+from loft.pagination import Page
+from datetime import datetime, timedelta
+import re
+
+# A full scan of one of loft's tables in SQLite's EXPLAIN QUERY PLAN output.
+# Full-text tables are "scanned" with a MATCH constraint (M) on their index.
+FULL_SCAN = re.compile(r'\bSCAN (?:TABLE )?(loft_\w+)\b(?! USING (?:COVERING )?INDEX| VIRTUAL TABLE INDEX \d+:\S*M)')
+
+
+class QueryRecorder(object):
+    """
+    Records the SQL and parameters of every query run on a connection
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.queries = []
+
+    def __enter__(self):
+        original = self.connection.cursor
+        queries = self.queries
+        class RecordingCursor(object):
+            def __init__(self, cursor):
+                self.cursor = cursor
+            def execute(self, sql, params=()):
+                queries.append((sql, params))
+                return self.cursor.execute(sql, params)
+            def __getattr__(self, attr):
+                return getattr(self.cursor, attr)
+            def __iter__(self):
+                return iter(self.cursor)
+        self.connection.cursor = lambda: RecordingCursor(original())
+        return self
+
+    def __exit__(self, *exc_info):
+        del self.connection.cursor
+
+
+class QueryPlanTestCase(TransactionTestCase):
+    """
+    Runs every query issued by the views, feeds, sitemap and template tags
+    through SQLite's query planner and fails if any of loft's tables is read
+    with a full scan. SQLite commits before running EXPLAIN, so this can't be
+    rolled back like an ordinary TestCase.
+    """
+
+    fixtures = ['users.json']
+
+    def setUp(self):
+        superuser = User.objects.get(username='superuser')
+        category = Category.objects.create(name="Category")
+        now = datetime.now()
+        for i in range(5):
+            entry = Entry.objects.create(
+                title="entry %d" % i,
+                body="An entry",
+                author=superuser,
+                status=Entry.PUBLISHED,
+                publish_date=now - timedelta(days=i * 20)
+            )
+            entry.categories.add(category)
+        self.entry = entry
+
+    def assertIndexed(self, queries):
+        cursor = connection.cursor()
+        for sql, params in queries:
+            if not sql.lstrip().upper().startswith('SELECT'):
+                continue
+            cursor.execute('EXPLAIN QUERY PLAN %s' % sql, params)
+            plan = '\n'.join([row[-1] for row in cursor.fetchall()])
+            match = FULL_SCAN.search(plan)
+            if match:
+                self.fail("Full scan of %s in:\n%s\n%s" % (match.group(1), sql, plan))
+
+    def test_query_plans(self):
+        if connection.vendor != 'sqlite':
+            return
+        date = self.entry.publish_date
+        with QueryRecorder(connection) as recorder:
+            self.client.get(reverse('blog_index'))
+            self.client.get(reverse('blog_index'), HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+            page = Page(Entry.objects.published(), 2, after=Page(Entry.objects.published(), 2).next_cursor())
+            self.client.get(reverse('blog_index') + page.next_url())
+            self.client.get(reverse('blog_index') + page.previous_url())
+            self.client.get(self.entry.get_absolute_url())
+            self.client.get(reverse('blog_search'), {'q': 'entry'}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+            self.client.get(self.entry.get_absolute_url(), HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+            self.client.get(reverse('blog_entry_archive_year', kwargs={'year': date.year}))
+            self.client.get(reverse('blog_entry_archive_month', kwargs={
+                'year': date.year, 'month': date.strftime('%b').lower()}))
+            self.client.get(reverse('blog_rss_feed'))
+            self.client.get(reverse('blog_atom_feed'))
+            LoftEntryFeedRSS().build()
+            entry = Entry.objects.get(pk=self.entry.pk)
+            entry.get_neighbours()
+            list(entry.categories.all())
+            LoftSitemap().get_urls(site=Site.objects.get_current())
+            self.client.get(reverse('blog_sitemap'))
+            self.client.get(reverse('blog_sitemap_section', kwargs={'section': 1}))
+            sitemaps.index(RequestFactory().get(reverse('blog_sitemap')))
+            Template(
+                "{% load blog_tags %}{% get_latest_entries 5 %}"
+                "{% for entry in entry_list %}{{ entry.title }}{% endfor %}"
+            ).render(Context())
+            Template(
+                "{% load blog_tags %}{% get_latest_entries 5 category=\"category\" featured %}"
+            ).render(Context())
+            Template("{% load blog_tags %}{% get_archive_tree %}").render(Context())
+            Template("{% load blog_tags %}{% get_category_cloud %}").render(Context())
+            Template(
+                "{% load blog_tags %}{% get_related_entries entry 3 %}"
+                "{% for related in related_entries %}{{ related.title }}{% endfor %}"
+            ).render(Context({'entry': self.entry}))
+        self.assertTrue(recorder.queries)
+        self.assertIndexed(recorder.queries)
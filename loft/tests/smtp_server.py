@@ -0,0 +1,43 @@
+"""
+A local stand-in for an SMTP server, for testing notification emails without
+the network. Set ``fail`` to have it refuse messages.
+"""
+import asyncore
+import smtpd
+import threading
+
+
+class FakeSMTP(smtpd.SMTPServer):
+
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.connections = 0
+        self.messages = []
+        self.fail = False
+        self._running = False
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            self.connections += 1
+            smtpd.SMTPChannel(self, *pair)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        if self.fail:
+            return '451 Try again later'
+        self.messages.append((mailfrom, rcpttos, data))
+
+    def start(self):
+        self._running = True
+        thread = threading.Thread(target=self._serve)
+        thread.daemon = True
+        thread.start()
+
+    def _serve(self):
+        while self._running:
+            asyncore.loop(timeout=0.05, count=1)
+
+    def stop(self):
+        self._running = False
+        self.close()
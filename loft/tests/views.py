@@ -1,6 +1,12 @@
 from django.contrib.auth.models import User
 from django.test import TestCase
 from loft.models import Entry, Category
+from loft.pagination import Page
+from loft.decorators import add_ajax, iter_values
+from loft.pagecache import entry_paths
+import json
+import gzip
+from StringIO import StringIO
 from datetime import datetime, timedelta
 from django.core.urlresolvers import reverse
 from django.test import Client
@@ -47,4 +53,391 @@ class ViewTestCase(TestCase):
         
         r1 = self.client.get(reverse('blog_index'))
         self.assertEquals(r1.status_code, 200)
-        self.assertEquals(str(r1.context['object_list']), str([e2, e4]))
\ No newline at end of file
+        self.assertEquals(str(r1.context['object_list']), str([e2, e4]))
+
+    def test_pagination(self):
+        """
+        Paging through entries with cursors
+        """
+        entries = [
+            self.new_entry("entry %d" % i, "An entry", status=Entry.PUBLISHED, publish_date=self.yesterday)
+            for i in range(5)
+        ]
+        entries.reverse()
+        qs = Entry.objects.published()
+
+        p1 = Page(qs, 2)
+        self.assertEquals(entries[:2], list(p1))
+        self.assertFalse(p1.has_previous())
+        p2 = Page(qs, 2, after=p1.next_cursor())
+        self.assertEquals(entries[2:4], list(p2))
+        p3 = Page(qs, 2, after=p2.next_cursor())
+        self.assertEquals(entries[4:], list(p3))
+        self.assertFalse(p3.has_next())
+        self.assertEquals(entries[2:4], list(Page(qs, 2, before=p3.previous_cursor())))
+        self.assertEquals(entries[:2], list(Page(qs, 2, before=p2.previous_cursor())))
+
+        # JSON pages follow the same cursors
+        response = self.client.get(reverse('blog_index') + p1.next_url(), HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        data = json.loads(response.content)
+        self.assertEquals([e.slug for e in entries[2:]], [e['slug'] for e in data['object_list_json']])
+        self.assertEquals(entries[:2], list(Page(qs, 2, before=data['page_json']['previous_cursor'])))
+        self.assertEquals(None, data['page_json']['next_cursor'])
+
+        response = self.client.get(reverse('blog_index') + '?after=nonsense')
+        self.assertEquals(response.status_code, 404)
+
+        # Published entries always have a publish date for the cursors, and
+        # older rows without one are given one by publish_scheduled()
+        entries[1].publish_date = None
+        entries[1].save()
+        self.assertNotEquals(None, entries[1].publish_date)
+        Entry.objects.filter(pk=entries[1].pk).update(publish_date=None)
+        Entry.objects.publish_scheduled()
+        self.assertEquals(0, qs.filter(publish_date__isnull=True).count())
+        self.assertContains(self.client.get(reverse('blog_index')), entries[1].title)
+
+    def test_entry_detail_queries(self):
+        """
+        The detail view loads the entry, author and categories in two queries,
+        after one more for the conditional GET validators
+        """
+        e1 = self.new_entry("entry 1", "An entry", status=Entry.PUBLISHED)
+        e1.categories.add(Category.objects.create(name="Category"))
+        url = e1.get_absolute_url()
+
+        self.assertNumQueries(3, self.client.get, url)
+        with self.assertNumQueries(3):
+            response = self.client.get(url, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        data = json.loads(response.content)['object_json'][0]
+        self.assertEquals(data['slug'], e1.slug)
+        self.assertEquals(data['author'], self.superuser.pk)
+
+        response = self.client.get(url)
+        self.assertEquals(response.context['object'].get_categories(), list(e1.categories.all()))
+        response = self.client.get(reverse('blog_entry_detail', kwargs={'slug': 'missing-entry'}))
+        self.assertEquals(response.status_code, 404)
+
+    def test_streaming_json(self):
+        """
+        Streamed JSON and NDJSON match the buffered response
+        """
+        for i in range(5):
+            self.new_entry("entry %d" % i, "An entry", status=Entry.PUBLISHED, publish_date=self.yesterday)
+
+        def entries(request):
+            return {'entries': Entry.objects.published().order_by('-pk').values('title', 'slug')}
+        buffered = add_ajax('loft/entry_list.html')(entries)
+        streamed = add_ajax('loft/entry_list.html', stream=True)(entries)
+
+        request = self.factory.get('/', HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        expected = json.loads(buffered(request).content)
+        self.assertEquals(5, len(expected['entries']))
+        self.assertEquals(expected, json.loads(streamed(request).content))
+        qs = entries(request)['entries']
+        self.assertEquals([[len(rows)] for rows in iter_values(qs, 2)], [[2], [2], [1]])
+        self.assertEquals(list(qs), [row for rows in iter_values(qs, 2) for row in rows])
+
+        request = self.factory.get('/', HTTP_X_REQUESTED_WITH='XMLHttpRequest', HTTP_ACCEPT='application/x-ndjson')
+        response = buffered(request)
+        self.assertEquals('application/x-ndjson', response['Content-Type'])
+        lines = [json.loads(line) for line in response.content.splitlines()]
+        self.assertEquals(expected['entries'], lines)
+
+        # Rows are seeked through by their ordering, a query a chunk, without
+        # reading every primary key first
+        qs = Entry.objects.published().order_by('status', '-pk').values('title')
+        with self.assertNumQueries(3):
+            chunks = [rows for rows in iter_values(qs, 2)]
+        self.assertEquals([row for rows in chunks for row in rows], list(qs))
+        # Columns that may be NULL can't be seeked through
+        qs = Entry.objects.order_by('-publish_date').values('title')
+        self.assertEquals([row for rows in iter_values(qs, 2) for row in rows], list(qs))
+
+        # The index and search stream a line for each entry
+        for url in (reverse('blog_index') + '?format=ndjson', reverse('blog_search') + '?q=entry&format=ndjson'):
+            response = self.client.get(url, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+            lines = [json.loads(line) for line in ''.join(response).splitlines()]
+            self.assertEquals(len([line for line in lines if 'title' in line]), 5)
+        response = self.client.get(reverse('blog_index'), HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertFalse(response._is_string)
+        self.assertEquals(len(json.loads(''.join(response))['object_list_json']), 5)
+
+    def test_conditional_get(self):
+        """
+        Unchanged pages are answered with 304 Not Modified
+        """
+        e1 = self.new_entry("entry 1", "An entry", status=Entry.PUBLISHED, publish_date=self.yesterday)
+        urls = [
+            reverse('blog_index'),
+            e1.get_absolute_url(),
+            reverse('blog_entry_archive_year', kwargs={'year': e1.publish_date.year}),
+        ]
+        for url in urls:
+            response = self.client.get(url)
+            self.assertEquals(response.status_code, 200)
+            validators = {
+                'HTTP_IF_NONE_MATCH': response['ETag'],
+                'HTTP_IF_MODIFIED_SINCE': response['Last-Modified'],
+            }
+            self.assertEquals(self.client.get(url, **validators).status_code, 304)
+            # The JSON variant has its own ETag
+            response = self.client.get(url, HTTP_X_REQUESTED_WITH='XMLHttpRequest', HTTP_IF_NONE_MATCH=response['ETag'])
+            self.assertEquals(response.status_code, 200)
+
+        response = self.client.get(e1.get_absolute_url())
+        e1.title = "A new title"
+        e1.save()
+        response = self.client.get(e1.get_absolute_url(), HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEquals(response.status_code, 200)
+
+        # Deleting an entry changes the ETag of the pages that listed it
+        e2 = self.new_entry("entry 2", "An entry", status=Entry.PUBLISHED, publish_date=self.last_week)
+        response = self.client.get(reverse('blog_index'))
+        e2.delete()
+        response = self.client.get(reverse('blog_index'), HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEquals(response.status_code, 200)
+
+        # Comments change the validators of their entry's page
+        from django.conf import settings
+        from django.contrib.comments.models import Comment
+        url = e1.get_absolute_url()
+        response = self.client.get(url)
+        comment = Comment.objects.create(content_object=e1, site_id=settings.SITE_ID,
+            user_name="Visitor", user_email="visitor@example.com", comment="Hello",
+            submit_date=self.now + timedelta(minutes=1))
+        validators = {
+            'HTTP_IF_NONE_MATCH': response['ETag'],
+            'HTTP_IF_MODIFIED_SINCE': response['Last-Modified'],
+        }
+        self.assertEquals(self.client.get(url, **validators).status_code, 200)
+        response = self.client.get(url)
+        comment.is_removed = True
+        comment.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEquals(response.status_code, 200)
+
+        # Visitors with a session get no validators, so an anonymous copy is
+        # never confirmed to them
+        self.client.cookies[settings.SESSION_COOKIE_NAME] = 'session'
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEquals(response.status_code, 200)
+        self.assertFalse(response.has_header('ETag'))
+
+    def test_feeds(self):
+        """
+        Feeds are served pre-serialized and rebuilt when their entries change
+        """
+        from loft import feeds
+        e1 = self.new_entry("entry 1", "An entry", status=Entry.PUBLISHED, publish_date=self.last_week)
+        for url in (reverse('blog_rss_feed'), reverse('blog_atom_feed')):
+            with self.assertNumQueries(0):
+                response = self.client.get(url)
+            self.assertContains(response, "entry 1")
+            self.assertEquals(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+            compressed = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip, deflate')
+            self.assertEquals(compressed['Content-Encoding'], 'gzip')
+            self.assertEquals(gzip.GzipFile(fileobj=StringIO(compressed.content)).read(), response.content)
+            self.assertNotEquals(compressed['ETag'], response['ETag'])
+
+        # Publishing rebuilds the feeds straight away
+        e2 = self.new_entry("entry 2", "An entry", status=Entry.PUBLISHED, publish_date=self.yesterday)
+        with self.assertNumQueries(0):
+            self.assertContains(self.client.get(reverse('blog_rss_feed')), "entry 2")
+        e2.status = Entry.DRAFT
+        e2.save()
+        self.assertNotContains(self.client.get(reverse('blog_rss_feed')), "entry 2")
+
+        # Feeds rebuilt outside of a request link to the site
+        from django.contrib.sites.models import Site
+        from loft import handlers
+        domain = Site.objects.get_current().domain
+        self.assertContains(self.client.get(reverse('blog_rss_feed')), 'http://%s%s' % (domain, e1.get_absolute_url()))
+        scheme = handlers.SITE_SCHEME
+        handlers.SITE_SCHEME = 'https'
+        try:
+            e1.save()
+        finally:
+            handlers.SITE_SCHEME = scheme
+        self.assertContains(self.client.get(reverse('blog_rss_feed')), 'https://%s%s' % (domain, e1.get_absolute_url()))
+
+        # Entries too old to be in a full feed don't rebuild it
+        items = feeds.FEED_ITEMS
+        feeds.FEED_ITEMS = 1
+        try:
+            e2.status = Entry.PUBLISHED
+            e2.save()
+            e1.title = "A new title"
+            e1.save()
+            self.assertNotContains(self.client.get(reverse('blog_rss_feed')), "entry 1")
+            with self.assertNumQueries(0):
+                feeds.refresh_feeds(Entry, {e1.pk: (e1.get_state(), e1.get_state())})
+            # An entry without a publish date is taken to be in it
+            undated = e1.get_state()._replace(publish_date=None)
+            feeds.refresh_feeds(Entry, {e1.pk: (e1.get_state(), undated)})
+        finally:
+            feeds.FEED_ITEMS = items
+
+    def test_sitemap(self):
+        """
+        The sitemap is split into sections of primary keys, each streamed
+        """
+        from loft import sitemaps
+        size, chunk_size = sitemaps.SITEMAP_SIZE, sitemaps.SITEMAP_CHUNK_SIZE
+        sitemaps.SITEMAP_SIZE, sitemaps.SITEMAP_CHUNK_SIZE = 2, 1
+        try:
+            entries = [
+                self.new_entry("entry %d" % i, "An entry", status=Entry.PUBLISHED, publish_date=self.last_week)
+                for i in range(5)
+            ]
+            self.new_entry("draft", "An entry", status=Entry.DRAFT)
+            numbers = sorted(set([sitemaps.section_number(e.pk) for e in entries]))
+            self.assertEquals([number for number, lastmod in sitemaps.sections()], numbers)
+
+            response = sitemaps.index(self.factory.get(reverse('blog_sitemap')))
+            for number in numbers:
+                self.assertContains(response, reverse('blog_sitemap_section', kwargs={'section': number}))
+
+            urls = []
+            for number in numbers:
+                response = self.client.get(reverse('blog_sitemap_section', kwargs={'section': number}))
+                self.assertEquals(response['Content-Type'], 'application/xml')
+                content = response.content
+                self.assertTrue(content.count('<url>') <= 2)
+                urls += [e.get_absolute_url() for e in entries if e.get_absolute_url() in content]
+            self.assertEquals(sorted(urls), sorted([e.get_absolute_url() for e in entries]))
+            self.assertFalse('draft' in ''.join(urls))
+
+            empty = reverse('blog_sitemap_section', kwargs={'section': numbers[-1] + 1})
+            self.assertEquals(self.client.get(empty).status_code, 404)
+        finally:
+            sitemaps.SITEMAP_SIZE, sitemaps.SITEMAP_CHUNK_SIZE = size, chunk_size
+
+    def test_search(self):
+        """
+        Searching published entries, best matches first
+        """
+        self.new_entry("Django tips", "Notes on *caching*.", status=Entry.PUBLISHED, publish_date=self.last_week)
+        self.new_entry("Caching", "Caching with Django and memcached.", status=Entry.PUBLISHED, publish_date=self.yesterday)
+        self.new_entry("Unrelated", "Nothing to see here.", status=Entry.PUBLISHED, publish_date=self.yesterday)
+        self.new_entry("Draft caching", "Django caching draft.", status=Entry.DRAFT)
+
+        def search(query, **params):
+            params['q'] = query
+            response = self.client.get(reverse('blog_search'), params, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+            self.assertEquals(response.status_code, 200)
+            return json.loads(response.content)
+
+        data = search("caching")
+        self.assertEquals([e['title'] for e in data['object_list_json']], ["Caching", "Django tips"])
+        self.assertTrue(data['object_list_json'][0]['score'] > data['object_list_json'][1]['score'])
+        self.assertEquals(search("django caching")['page_json']['count'], 2)
+        self.assertEquals(search("memcached")['page_json']['count'], 1)
+        self.assertEquals(search("the")['object_list_json'], [])
+        self.assertEquals(search('"drop table')['object_list_json'], [])
+
+        from loft.views import search as search_view
+        request = self.factory.get(reverse('blog_search'), {'q': 'caching', 'page': 2},
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        data = json.loads(search_view(request, klass=Entry, per_page=1).content)
+        self.assertEquals([e['title'] for e in data['object_list_json']], ["Django tips"])
+        self.assertEquals(data['page_json']['previous_url'], '?q=caching&page=1')
+        self.assertEquals(data['page_json']['next_url'], None)
+        response = self.client.get(reverse('blog_search'), {'q': 'caching', 'page': 3},
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEquals(response.status_code, 404)
+
+        # The admin's search uses the index too, drafts included
+        self.superuser.set_password('password')
+        self.superuser.save()
+        admin = Client()
+        admin.login(username='superuser', password='password')
+        response = admin.get(reverse('admin:loft_entry_changelist'), {'q': 'caching'})
+        self.assertEquals(response.context['cl'].result_count, 3)
+        self.assertNotContains(response, "Unrelated")
+
+    def test_page_cache(self):
+        """
+        Pages are cached until an entry shown on them changes
+        """
+        from django.conf import settings
+        settings.LOFT_PAGE_CACHE = True
+        try:
+            e1 = self.new_entry("entry 1", "An entry", status=Entry.PUBLISHED, publish_date=self.last_week)
+            e2 = self.new_entry("entry 2", "An entry", status=Entry.PUBLISHED, publish_date=self.yesterday)
+            old = self.new_entry("entry 3", "An entry", status=Entry.PUBLISHED, publish_date=self.now - timedelta(days=400))
+            index = reverse('blog_index')
+            old_url = old.get_absolute_url()
+            self.assertContains(self.client.get(index), "entry 2")
+            self.client.get(old_url)
+
+            # Cached pages are served without touching the database, apart
+            # from the conditional GET validators
+            with self.assertNumQueries(1):
+                self.assertContains(self.client.get(index), "entry 2")
+
+            e2.title = "A new title"
+            e2.save()
+            self.assertContains(self.client.get(index), "A new title")
+            # Its neighbour links to it, the old entry doesn't
+            paths = entry_paths(e2.pk, e2.get_state())
+            self.assertTrue(e1.get_absolute_url() in paths)
+            self.assertFalse(old_url in paths)
+            with self.assertNumQueries(1):
+                self.client.get(old_url)
+
+            # Deleting an entry purges the pages that showed it
+            e2.delete()
+            self.assertNotContains(self.client.get(index), "A new title")
+
+            # So do bulk actions in the admin, which don't call save()
+            self.superuser.set_password('password')
+            self.superuser.save()
+            admin = Client()
+            admin.login(username='superuser', password='password')
+            admin.post(reverse('admin:loft_entry_changelist'), {
+                'action': 'make_draft',
+                '_selected_action': [e1.pk],
+            })
+            self.assertEquals(Entry.objects.get(pk=e1.pk).status, Entry.DRAFT)
+            self.assertNotContains(self.client.get(index), "entry 1")
+        finally:
+            del settings.LOFT_PAGE_CACHE
+
+    def test_page_cache_csrf_and_comments(self):
+        """
+        Pages holding a CSRF token aren't cached, and comments purge their
+        entry's page
+        """
+        from django.conf import settings
+        from django.contrib.comments.models import Comment
+        from django.http import HttpResponse
+        from django.middleware.csrf import get_token
+        from loft.cache import cache
+        from loft.pagecache import cache_page, page_key
+        settings.LOFT_PAGE_CACHE = True
+        try:
+            @cache_page
+            def form(request):
+                return HttpResponse(get_token(request))
+            request = self.factory.get('/form/')
+            form(request)
+            self.assertEquals(cache.get(page_key(request)), None)
+
+            e1 = self.new_entry("entry 1", "An entry", status=Entry.PUBLISHED, publish_date=self.yesterday)
+            url = e1.get_absolute_url()
+            self.client.get(url)
+            request = self.factory.get(url)
+            self.assertNotEquals(cache.get(page_key(request)), None)
+            comment = Comment.objects.create(content_object=e1, site_id=settings.SITE_ID,
+                user_name="Visitor", user_email="visitor@example.com", comment="Hello")
+            self.assertEquals(cache.get(page_key(request)), None)
+
+            # Moderating it purges the page again
+            self.client.get(url)
+            comment.is_public = False
+            comment.save()
+            self.assertEquals(cache.get(page_key(request)), None)
+        finally:
+            del settings.LOFT_PAGE_CACHE
@@ -2,7 +2,11 @@ from django.conf.urls.defaults import *
 from django.contrib.auth.decorators import user_passes_test
 from models import Entry
 from django.views.generic.list_detail import object_detail, object_list
+from django.views.generic.date_based import archive_year, archive_month
 from feeds import LoftEntryFeedRSS, LoftEntryFeedAtom
+from conditional import conditional
+from pagecache import cache_page
+import sitemaps as loft_sitemaps
 import views as loft_views
 
 draft_detail_view = user_passes_test(lambda u: u.is_staff)(object_detail)
@@ -12,25 +16,29 @@ live_entries = {
 }
 
 monthly_entries = dict(live_entries.items() + [
-    ('date_field', 'created')
+    ('date_field', 'publish_date')
 ])
 
 yearly_entries = dict(monthly_entries.items() + [
-    ('date_field', 'created'),
+    ('date_field', 'publish_date'),
     ('make_object_list', True)
 ])
 
 
+# Archives come first so that a year isn't taken for an entry slug
 urlpatterns = patterns('',
+    url(r'^(?P<year>\d{4})/$', conditional(cache_page(archive_year)), yearly_entries, name='blog_entry_archive_year'),
+    url(r'^(?P<year>\d{4})/(?P<month>\w{3})/$', conditional(cache_page(archive_month)), monthly_entries, name='blog_entry_archive_month'),
+    (r'^comments/', include('django.contrib.comments.urls')),
+)
+
+urlpatterns += patterns('',
     url(r'^$', loft_views.list, {'klass': Entry}, name='blog_index'),
+    url(r'^search/$', loft_views.search, {'klass': Entry}, name='blog_search'),
     url(r'^(?P<slug>[-\w]+)/$', loft_views.detail, {'klass': Entry}, name='blog_entry_detail'),
     url(r'^draft/(?P<object_id>\d+)/$', draft_detail_view, {'queryset': Entry.objects.all()}, name='blog_entry_draft'),
     url(r'^feeds/rss/$', LoftEntryFeedRSS(), name='blog_rss_feed'),
-    url(r'^feeds/atom/$', LoftEntryFeedAtom(), name='blog_atom_feed')
-)
-
-urlpatterns += patterns('django.views.generic.date_based',
-    url(r'^(?P<year>\d{4})/$', 'archive_year', yearly_entries, name='blog_entry_archive_year'),
-    url(r'^(?P<year>\d{4})/(?P<month>\w{3})/$', 'archive_month', monthly_entries, name='blog_entry_archive_month'),
-    (r'^comments/', include('django.contrib.comments.urls')),
+    url(r'^feeds/atom/$', LoftEntryFeedAtom(), name='blog_atom_feed'),
+    url(r'^sitemap\.xml$', loft_sitemaps.index, name='blog_sitemap'),
+    url(r'^sitemap-(?P<section>\d+)\.xml$', loft_sitemaps.section, name='blog_sitemap_section'),
 )
@@ -1,42 +1,121 @@
-from decorators import add_ajax
+from decorators import add_ajax, InstanceValues, ListValues
+from conditional import conditional
+from pagecache import cache_page
+from pagination import Page, InvalidCursor, PER_PAGE
+from search import SearchResults
+from django.core.paginator import Paginator, InvalidPage
 from django.shortcuts import get_object_or_404
 from django import http
+from urllib import urlencode
 
+@conditional
+@cache_page
 @add_ajax('loft/entry_detail.html')
 def detail(request, klass, slug):
     
     """
     Simple decorated view to return either a rendered template or, if requested
-    via AJAX, a JSON response. Note that we are returning queryset.values()
-    rather than a serialized version of the object because we shouldn't be
-    exposing every field in the json. values() can only be run on a queryset
-    hence we use filter() rather than get().
-
-    There are issues with this method. queryset.values() only works for model
-    field attributes, not methods. If you need this functionality, you're
-    probably better off using a decorator that serialises a dictionary that
-    you build manually.
+    via AJAX, a JSON response. The entry and its author are fetched with one
+    query and its categories with another; templates should use
+    object.get_categories to read them. The JSON is a projection of the loaded
+    entry rather than a serialized version of the object because we shouldn't
+    be exposing every field in the json.
     """
 
-    obj = klass._default_manager.filter(slug=slug)
-    if not obj:
+    try:
+        obj = klass._default_manager.select_related('author').get(slug=slug)
+    except klass.DoesNotExist:
         raise http.Http404
+    obj.get_categories()
     return {
-        'object': obj[0],
-        'object_json': obj.values(
+        'object': obj,
+        'object_json': InstanceValues(obj,
             'title', 'excerpt_html', 'body_html', 'author', 'publish_date',
             'featured', 'slug'
         )
     }
 
 
-@add_ajax('loft/entry_list.html')
-def list(request, klass):
-    obj_list = klass._default_manager.published()
-    return {
-        'object_list': obj_list,
-        'object_list_json': obj_list.values(
-            'title', 'excerpt_html', 'body_html', 'author', 'publish_date',
-            'featured', 'slug'
+@conditional
+@cache_page
+@add_ajax('loft/entry_list.html', stream=True)
+def list(request, klass, per_page=PER_PAGE):
+
+    """
+    A page of published entries, newest first. Pages are selected with the
+    opaque 'after' and 'before' cursors in the query string, which are given
+    by the page's next_url/previous_url in templates and in 'page_json'.
+    Only the variant that's rendered is fetched from the database.
+    """
+
+    try:
+        page = Page(
+            klass._default_manager.published(), per_page,
+            after=request.GET.get('after'), before=request.GET.get('before')
         )
+    except InvalidCursor:
+        raise http.Http404
+    page_json = page.values(
+        'title', 'excerpt_html', 'lead_in_html', 'body_html', 'author', 'publish_date',
+        'featured', 'slug'
+    )
+    return {
+        'object_list': page,
+        'page': page,
+        'object_list_json': page_json,
+        'page_json': page_json.links(),
+    }
+
+
+class SearchPageLinks(object):
+
+    """
+    The position of a page of search results and links to its neighbours,
+    for JSON responses
+    """
+
+    def __init__(self, page, query):
+        self.page = page
+        self.query = query
+
+    def url(self, number):
+        return '?%s' % urlencode([('q', self.query.encode('utf-8')), ('page', number)])
+
+    def as_json(self):
+        page = self.page
+        return {
+            'number': page.number,
+            'num_pages': page.paginator.num_pages,
+            'count': page.paginator.count,
+            'next_url': page.has_next() and self.url(page.next_page_number()) or None,
+            'previous_url': page.has_previous() and self.url(page.previous_page_number()) or None,
+        }
+
+
+@conditional
+@cache_page
+@add_ajax('loft/search.html', stream=True)
+def search(request, klass, per_page=PER_PAGE):
+
+    """
+    Published entries matching the search in the 'q' parameter, best matches
+    first, a page at a time. Pages are numbered with the 'page' parameter;
+    ranked results can't be paged with cursors as the index is.
+    """
+
+    query = request.GET.get('q', '').strip()
+    paginator = Paginator(SearchResults(query, klass._default_manager.published()), per_page)
+    try:
+        page = paginator.page(request.GET.get('page', 1))
+    except InvalidPage:
+        raise http.Http404
+    return {
+        'query': query,
+        'object_list': page.object_list,
+        'page': page,
+        'object_list_json': ListValues(page.object_list,
+            'title', 'excerpt_html', 'lead_in_html', 'author', 'publish_date',
+            'featured', 'slug', 'score'
+        ),
+        'page_json': SearchPageLinks(page, query),
     }
@@ -10,8 +10,14 @@ setup(
     url = "http://github.com/timfletcher/loft",
     packages = [
         "loft",
+        "loft.benchmarks",
+        "loft.management",
+        "loft.management.commands",
         "loft.templatetags",
     ],
+    package_data = {
+        "loft": ["sql/*.sql"],
+    },
     classifiers = [
         "Development Status :: 3 - Alpha",
         "Environment :: Web Environment",